@@ -8,7 +8,6 @@ from flask_login import LoginManager
 
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 class Base(DeclarativeBase):
@@ -16,53 +15,142 @@ class Base(DeclarativeBase):
 
 
 db = SQLAlchemy(model_class=Base)
-# create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
-
-# configure the database with SQLite for local development
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///attendance.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# AWS config
-app.config["AWS_ACCESS_KEY"] = os.environ.get("AWS_ACCESS_KEY", "")
-app.config["AWS_SECRET_KEY"] = os.environ.get("AWS_SECRET_KEY", "")
-app.config["S3_BUCKET"] = os.environ.get("S3_BUCKET", "student-attendance-images")
-app.config["AWS_REGION"] = os.environ.get("AWS_REGION", "us-east-1")
-
-# Configure max content length (20MB) for image uploads
-app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024
-
-# initialize the app with the extension
-db.init_app(app)
-
-# Configure login manager
 login_manager = LoginManager()
-login_manager.login_view = 'login'
-login_manager.init_app(app)
+login_manager.login_view = 'main.login'
 
-# Import and initialize login user loader
-from models import User
 
+def configure_app(app):
+    """
+    Apply the settings read from the environment to a new app.
+
+    Args:
+        app: Flask application to configure
+    """
+    app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+
+    # configure the database with SQLite for local development
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///attendance.db")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    # AWS config
+    app.config["AWS_ACCESS_KEY"] = os.environ.get("AWS_ACCESS_KEY", "")
+    app.config["AWS_SECRET_KEY"] = os.environ.get("AWS_SECRET_KEY", "")
+    app.config["S3_BUCKET"] = os.environ.get("S3_BUCKET", "student-attendance-images")
+    app.config["AWS_REGION"] = os.environ.get("AWS_REGION", "us-east-1")
+
+    # File storage: 'local' (files under STORAGE_ROOT) or 's3' (AWS or an S3-compatible service at S3_ENDPOINT_URL)
+    app.config["STORAGE_BACKEND"] = os.environ.get("STORAGE_BACKEND", "local")
+    app.config["STORAGE_ROOT"] = os.environ.get("STORAGE_ROOT", os.path.join(app.instance_path, "storage"))
+    app.config["S3_ENDPOINT_URL"] = os.environ.get("S3_ENDPOINT_URL", "")
+    app.config["S3_MAX_POOL_CONNECTIONS"] = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 16))
+    app.config["S3_MULTIPART_THRESHOLD"] = int(os.environ.get("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+
+    # How long browsers may reuse resized images (thumbnails etc.) before revalidating, in seconds
+    app.config["IMAGE_CACHE_MAX_AGE"] = int(os.environ.get("IMAGE_CACHE_MAX_AGE", 7 * 24 * 3600))
+
+    # Face recognition backend: 'mock' (random results for demos) or 'synthetic'
+    # (deterministic faces derived from each image, for load tests and benchmarks)
+    app.config["RECOGNITION_BACKEND"] = os.environ.get("RECOGNITION_BACKEND", "mock")
+    app.config["RECOGNITION_SEED"] = int(os.environ.get("RECOGNITION_SEED", 0))
+
+    # Institution-wide face index (snapshot file; updates are logged next to it)
+    app.config["FACE_INDEX_PATH"] = os.environ.get("FACE_INDEX_PATH", os.path.join(app.instance_path, "face_index.npz"))
+
+    # Background attendance processing (0 workers processes photos inside the request)
+    app.config["ATTENDANCE_WORKERS"] = int(os.environ.get("ATTENDANCE_WORKERS", 2))
+    app.config["ATTENDANCE_QUEUE_SIZE"] = int(os.environ.get("ATTENDANCE_QUEUE_SIZE", 32))
+
+    # Sessions still 'processing' after this many seconds are marked failed (the queue does not survive a restart)
+    app.config["ATTENDANCE_PROCESSING_TIMEOUT"] = int(os.environ.get("ATTENDANCE_PROCESSING_TIMEOUT", 900))
+
+    # Multi-photo sessions: at most this many photos, with faces detected in parallel threads
+    app.config["ATTENDANCE_MAX_PHOTOS"] = int(os.environ.get("ATTENDANCE_MAX_PHOTOS", 4))
+    app.config["ATTENDANCE_DETECTION_THREADS"] = int(os.environ.get("ATTENDANCE_DETECTION_THREADS", 4))
+
+    # Frame-stream attendance: time budget (seconds), frames a student must be seen in,
+    # minimum seconds between processed frames and maximum frames per stream
+    app.config["ATTENDANCE_STREAM_BUDGET"] = float(os.environ.get("ATTENDANCE_STREAM_BUDGET", 20))
+    app.config["ATTENDANCE_STREAM_MIN_FRAMES"] = int(os.environ.get("ATTENDANCE_STREAM_MIN_FRAMES", 2))
+    app.config["ATTENDANCE_STREAM_FRAME_INTERVAL"] = float(os.environ.get("ATTENDANCE_STREAM_FRAME_INTERVAL", 0.5))
+    app.config["ATTENDANCE_STREAM_MAX_FRAMES"] = int(os.environ.get("ATTENDANCE_STREAM_MAX_FRAMES", 40))
+
+    # Resubmissions of the same photo (or idempotency key) within this many seconds reuse the first session
+    app.config["ATTENDANCE_DEDUP_WINDOW"] = int(os.environ.get("ATTENDANCE_DEDUP_WINDOW", 600))
+    app.config["ATTENDANCE_DEDUP_CACHE_SIZE"] = int(os.environ.get("ATTENDANCE_DEDUP_CACHE_SIZE", 1024))
+
+    # Bulk student import: face encoding processes and concurrent photo uploads
+    app.config["BULK_IMPORT_PROCESSES"] = int(os.environ.get("BULK_IMPORT_PROCESSES", os.cpu_count() or 1))
+    app.config["BULK_IMPORT_UPLOAD_THREADS"] = int(os.environ.get("BULK_IMPORT_UPLOAD_THREADS", 8))
+    # Total uncompressed size of the photos read from one import archive (they are held in memory)
+    app.config["BULK_IMPORT_MAX_BYTES"] = int(os.environ.get("BULK_IMPORT_MAX_BYTES", 200 * 1024 * 1024))
+
+    # Report the SQL statement count and time of each request in X-SQL-Query-* headers (always on in debug mode)
+    app.config["SQL_DEBUG_HEADERS"] = os.environ.get("SQL_DEBUG_HEADERS", "0") == "1"
+
+    # Bearer token required to scrape /metrics (empty: only served in debug mode or to direct local requests)
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+
+    # Configure max content length (20MB) for image uploads
+    app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024
+
+
+# Login user loader (models imports this module, so User is imported on first use)
 @login_manager.user_loader
 def load_user(user_id):
+    from models import User
     return User.query.get(int(user_id))
 
-with app.app_context():
-    # Import models before creating tables
+
+def create_app(config=None):
+    """
+    Create an application: configuration, extensions, routes, request hooks and CLI commands.
+
+    Every call returns a new, independent app (tests build their own), while
+    the extensions, models and blueprints are shared module-level objects.
+    Creating an app touches neither the database schema (see the init-db
+    command) nor the recognition and image libraries (NumPy, Pillow, the
+    recognition backend), which are imported when first used, so web
+    workers, CLI commands and scripts do not pay for each other's imports.
+    Logging is configured by the entry point (main.py), not here.
+
+    Args:
+        config: Optional mapping of settings overriding the environment (e.g. for tests)
+
+    Returns:
+        Flask: The application
+    """
+    app = Flask(__name__)
+    configure_app(app)
+
+    if config:
+        app.config.update(config)
+
+    # initialize the app with the extension
+    db.init_app(app)
+    login_manager.init_app(app)
+
     import models  # noqa: F401
-    
-    # Create all tables
-    db.create_all()
-    
-    # Import routes after models are defined
-    import routes  # noqa: F401
+
+    # Count SQL statements per request
+    import query_stats
+    query_stats.init_app(app)
+
+    # Register routes after models are defined
+    from routes import bp as routes_bp
+    app.register_blueprint(routes_bp)
+
+    # Register CLI commands
+    from commands import bp as commands_bp
+    app.register_blueprint(commands_bp)
 
     logger.info("Application initialized successfully")
+    return app
+
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    logging.basicConfig(level=logging.DEBUG)
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,534 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import delete, insert
+from flask import current_app
+
+from app import db
+from models import AttendanceSession, AttendanceRecord, SessionDetections, SessionPhoto
+from face_recognition_service import detect_faces_in_image, match_faces, merge_photo_faces
+from recognition_backends import get_recognition_backend
+from aws_service import upload_files
+from encoding_cache import get_class_encodings
+from utils import generate_filename
+from attendance_rollups import UPSERT_INSERTS, add_session_to_rollups, remove_session_from_rollups
+from image_derivatives import generate_derivatives
+from metrics import Counter, STAGE_DURATION, stage_timer
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = None
+_detection_executor = None
+
+ATTENDANCE_SESSIONS = Counter('sgis_attendance_sessions_total',
+                              'Attendance sessions processed, by outcome.',
+                              ['status'])
+
+# Recent submissions: (class_id, kind, value) -> _Submission, oldest first
+_submissions = OrderedDict()
+_submissions_lock = threading.Lock()
+
+# Seconds a resubmission waits for the session of an identical submission still being created
+SUBMISSION_WAIT_TIMEOUT = 10
+
+
+class _Submission:
+    """A recent submission; session_id is set once its session is committed, then ready is set"""
+
+    def __init__(self):
+        self.session_id = None
+        self.submitted_at = time.monotonic()
+        self.ready = threading.Event()
+
+
+# One pool of each kind per process, sized by the first app that uses it
+def _get_executor():
+    global _executor, _pending
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config["ATTENDANCE_WORKERS"],
+                                           thread_name_prefix='attendance')
+            _pending = threading.BoundedSemaphore(current_app.config["ATTENDANCE_QUEUE_SIZE"])
+        return _executor
+
+
+def _get_detection_executor():
+    global _detection_executor
+    with _executor_lock:
+        if _detection_executor is None:
+            _detection_executor = ThreadPoolExecutor(max_workers=current_app.config["ATTENDANCE_DETECTION_THREADS"],
+                                                     thread_name_prefix='detection')
+        return _detection_executor
+
+
+def start_attendance(class_obj, images, idempotency_key=None):
+    """
+    Create an attendance session for classroom photos and queue it for processing.
+
+    This is the shared entry point for form uploads and camera captures. A large
+    room can be covered by several photos, which become one session. Photos
+    submitted again for the same class within ATTENDANCE_DEDUP_WINDOW seconds,
+    identified by their content hash or by the client's idempotency key, return
+    the earlier session instead of storing and processing the photos again.
+
+    Args:
+        class_obj: Class the attendance is taken for
+        images: Bytes-like buffer holding the classroom photo (see utils.read_upload),
+                or a list of them
+        idempotency_key: Optional client-chosen key identifying the submission
+
+    Returns:
+        tuple: (session, created) - the new or earlier AttendanceSession (None if the
+               processing queue is full) and whether it was created by this call
+    """
+    if isinstance(images, (bytes, bytearray, memoryview)):
+        images = [images]
+
+    content_hash = hashlib.sha256()
+    for image_data in images:
+        content_hash.update(memoryview(image_data).nbytes.to_bytes(8, 'little'))
+        content_hash.update(image_data)
+
+    keys = [(class_obj.id, 'sha256', content_hash.hexdigest())]
+    if idempotency_key:
+        keys.append((class_obj.id, 'key', idempotency_key))
+
+    while True:
+        # Only the in-memory lookup and reservation hold the lock, so two simultaneous
+        # resubmissions cannot both miss, yet no submission waits on another's database commit
+        with _submissions_lock:
+            submission = _find_submission(keys)
+            if submission is None:
+                reservation = _reserve_submission(keys)
+                break
+
+        # An identical submission is (or was) creating its session; wait until it is committed
+        submission.ready.wait(SUBMISSION_WAIT_TIMEOUT)
+        existing_session = db.session.get(AttendanceSession, submission.session_id) if submission.session_id else None
+
+        # A failed session is retried rather than returned
+        if existing_session is not None and existing_session.status != 'failed':
+            logger.info(f"Duplicate attendance submission for class {class_obj.id}, reusing session {existing_session.id}")
+            return existing_session, False
+
+        with _submissions_lock:
+            _forget_submission(keys, submission)
+
+    filename = generate_filename(f"class_{class_obj.id}", "jpg")
+
+    new_session = AttendanceSession(
+        class_id=class_obj.id,
+        session_date=date.today(),
+        start_time=datetime.utcnow().time(),
+        status='processing'
+    )
+
+    try:
+        db.session.add(new_session)
+        db.session.commit()
+        reservation.session_id = new_session.id
+    except Exception:
+        with _submissions_lock:
+            _forget_submission(keys, reservation)
+        raise
+    finally:
+        # Waiting resubmissions go on, to this session or to creating their own
+        reservation.ready.set()
+
+    if not submit_attendance(new_session.id, images, filename):
+        new_session.status = 'failed'
+        db.session.commit()
+        return None, True
+
+    return new_session, True
+
+
+def _find_submission(keys):
+    """Return the recent _Submission matching any of keys, or None; caller holds _submissions_lock"""
+    cutoff = time.monotonic() - current_app.config["ATTENDANCE_DEDUP_WINDOW"]
+
+    for key in keys:
+        submission = _submissions.get(key)
+        if submission is None:
+            continue
+        if submission.submitted_at < cutoff:
+            del _submissions[key]
+            continue
+        return submission
+
+    return None
+
+
+def _reserve_submission(keys):
+    """Record a new submission under keys before its session exists; caller holds _submissions_lock"""
+    submission = _Submission()
+    for key in keys:
+        _submissions[key] = submission
+        _submissions.move_to_end(key)
+
+    while len(_submissions) > current_app.config["ATTENDANCE_DEDUP_CACHE_SIZE"]:
+        _submissions.popitem(last=False)
+    return submission
+
+
+def _forget_submission(keys, submission):
+    """Drop the keys still pointing at submission; caller holds _submissions_lock"""
+    for key in keys:
+        if _submissions.get(key) is submission:
+            del _submissions[key]
+
+
+def submit_attendance(session_id, images, filename):
+    """
+    Queue classroom photos for background attendance processing.
+
+    Args:
+        session_id: ID of an AttendanceSession in 'processing' state
+        images: List of bytes-like buffers holding the classroom photos (see utils.read_upload)
+        filename: Secure filename used for the stored photos
+
+    Returns:
+        bool: True if the photos were queued (or processed inline), False if the queue is full
+    """
+    # With no workers configured, process inline (useful for debugging and tests)
+    if not current_app.config["ATTENDANCE_WORKERS"]:
+        process_attendance(session_id, images, filename)
+        return True
+
+    executor = _get_executor()
+    if not _pending.acquire(blocking=False):
+        logger.warning(f"Attendance queue full, rejecting session {session_id}")
+        return False
+
+    queued_at = time.perf_counter()
+    # The worker threads are shared by every app in the process; each job runs in the app that queued it
+    app = current_app._get_current_object()
+
+    def run():
+        try:
+            STAGE_DURATION.observe(time.perf_counter() - queued_at, 'queue')
+            with app.app_context():
+                process_attendance(session_id, images, filename)
+        finally:
+            _pending.release()
+
+    executor.submit(run)
+    return True
+
+
+def expire_stale_session(attendance_session):
+    """
+    Mark a session failed if it has been 'processing' for longer than ATTENDANCE_PROCESSING_TIMEOUT.
+
+    Queued photos only live in memory, so the session of a photo lost in a
+    worker restart would otherwise stay 'processing' forever.
+
+    Args:
+        attendance_session: AttendanceSession to check
+
+    Returns:
+        bool: True if the session was marked failed
+    """
+    if attendance_session.status != 'processing' or attendance_session.created_at is None:
+        return False
+
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config["ATTENDANCE_PROCESSING_TIMEOUT"])
+    if attendance_session.created_at >= cutoff:
+        return False
+
+    logger.warning(f"Attendance session {attendance_session.id} was still processing after "
+                   f"{current_app.config['ATTENDANCE_PROCESSING_TIMEOUT']} seconds, marking it failed")
+    attendance_session.status = 'failed'
+    attendance_session.end_time = datetime.utcnow().time()
+    db.session.commit()
+    ATTENDANCE_SESSIONS.inc('failed')
+    return True
+
+
+def process_attendance(session_id, images, filename):
+    """
+    Store the photos, detect, store and match faces, and record attendance for a session.
+
+    Faces are detected in all photos concurrently while the photos are stored,
+    so a multi-photo session takes about as long as its slowest photo. People
+    seen in more than one photo are merged before matching.
+
+    The session ends up 'completed' (even if no student or face was found) or
+    'failed' if anything goes wrong.
+
+    Args:
+        session_id: ID of the AttendanceSession to process
+        images: List of bytes-like buffers holding the classroom photos (see utils.read_upload)
+        filename: Secure filename used for the stored photos
+
+    Returns:
+        int: Number of students marked present
+    """
+    attendance_session = db.session.get(AttendanceSession, session_id)
+
+    try:
+        # 1. Detect faces in every photo on the detection pool while uploading them from here;
+        # the pool's threads have no app context, so the app's backend is selected from this one
+        get_recognition_backend()
+        detection_executor = _get_detection_executor()
+        detection_futures = [detection_executor.submit(detect_faces_in_image, image_data) for image_data in images]
+
+        paths = [_photo_path(attendance_session.id, filename, position) for position in range(len(images))]
+        with stage_timer('upload'):
+            uploads = upload_files({path: (image_data, 'image/jpeg') for path, image_data in zip(paths, images)})
+
+        for path in paths:
+            success, message = uploads[path]
+            if not success:
+                raise RuntimeError(f"S3 upload error: {message}")
+
+        attendance_session.image_path = paths[0]
+        for position, path in enumerate(paths):
+            db.session.add(SessionPhoto(session_id=attendance_session.id, position=position, image_path=path))
+
+        # 2. Keep every detected face, with the photo it was found in, for later re-matching
+        face_locations = []
+        face_encodings = []
+        photo_indices = []
+
+        # Time left waiting for detection once the uploads are done
+        with stage_timer('detection_wait'):
+            for position, future in enumerate(detection_futures):
+                locations, encodings = future.result()
+                face_locations.extend(locations)
+                face_encodings.extend(encodings)
+                photo_indices.extend([position] * len(locations))
+
+        detections = SessionDetections(session_id=attendance_session.id)
+        detections.set_detections(face_locations, face_encodings, photo_indices)
+        db.session.add(detections)
+
+        # 3. Match the students of the class against the stored (float32) encodings,
+        #    exactly as a later re-match will
+        with stage_timer('match'):
+            _, stored_encodings, stored_photos = detections.get_detections()
+            statuses, confidences = match_students(attendance_session.class_id,
+                                                   merge_session_faces(stored_encodings, stored_photos))
+
+        with stage_timer('commit'):
+            record_attendance(attendance_session, statuses, confidences)
+            db.session.commit()
+        ATTENDANCE_SESSIONS.inc('completed')
+
+        # Display sizes are ready before anyone opens the session; failures only mean lazy generation
+        with stage_timer('derivatives'):
+            for path in paths:
+                generate_derivatives(path)
+
+        return sum(1 for status in statuses.values() if status == 'present')
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error processing attendance session {session_id}: {str(e)}")
+        ATTENDANCE_SESSIONS.inc('failed')
+
+        attendance_session = db.session.get(AttendanceSession, session_id)
+        attendance_session.status = 'failed'
+        attendance_session.end_time = datetime.utcnow().time()
+        db.session.commit()
+        return 0
+
+
+def record_attendance(attendance_session, statuses, confidences):
+    """
+    Add a session's attendance records, complete it and fold it into the rollups.
+
+    Runs in the caller's transaction; the caller commits. Recording a session
+    that is already completed (a retry) replaces its records and their share
+    of the rollups instead of adding them twice.
+
+    Args:
+        attendance_session: AttendanceSession being completed
+        statuses: Dict of Student.id -> 'present'/'absent'
+        confidences: Dict of Student.id -> match confidence
+    """
+    previous = {}
+    if attendance_session.status == 'completed':
+        previous = {student_id: status for student_id, status in
+                    db.session.query(AttendanceRecord.student_id, AttendanceRecord.status)
+                    .filter(AttendanceRecord.session_id == attendance_session.id)
+                    if student_id in statuses}
+
+    write_attendance_records(attendance_session.id, statuses, confidences)
+
+    if attendance_session.status == 'completed':
+        remove_session_from_rollups(attendance_session.class_id, attendance_session.session_date, previous)
+
+    attendance_session.status = 'completed'
+    attendance_session.end_time = datetime.utcnow().time()
+    add_session_to_rollups(attendance_session.class_id, attendance_session.session_date, statuses)
+
+
+def write_attendance_records(session_id, statuses, confidences):
+    """
+    Insert a session's attendance records in one batched statement.
+
+    A student who already has a record in the session gets it updated instead
+    (upsert on the unique (session_id, student_id) index), so writing the
+    same records twice never creates duplicates. Runs in the caller's transaction.
+
+    Args:
+        session_id: ID of the AttendanceSession
+        statuses: Dict of Student.id -> attendance status
+        confidences: Dict of Student.id -> match confidence
+    """
+    if not statuses:
+        return
+
+    recorded_at = datetime.utcnow()
+    values = [{
+        'session_id': session_id,
+        'student_id': student_id,
+        'status': status,
+        'confidence': float(confidences[student_id]),
+        'recorded_at': recorded_at
+    } for student_id, status in statuses.items()]
+
+    upsert_insert = UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert_insert is not None:
+        stmt = upsert_insert(AttendanceRecord)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[AttendanceRecord.session_id, AttendanceRecord.student_id],
+            set_={'status': stmt.excluded.status, 'confidence': stmt.excluded.confidence}
+        )
+    else:
+        # Portable fallback: replace the students' existing records
+        db.session.execute(delete(AttendanceRecord)
+                           .where(AttendanceRecord.session_id == session_id,
+                                  AttendanceRecord.student_id.in_(list(statuses))))
+        stmt = insert(AttendanceRecord)
+
+    # A list of parameter sets is sent as multi-row INSERTs rather than one statement per row
+    db.session.execute(stmt, values)
+
+
+def _photo_path(session_id, filename, position):
+    """Storage path of a session photo; the first keeps the single-photo naming"""
+    if position == 0:
+        return f"classroom_photos/{session_id}_{filename}"
+    return f"classroom_photos/{session_id}_{position}_{filename}"
+
+
+def merge_session_faces(face_encodings, photo_indices):
+    """
+    Merge the faces of a session's photos so everyone seen in several photos counts once.
+
+    Args:
+        face_encodings: (faces, dimension) array of stored face encodings
+        photo_indices: (faces,) array giving the photo each face was found in
+
+    Returns:
+        numpy.ndarray: (people, dimension) float32 array of encodings to match against
+    """
+    photo_count = int(photo_indices.max()) + 1 if len(photo_indices) else 0
+    if photo_count <= 1:
+        return face_encodings
+
+    merged_encodings, _ = merge_photo_faces([face_encodings[photo_indices == position]
+                                             for position in range(photo_count)])
+    return merged_encodings
+
+
+def match_students(class_id, face_encodings):
+    """
+    Match the current students of a class against the faces found in a photo.
+
+    Args:
+        class_id: ID of the class
+        face_encodings: (faces, dimension) array of detected face encodings
+
+    Returns:
+        tuple: (statuses, confidences) - dicts of Student.id -> 'present'/'absent' and
+               Student.id -> confidence; both empty if there are no students or no faces
+    """
+    class_encodings = get_class_encodings(class_id)
+
+    if not len(class_encodings.student_ids):
+        logger.info(f"No students registered in class {class_id}")
+        return {}, {}
+    if not len(face_encodings):
+        logger.info(f"No faces detected for class {class_id}")
+        return {}, {}
+
+    # Match all student face encodings against the detected faces in one call
+    face_indices, match_confidences = match_faces(class_encodings.encodings, face_encodings)
+
+    matches = {
+        int(student_id): float(confidence)
+        for student_id, face_index, confidence in zip(class_encodings.encoded_ids, face_indices, match_confidences)
+        if face_index >= 0
+    }
+
+    student_ids = class_encodings.student_ids.tolist()
+    statuses = {student_id: 'present' if student_id in matches else 'absent' for student_id in student_ids}
+    confidences = {student_id: matches.get(student_id, 0) for student_id in student_ids}
+    return statuses, confidences
+
+
+def rematch_attendance(session_id):
+    """
+    Re-run matching for a completed session against the class's current roster.
+
+    The faces stored when the session was processed are matched again, so no
+    photo is downloaded, decoded or searched. Existing records are updated,
+    students enrolled since the session get new records, and the rollups are
+    adjusted by the difference.
+
+    Args:
+        session_id: ID of the AttendanceSession to re-match
+
+    Returns:
+        tuple: (success, message)
+    """
+    attendance_session = db.session.get(AttendanceSession, session_id)
+    if attendance_session is None or attendance_session.status != 'completed':
+        return False, "Only completed attendance sessions can be re-matched"
+
+    detections = db.session.get(SessionDetections, session_id)
+    if detections is None:
+        return False, "No stored face detections for this session; take attendance again"
+
+    try:
+        _, face_encodings, photo_indices = detections.get_detections()
+        statuses, confidences = match_students(attendance_session.class_id,
+                                               merge_session_faces(face_encodings, photo_indices))
+
+        old_statuses = dict(db.session.query(AttendanceRecord.student_id, AttendanceRecord.status)
+                            .filter(AttendanceRecord.session_id == session_id))
+
+        # Student.id -> old status, for records whose status changes
+        previous = {student_id: old_statuses[student_id] for student_id, status in statuses.items()
+                    if student_id in old_statuses and old_statuses[student_id] != status}
+        # Student.id -> new status, for changed and new records
+        updated = {student_id: status for student_id, status in statuses.items()
+                   if old_statuses.get(student_id) != status}
+
+        write_attendance_records(session_id, statuses, confidences)
+
+        # Swap the changed records in the rollups; the session itself is still counted once
+        remove_session_from_rollups(attendance_session.class_id, attendance_session.session_date, previous, session_count=0)
+        add_session_to_rollups(attendance_session.class_id, attendance_session.session_date, updated, session_count=0)
+
+        db.session.commit()
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error re-matching attendance session {session_id}: {str(e)}")
+        return False, "An error occurred while re-matching attendance"
+
+    present_count = sum(1 for status in statuses.values() if status == 'present')
+    logger.info(f"Re-matched attendance session {session_id}: {len(updated)} records changed")
+    return True, f"Re-matched {len(statuses)} students: {present_count} present, {len(updated)} records changed"
@@ -0,0 +1,136 @@
+import logging
+
+from sqlalchemy import case, func, insert, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import db
+from models import AttendanceSession, AttendanceRecord, ClassAttendanceRollup, StudentAttendanceRollup
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Dialects with INSERT ... ON CONFLICT, and the insert() that supports it
+UPSERT_INSERTS = {
+    'postgresql': postgresql_insert,
+    'sqlite': sqlite_insert,
+}
+
+
+def add_session_to_rollups(class_id, session_date, statuses, session_count=1):
+    """
+    Add a completed session's attendance to the rollup tables.
+
+    Runs in the caller's transaction, so the rollups commit together with the records.
+
+    Args:
+        class_id: ID of the session's class
+        session_date: Date of the session
+        statuses: Dict of Student.id -> attendance status recorded in the session
+        session_count: How many sessions this adds (0 when only the records changed)
+    """
+    _apply(class_id, session_date, statuses, session_count, 1)
+
+
+def remove_session_from_rollups(class_id, session_date, statuses, session_count=1):
+    """
+    Subtract a session's attendance from the rollup tables.
+
+    Args:
+        class_id: ID of the session's class
+        session_date: Date of the session
+        statuses: Dict of Student.id -> attendance status previously recorded
+        session_count: How many sessions this removes (0 when only the records change)
+    """
+    _apply(class_id, session_date, statuses, session_count, -1)
+
+
+def _apply(class_id, session_date, statuses, session_count, sign):
+    present_count = sum(1 for status in statuses.values() if status == 'present')
+
+    _increment(ClassAttendanceRollup,
+               [{'class_id': class_id, 'session_date': session_date}],
+               {'session_count': sign * session_count,
+                'present_count': sign * present_count,
+                'record_count': sign * len(statuses)})
+
+    if statuses:
+        _increment(StudentAttendanceRollup,
+                   [{'student_id': student_id, 'class_id': class_id} for student_id in statuses],
+                   [{'session_count': sign, 'present_count': sign * (status == 'present')}
+                    for status in statuses.values()])
+
+
+def _increment(model, keys, increments):
+    """Add to the counters of rollup rows, creating missing rows, in as few statements as possible"""
+    if isinstance(increments, dict):
+        increments = [increments] * len(keys)
+    columns = list(increments[0])
+
+    upsert_insert = UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert_insert is not None:
+        stmt = upsert_insert(model)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys[0]),
+            set_={column: getattr(model, column) + getattr(stmt.excluded, column) for column in columns}
+        )
+        # Sent as batched multi-row statements; compiling one huge VALUES clause is slow for big classes
+        db.session.execute(stmt, [dict(key, **values) for key, values in zip(keys, increments)])
+        return
+
+    # Portable fallback: update, then insert whatever did not exist yet
+    for key, values in zip(keys, increments):
+        result = db.session.execute(
+            update(model)
+            .where(*[getattr(model, name) == value for name, value in key.items()])
+            .values({column: getattr(model, column) + values[column] for column in columns})
+        )
+        if not result.rowcount:
+            db.session.execute(insert(model).values(dict(key, **values)))
+
+
+def rebuild_rollups():
+    """
+    Recompute both rollup tables from the raw attendance records.
+
+    Only completed sessions are counted. The caller commits.
+
+    Returns:
+        tuple: (class_rows, student_rows) - number of rollup rows written
+    """
+    db.session.execute(ClassAttendanceRollup.__table__.delete())
+    db.session.execute(StudentAttendanceRollup.__table__.delete())
+
+    is_present = case((AttendanceRecord.status == 'present', 1), else_=0)
+
+    class_totals = (
+        db.select(AttendanceSession.class_id,
+                  AttendanceSession.session_date,
+                  func.count(func.distinct(AttendanceSession.id)),
+                  func.coalesce(func.sum(is_present), 0),
+                  func.count(AttendanceRecord.id))
+        .outerjoin(AttendanceRecord, AttendanceRecord.session_id == AttendanceSession.id)
+        .where(AttendanceSession.status == 'completed')
+        .group_by(AttendanceSession.class_id, AttendanceSession.session_date)
+    )
+    class_rows = db.session.execute(
+        insert(ClassAttendanceRollup).from_select(
+            ['class_id', 'session_date', 'session_count', 'present_count', 'record_count'], class_totals)
+    ).rowcount
+
+    student_totals = (
+        db.select(AttendanceRecord.student_id,
+                  AttendanceSession.class_id,
+                  func.count(AttendanceRecord.id),
+                  func.coalesce(func.sum(is_present), 0))
+        .join(AttendanceSession, AttendanceRecord.session_id == AttendanceSession.id)
+        .where(AttendanceSession.status == 'completed')
+        .group_by(AttendanceRecord.student_id, AttendanceSession.class_id)
+    )
+    student_rows = db.session.execute(
+        insert(StudentAttendanceRollup).from_select(
+            ['student_id', 'class_id', 'session_count', 'present_count'], student_totals)
+    ).rowcount
+
+    logger.info(f"Rebuilt attendance rollups: {class_rows} class rows, {student_rows} student rows")
+    return class_rows, student_rows
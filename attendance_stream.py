@@ -0,0 +1,349 @@
+import io
+import time
+import logging
+import threading
+from datetime import datetime, date
+
+import numpy as np
+from PIL import Image
+from flask import current_app
+
+from app import db
+from models import AttendanceSession, SessionDetections, SessionPhoto
+from face_recognition_service import detect_faces_in_image, match_faces
+from encoding_cache import get_class_encodings
+from aws_service import upload_file_to_s3
+from utils import generate_filename
+from attendance_pipeline import record_attendance
+from image_derivatives import generate_derivatives
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Open streams: session_id -> FrameStream. They live in the memory of the process that
+# started them, so every request of a stream must reach that process (see routes.owned_stream)
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+class FrameStream:
+    """
+    Attendance evidence gathered over the frames of one camera stream or clip.
+
+    Every processed frame is matched one-to-one against the class, and a
+    student counts as present once matched in min_frames frames. The stream
+    is done as soon as every student with a face encoding is present, after
+    max_frames frames or when the time budget runs out.
+    """
+
+    def __init__(self, session_id, class_id, budget, min_frames, frame_interval, max_frames):
+        self.session_id = session_id
+        self.class_id = class_id
+        self.min_frames = min_frames
+        self.frame_interval = frame_interval
+        self.max_frames = max_frames
+        self.deadline = time.monotonic() + budget
+        self.lock = threading.Lock()
+        self.done = False
+
+        class_encodings = get_class_encodings(class_id)
+        self.student_ids = class_encodings.student_ids.tolist()
+        self.encoded_ids = class_encodings.encoded_ids.tolist()
+        self.known_encodings = class_encodings.encodings
+        self.hits = np.zeros(len(self.encoded_ids), dtype=np.int32)
+        self.best_confidences = np.zeros(len(self.encoded_ids), dtype=np.float32)
+
+        self.frames = 0
+        self.last_frame_at = None
+        self.face_locations = []
+        self.face_encodings = []
+        self.photo_indices = []
+
+        # The frame with the most faces is kept as the session photo
+        self.best_frame = None
+        self.best_frame_faces = -1
+
+    @property
+    def matched_count(self):
+        return int((self.hits >= self.min_frames).sum())
+
+    @property
+    def finished(self):
+        """Whether there is nothing more to gain from further frames"""
+        return (self.matched_count == len(self.encoded_ids)
+                or self.frames >= self.max_frames
+                or time.monotonic() >= self.deadline)
+
+    def add_frame(self, frame):
+        """
+        Detect and match the faces in one frame.
+
+        Frames arriving sooner than frame_interval after the last processed
+        one are skipped, so a fast client cannot make the server process
+        every frame.
+
+        Args:
+            frame: Bytes-like buffer or PIL image of the frame
+
+        Returns:
+            bool: True if the frame was processed, False if it was skipped
+        """
+        now = time.monotonic()
+        if self.last_frame_at is not None and now - self.last_frame_at < self.frame_interval:
+            return False
+        self.last_frame_at = now
+
+        face_locations, face_encodings = detect_faces_in_image(frame)
+
+        if face_locations:
+            face_indices, confidences = match_faces(self.known_encodings, face_encodings)
+            matched = face_indices >= 0
+            self.hits[matched] += 1
+            np.maximum(self.best_confidences, np.where(matched, confidences, 0), out=self.best_confidences)
+
+            self.face_locations.extend(face_locations)
+            self.face_encodings.extend(face_encodings)
+            self.photo_indices.extend([self.frames] * len(face_locations))
+
+        if len(face_locations) > self.best_frame_faces:
+            self.best_frame = frame
+            self.best_frame_faces = len(face_locations)
+
+        self.frames += 1
+        return True
+
+    def results(self):
+        """
+        Attendance from the evidence so far.
+
+        Returns:
+            tuple: (statuses, confidences) - dicts keyed by Student.id, both empty if no
+                   student is enrolled or no face was seen (as for a single photo)
+        """
+        if not self.student_ids or not self.face_encodings:
+            return {}, {}
+
+        present = {student_id: float(confidence)
+                   for student_id, hits, confidence in zip(self.encoded_ids, self.hits, self.best_confidences)
+                   if hits >= self.min_frames}
+
+        statuses = {student_id: 'present' if student_id in present else 'absent' for student_id in self.student_ids}
+        confidences = {student_id: present.get(student_id, 0) for student_id in self.student_ids}
+        return statuses, confidences
+
+    def progress(self):
+        return {
+            'session_id': self.session_id,
+            'done': self.done,
+            'frames': self.frames,
+            'matched_count': self.matched_count,
+            'total_count': len(self.encoded_ids),
+            'remaining_seconds': max(0, round(self.deadline - time.monotonic(), 1)),
+        }
+
+
+def start_stream(class_obj):
+    """
+    Create an attendance session that is filled from a stream of camera frames.
+
+    Args:
+        class_obj: Class the attendance is taken for
+
+    Returns:
+        FrameStream: The open stream; its session is 'processing' until the stream finishes
+    """
+    finish_expired_streams()
+
+    new_session = AttendanceSession(
+        class_id=class_obj.id,
+        session_date=date.today(),
+        start_time=datetime.utcnow().time(),
+        status='processing'
+    )
+
+    db.session.add(new_session)
+    db.session.commit()
+
+    stream = FrameStream(new_session.id, class_obj.id,
+                         budget=current_app.config["ATTENDANCE_STREAM_BUDGET"],
+                         min_frames=current_app.config["ATTENDANCE_STREAM_MIN_FRAMES"],
+                         frame_interval=current_app.config["ATTENDANCE_STREAM_FRAME_INTERVAL"],
+                         max_frames=current_app.config["ATTENDANCE_STREAM_MAX_FRAMES"])
+
+    with _streams_lock:
+        _streams[new_session.id] = stream
+
+    logger.info(f"Started attendance stream for session {new_session.id} ({len(stream.encoded_ids)} students)")
+    return stream
+
+
+def get_stream(session_id):
+    """Get an open stream, or None if it does not exist (or already finished)"""
+    finish_expired_streams()
+    with _streams_lock:
+        return _streams.get(session_id)
+
+
+def add_stream_frame(stream, frame):
+    """
+    Process one frame of a stream, finishing the stream once nothing more can be gained.
+
+    Args:
+        stream: FrameStream from start_stream
+        frame: Bytes-like buffer holding the frame (see utils.read_upload)
+
+    Returns:
+        dict: Progress of the stream, with 'processed' telling whether this frame was used
+    """
+    with stream.lock:
+        processed = False
+        if not stream.done:
+            try:
+                processed = stream.add_frame(frame)
+            except Exception:
+                _fail(stream)
+                raise
+            if stream.finished:
+                _finish(stream)
+
+        return dict(stream.progress(), processed=processed)
+
+
+def finish_stream(stream):
+    """
+    Finish a stream early (e.g. the teacher stopped the camera) and record attendance.
+
+    Args:
+        stream: FrameStream from start_stream
+
+    Returns:
+        dict: Final progress of the stream
+    """
+    with stream.lock:
+        if not stream.done:
+            _finish(stream)
+        return stream.progress()
+
+
+def process_clip(class_obj, clip_data):
+    """
+    Take attendance from a short clip, sampling frames until everyone is found.
+
+    Clips are multi-frame images (animated WebP, GIF or PNG, or MPO); frames
+    are sampled evenly so at most ATTENDANCE_STREAM_MAX_FRAMES are examined.
+
+    Args:
+        class_obj: Class the attendance is taken for
+        clip_data: Bytes-like buffer holding the clip
+
+    Returns:
+        dict: Final progress of the stream the clip was processed as
+    """
+    clip = Image.open(io.BytesIO(clip_data))
+    frame_count = getattr(clip, 'n_frames', 1)
+
+    stream = start_stream(class_obj)
+    stream.frame_interval = 0
+    step = max(1, -(-frame_count // stream.max_frames))
+
+    with stream.lock:
+        try:
+            for index in range(0, frame_count, step):
+                clip.seek(index)
+                stream.add_frame(clip.convert('RGB'))
+                if stream.finished:
+                    break
+        except Exception:
+            _fail(stream)
+            raise
+
+        _finish(stream)
+        logger.info(f"Processed {stream.frames} of {frame_count} clip frames for session {stream.session_id}")
+        return stream.progress()
+
+
+def _finish(stream):
+    """Store the best frame and detections, record attendance and close the stream; caller holds stream.lock"""
+    stream.done = True
+    with _streams_lock:
+        _streams.pop(stream.session_id, None)
+
+    attendance_session = db.session.get(AttendanceSession, stream.session_id)
+    image_path = None
+
+    try:
+        if stream.best_frame is not None:
+            frame = stream.best_frame
+            if isinstance(frame, Image.Image):
+                output = io.BytesIO()
+                frame.save(output, 'JPEG', quality=90)
+                frame = output.getbuffer()
+
+            image_path = f"classroom_photos/{stream.session_id}_{generate_filename(f'class_{stream.class_id}', 'jpg')}"
+            success, message = upload_file_to_s3(frame, image_path, content_type='image/jpeg')
+            if not success:
+                raise RuntimeError(f"S3 upload error: {message}")
+
+            attendance_session.image_path = image_path
+            db.session.add(SessionPhoto(session_id=stream.session_id, position=0, image_path=image_path))
+
+        # Faces of every frame are kept, so a re-match merges them like a multi-photo session
+        detections = SessionDetections(session_id=stream.session_id)
+        detections.set_detections(stream.face_locations, stream.face_encodings, stream.photo_indices)
+        db.session.add(detections)
+
+        statuses, confidences = stream.results()
+        record_attendance(attendance_session, statuses, confidences)
+        db.session.commit()
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error finishing attendance stream {stream.session_id}: {str(e)}")
+
+        attendance_session = db.session.get(AttendanceSession, stream.session_id)
+        attendance_session.status = 'failed'
+        attendance_session.end_time = datetime.utcnow().time()
+        db.session.commit()
+        return
+
+    if image_path:
+        generate_derivatives(image_path)
+
+    logger.info(f"Finished attendance stream {stream.session_id}: {stream.matched_count} of "
+                f"{len(stream.encoded_ids)} students after {stream.frames} frames")
+
+
+def _fail(stream):
+    """Close a stream that raised and mark its session failed; caller holds stream.lock"""
+    stream.done = True
+    with _streams_lock:
+        _streams.pop(stream.session_id, None)
+
+    db.session.rollback()
+    attendance_session = db.session.get(AttendanceSession, stream.session_id)
+    attendance_session.status = 'failed'
+    attendance_session.end_time = datetime.utcnow().time()
+    db.session.commit()
+    logger.error(f"Attendance stream {stream.session_id} failed after {stream.frames} frames")
+
+
+def finish_expired_streams():
+    """
+    Record attendance for streams whose time budget ran out, e.g. because the
+    client went away without finishing them.
+
+    Called whenever a stream or its session is looked up, so an abandoned
+    stream does not stay 'processing' until another stream is started.
+    Streams busy with a frame are left to that request, which finishes them.
+    """
+    now = time.monotonic()
+    with _streams_lock:
+        abandoned = [stream for stream in _streams.values() if now >= stream.deadline]
+
+    for stream in abandoned:
+        if stream.lock.acquire(blocking=False):
+            try:
+                if not stream.done:
+                    _finish(stream)
+            finally:
+                stream.lock.release()
@@ -1,114 +1,223 @@
-import os
-import logging
 import time
-from flask import current_app
+import logging
+import threading
+from collections import OrderedDict
+from storage import get_storage, as_file
+from metrics import register_cache
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# In-memory storage for mock S3 operations
-mock_s3_storage = {}
+class FileUrlCache:
+    """
+    Process-level LRU cache of generated file URLs.
+    
+    A URL is handed out again until less than half of its lifetime is left,
+    so every caller still gets at least expiration / 2 seconds of validity.
+    Entries are keyed by path and requested expiration, and evicted
+    least-recently-used first once more than max_paths paths are cached.
+    """
+    
+    def __init__(self, max_paths=4096):
+        self.max_paths = max_paths
+        self._entries = OrderedDict()  # path -> {expiration: (url, reuse_until)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, path, expiration, generate):
+        """
+        Get a URL for path, calling generate(path, expiration) on a miss.
+        
+        Args:
+            path: Path to object in the store
+            expiration: URL expiration time in seconds
+            generate: Function returning a new URL, or None if there is none
+            
+        Returns:
+            str: Cached or newly generated URL, or None
+        """
+        now = time.monotonic()
+        
+        with self._lock:
+            entry = self._entries.get(path, {}).get(expiration)
+            if entry is not None and now < entry[1]:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        
+        url = generate(path, expiration)
+        if url is None:
+            return None
+        
+        with self._lock:
+            self._entries.setdefault(path, {})[expiration] = (url, now + expiration / 2)
+            self._entries.move_to_end(path)
+            
+            while len(self._entries) > self.max_paths:
+                self._entries.popitem(last=False)
+        
+        return url
+    
+    def invalidate(self, path=None):
+        """
+        Drop the cached URLs of a path, or of every path if path is None.
+        
+        Args:
+            path: Path to object in the store (default: all paths)
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+    
+    def stats(self):
+        """Hit/miss counters and current size, e.g. for monitoring"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'paths': len(self._entries)}
 
-def upload_file_to_s3(file_obj, s3_path):
+# Shared cache for this process
+file_url_cache = FileUrlCache()
+register_cache('file_urls', file_url_cache)
+
+def upload_file_to_s3(file_obj, s3_path, content_type=None):
     """
-    Mock function to simulate uploading a file to S3.
+    Upload a file to the configured storage backend (local disk or S3).
     
     Args:
-        file_obj: File-like object to upload
-        s3_path: Path in S3 bucket (e.g., 'folder/filename.jpg')
-        
+        file_obj: File-like object or bytes-like buffer (e.g. from utils.read_upload) to upload
+        s3_path: Path in the store (e.g., 'folder/filename.jpg')
+        content_type: MIME type of the object (default: taken from file_obj if available)
+    
     Returns:
         tuple: (success, message) - boolean indicating success and informational message
     """
     try:
-        # Reset file pointer to beginning
-        file_obj.seek(0)
-        
-        # In a real implementation, we would upload to S3
-        # For this mock version, we'll just log the action
-        logger.info(f"Mock S3 upload: {s3_path}")
+        if content_type is None:
+            content_type = getattr(file_obj, 'content_type', None) or 'application/octet-stream'
         
-        # Store the filename in our mock storage
-        mock_s3_storage[s3_path] = {
-            'upload_time': time.time(),
-            'content_type': getattr(file_obj, 'content_type', 'application/octet-stream')
-        }
+        # Buffers are streamed through a reader instead of being copied
+        get_storage().put(s3_path, as_file(file_obj), content_type)
+        file_url_cache.invalidate(s3_path)
         
+        logger.info(f"Uploaded {s3_path}")
         return True, f"File uploaded to {s3_path}"
     
     except Exception as e:
-        logger.error(f"Error in mock S3 upload: {str(e)}")
+        logger.error(f"Error uploading {s3_path}: {str(e)}")
         return False, str(e)
 
+def upload_files(files, max_workers=8):
+    """
+    Upload several files concurrently.
+    
+    Args:
+        files: Dict of path -> (file-like object or bytes-like buffer, content type)
+        max_workers: Maximum number of concurrent uploads
+    
+    Returns:
+        dict: path -> (success, message), as returned by upload_file_to_s3
+    """
+    errors = get_storage().put_many(
+        ((path, as_file(file_obj), content_type) for path, (file_obj, content_type) in files.items()),
+        max_workers=max_workers
+    )
+    
+    results = {}
+    for path, error in errors.items():
+        file_url_cache.invalidate(path)
+        if error is None:
+            results[path] = (True, f"File uploaded to {path}")
+        else:
+            logger.error(f"Error uploading {path}: {str(error)}")
+            results[path] = (False, str(error))
+    
+    logger.info(f"Uploaded {sum(success for success, _ in results.values())} of {len(results)} files")
+    return results
+
 def get_file_url(s3_path, expiration=3600):
     """
-    Generate a mock URL for an S3 object.
+    Generate a temporary URL for a stored object.
+    
+    URLs are cached (see FileUrlCache), so repeated calls for the same file
+    return the same URL until half of its lifetime has passed.
     
     Args:
-        s3_path: Path to object in S3 bucket
+        s3_path: Path to object in the store
         expiration: URL expiration time in seconds (default: 1 hour)
-        
+    
     Returns:
-        str: Mock URL or None if error
+        str: URL or None if the file does not exist or on error
     """
     try:
-        # Check if the file exists in our mock storage
-        if s3_path not in mock_s3_storage:
-            logger.warning(f"File not found in mock S3: {s3_path}")
-            return None
-        
-        # In a real implementation, we would generate a presigned URL
-        # For this mock version, we'll return a placeholder URL
-        mock_url = f"https://mock-s3-bucket.example.com/{s3_path}?expiry={int(time.time()) + expiration}"
-        
-        return mock_url
+        url = file_url_cache.get(s3_path, expiration, get_storage().url)
+        if url is None:
+            logger.warning(f"File not found in storage: {s3_path}")
+        return url
     
     except Exception as e:
-        logger.error(f"Error generating mock URL: {str(e)}")
+        logger.error(f"Error generating URL for {s3_path}: {str(e)}")
+        return None
+
+def read_file(s3_path):
+    """
+    Read the contents of a stored object.
+    
+    Args:
+        s3_path: Path to object in the store
+    
+    Returns:
+        bytes: File contents, or None if the file does not exist or on error
+    """
+    try:
+        return get_storage().get(s3_path)
+    
+    except KeyError:
+        logger.warning(f"File not found in storage: {s3_path}")
+        return None
+    except Exception as e:
+        logger.error(f"Error reading {s3_path}: {str(e)}")
         return None
 
 def list_files(prefix=''):
     """
-    List files in mock S3 storage with given prefix.
+    List stored files with a given prefix.
     
     Args:
         prefix: Folder prefix to list (e.g., 'student_photos/')
-        
+    
     Returns:
-        list: List of file keys in the mock storage with the given prefix
+        list: Sorted list of file keys with the given prefix
     """
     try:
-        # Filter files by prefix
-        matching_files = [key for key in mock_s3_storage.keys() if key.startswith(prefix)]
-        
-        return matching_files
+        return get_storage().list(prefix)
     
     except Exception as e:
-        logger.error(f"Error listing mock S3 files: {str(e)}")
+        logger.error(f"Error listing files: {str(e)}")
         return []
 
 def delete_file(s3_path):
     """
-    Delete a file from mock S3 storage.
+    Delete a stored file.
     
     Args:
-        s3_path: Path to object in mock S3 storage
-        
+        s3_path: Path to object in the store
+    
     Returns:
         bool: True if successful, False otherwise
     """
     try:
-        # Check if the file exists in our mock storage
-        if s3_path not in mock_s3_storage:
-            logger.warning(f"File not found in mock S3: {s3_path}")
-            return False
+        file_url_cache.invalidate(s3_path)
         
-        # Remove the file from mock storage
-        del mock_s3_storage[s3_path]
+        if not get_storage().delete(s3_path):
+            logger.warning(f"File not found in storage: {s3_path}")
+            return False
         
-        logger.info(f"Successfully deleted mock S3 file: {s3_path}")
+        logger.info(f"Successfully deleted file: {s3_path}")
         return True
     
     except Exception as e:
-        logger.error(f"Error deleting mock S3 file: {str(e)}")
+        logger.error(f"Error deleting file: {str(e)}")
         return False
@@ -0,0 +1,94 @@
+"""
+Recall vs. latency of the IVF face index against brute-force search.
+
+Usage:
+    python benchmarks/ann_index_benchmark.py --students 50000 --queries 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from face_index import IVFFaceIndex  # noqa: E402
+
+
+def make_encodings(num_students, num_queries, dimension, rng):
+    """Clustered synthetic encodings plus noisy re-captures of random students"""
+    # Real face encodings are not uniform; students cluster loosely (age, lighting, ...)
+    centers = rng.normal(0, 0.12, size=(max(1, num_students // 250), dimension))
+    labels = rng.integers(0, len(centers), size=num_students)
+    encodings = (centers[labels] + rng.normal(0, 0.06, size=(num_students, dimension))).astype(np.float32)
+
+    truth = rng.choice(num_students, size=num_queries, replace=False)
+    queries = (encodings[truth] + rng.normal(0, 0.02, size=(num_queries, dimension))).astype(np.float32)
+    return encodings, queries
+
+
+def brute_force(encodings, queries):
+    norms = (encodings * encodings).sum(axis=1)
+    scores = norms[None, :] - 2.0 * (queries @ encodings.T)
+    return np.argmin(scores, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--students', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=30, help='Faces searched per call (one classroom photo)')
+    parser.add_argument('--dimension', type=int, default=128)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    encodings, queries = make_encodings(args.students, args.queries, args.dimension, rng)
+    student_ids = np.arange(args.students, dtype=np.int64)
+
+    start = time.perf_counter()
+    index = IVFFaceIndex.train(encodings, nlist=args.nlist, seed=args.seed)
+    index.add(student_ids, encodings)
+    build_seconds = time.perf_counter() - start
+
+    batches = [queries[start:start + args.batch] for start in range(0, len(queries), args.batch)]
+
+    start = time.perf_counter()
+    exact = np.concatenate([brute_force(encodings, batch) for batch in batches])
+    brute_ms = (time.perf_counter() - start) * 1000 / args.queries
+
+    results = {
+        'students': args.students,
+        'queries': args.queries,
+        'batch': args.batch,
+        'nlist': index.nlist,
+        'build_seconds': round(build_seconds, 3),
+        'brute_force_ms_per_query': round(brute_ms, 4),
+        'runs': [],
+    }
+
+    print(f"{args.students} students, {index.nlist} buckets, built in {build_seconds:.2f}s")
+    print(f"brute force: {brute_ms:.3f} ms/query")
+    print(f"{'nprobe':>6} {'recall@1':>9} {'ms/query':>9} {'speedup':>8}")
+
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        found = np.concatenate([index.search(batch, nprobe=nprobe)[0] for batch in batches])
+        ivf_ms = (time.perf_counter() - start) * 1000 / args.queries
+        recall = float(np.mean(found == exact))
+
+        results['runs'].append({'nprobe': nprobe, 'recall_at_1': round(recall, 4), 'ms_per_query': round(ivf_ms, 4)})
+        print(f"{nprobe:>6} {recall:>9.3f} {ivf_ms:>9.3f} {brute_ms / ivf_ms:>7.1f}x")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
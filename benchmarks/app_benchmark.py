@@ -0,0 +1,200 @@
+"""
+End-to-end latency, query counts and memory of the main pages and of taking attendance.
+
+Drives the application through the Flask test client against a synthetic
+dataset (see the generate-synthetic-data command) with the synthetic
+recognition backend, so runs are repeatable and can be compared.
+
+Usage:
+    python benchmarks/app_benchmark.py --classes 50 --students 5000 --json results.json
+    python benchmarks/app_benchmark.py --database sqlite:///bench.db --requests 100
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decode_benchmark import peak_rss_kb  # noqa: E402
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 2)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(client, request, requests, warmup):
+    """Time requests made by request(i), then measure the Python allocation peak of one more"""
+    from query_stats import count_queries
+
+    for i in range(warmup):
+        request(i)
+
+    timings = []
+    queries = []
+    sql_ms = []
+    for i in range(warmup, warmup + requests):
+        with count_queries() as stats:
+            start = time.perf_counter()
+            response = request(i)
+            timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError(f"Request failed with status {response.status_code}")
+        queries.append(stats.count)
+        sql_ms.append(stats.duration * 1000)
+
+    # Tracing slows everything down, so it is kept out of the timed requests
+    tracemalloc.start()
+    request(warmup + requests)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'requests': requests,
+        'p50_ms': percentile(timings, 50),
+        'p95_ms': percentile(timings, 95),
+        'mean_ms': round(float(np.mean(timings)), 2),
+        'max_ms': round(max(timings), 2),
+        'queries_p50': int(np.median(queries)),
+        'queries_max': max(queries),
+        'sql_ms_p50': percentile(sql_ms, 50),
+        'peak_alloc_mb': round(peak_bytes / 1024 / 1024, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='Database URL (default: a new SQLite database in a temporary directory)')
+    parser.add_argument('--teachers', type=int, default=5)
+    parser.add_argument('--classes', type=int, default=50)
+    parser.add_argument('--students', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--sessions-per-week', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=50, help='Timed requests per page')
+    parser.add_argument('--attendance-requests', type=int, default=10, help='Timed take_attendance submissions')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--photo-size', type=int, nargs=2, default=[1600, 1200], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sgis-benchmark-')
+    os.environ["DATABASE_URL"] = args.database or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    os.environ["STORAGE_ROOT"] = os.path.join(workdir, 'storage')
+    os.environ["FACE_INDEX_PATH"] = os.path.join(workdir, 'face_index.npz')
+    os.environ["RECOGNITION_BACKEND"] = 'synthetic'
+    os.environ["RECOGNITION_SEED"] = str(args.seed)
+    # Process photos inside the request so take_attendance is measured end to end
+    os.environ["ATTENDANCE_WORKERS"] = '0'
+
+    from app import create_app, db
+    from models import User, Class, Student, AttendanceSession
+    from synthetic_data import (SYNTHETIC_USERNAME, SYNTHETIC_PASSWORD, generate_dataset,
+                                classroom_photo, student_identity)
+
+    # Per-request logging would dominate the timings
+    app = create_app({'TESTING': True})
+    logging.disable(logging.INFO)
+
+    with app.app_context():
+        db.create_all()
+        teacher = User.query.filter_by(username=SYNTHETIC_USERNAME.format(0)).first()
+        if teacher is None:
+            start = time.perf_counter()
+            dataset = generate_dataset(teachers=args.teachers, classes=args.classes, students=args.students,
+                                       days=args.days, sessions_per_week=args.sessions_per_week,
+                                       seed=args.seed, progress=lambda message: None)
+            dataset['generate_seconds'] = round(time.perf_counter() - start, 1)
+            teacher = User.query.filter_by(username=SYNTHETIC_USERNAME.format(0)).first()
+        else:
+            dataset = {'teachers': User.query.count(), 'classes': Class.query.count(),
+                       'students': Student.query.count(), 'sessions': AttendanceSession.query.count()}
+
+        # The teacher's largest class and its latest session
+        class_id = (db.session.query(Class.id)
+                    .join(Student)
+                    .filter(Class.teacher_id == teacher.id)
+                    .group_by(Class.id)
+                    .order_by(db.func.count(Student.id).desc())
+                    .limit(1)
+                    .scalar())
+        session_id = (db.session.query(AttendanceSession.id)
+                      .filter_by(class_id=class_id, status='completed')
+                      .order_by(AttendanceSession.session_date.desc())
+                      .limit(1)
+                      .scalar())
+        identities = [student_identity(student_id) for student_id, in
+                      db.session.query(Student.student_id).filter_by(class_id=class_id)]
+        database = db.engine.dialect.name
+
+    print(f"Dataset: {json.dumps(dataset)}")
+    print(f"Class {class_id}: {len(identities)} students, session {session_id}")
+
+    client = app.test_client()
+    client.post('/login', data={'username': teacher.username, 'password': SYNTHETIC_PASSWORD})
+
+    # Most of the class in every photo; a new photo each time so nothing is deduplicated
+    rng = np.random.default_rng(args.seed)
+    photo_count = args.warmup + args.attendance_requests + 1
+    photos = [classroom_photo(rng.choice(identities, int(len(identities) * 0.85), replace=False),
+                              *args.photo_size, seed=args.seed + i) for i in range(photo_count)]
+
+    def take_attendance(i):
+        return client.post('/attendance/take',
+                           data={'class_id': class_id, 'classroom_photo': (io.BytesIO(photos[i]), 'classroom.jpg')},
+                           headers={'Accept': 'application/json'})
+
+    scenarios = {
+        'dashboard': (lambda i: client.get('/dashboard'), args.requests),
+        'view_class': (lambda i: client.get(f'/classes/{class_id}'), args.requests),
+        'view_attendance': (lambda i: client.get(f'/attendance/session/{session_id}'), args.requests),
+        'attendance_reports': (lambda i: client.get(f'/attendance/reports?class_id={class_id}'), args.requests),
+        'take_attendance': (take_attendance, args.attendance_requests),
+    }
+
+    results = {
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'database': database,
+        'recognition_backend': 'synthetic',
+        'dataset': dataset,
+        'class_size': len(identities),
+        'scenarios': {},
+    }
+
+    print(f"{'scenario':<20} {'p50 ms':>8} {'p95 ms':>8} {'queries':>8} {'sql ms':>8} {'alloc MB':>9}")
+    for name, (request, requests) in scenarios.items():
+        result = run_scenario(client, request, requests, args.warmup)
+        results['scenarios'][name] = result
+        print(f"{name:<20} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['queries_p50']:>8} "
+              f"{result['sql_ms_p50']:>8.1f} {result['peak_alloc_mb']:>9.1f}")
+
+    results['peak_rss_mb'] = round(peak_rss_kb() / 1024, 1)
+    print(f"Peak RSS: {results['peak_rss_mb']} MB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
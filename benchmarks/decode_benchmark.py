@@ -0,0 +1,124 @@
+"""
+Full-size vs. reduced-resolution (JPEG draft) decoding of classroom photos.
+
+Every measurement runs in a fresh interpreter so peak RSS is not polluted by
+earlier runs.
+
+Usage:
+    python benchmarks/decode_benchmark.py --megapixels 2 5 8 12 20
+"""
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import resource
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_photo(path, megapixels, seed=0):
+    """Write a JPEG with photo-like content (smooth gradients plus sensor noise)"""
+    import numpy as np
+    from PIL import Image
+
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    rng = np.random.default_rng(seed)
+
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width * 200, y / height * 200, (x + y) / (width + height) * 255], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, size=base.shape), 0, 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, 'JPEG', quality=90)
+    return width, height
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB"""
+    # ru_maxrss survives fork+exec on Linux, so a child would report the parent's
+    # peak; VmHWM is reset when the interpreter is exec'd
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(mode, path, max_dimension, repeats):
+    """Runs inside the worker interpreter"""
+    from PIL import Image
+    from image_preprocessing import load_working_image
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    baseline_kb = peak_rss_kb()
+    timings = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        image = Image.open(io.BytesIO(data))
+        if mode == 'full':
+            image = image.convert('RGB')
+        else:
+            image = load_working_image(image, max_dimension).image
+        timings.append(time.perf_counter() - start)
+        size = image.size
+        del image
+
+    peak_kb = peak_rss_kb()
+    return {
+        'decode_ms': round(statistics.median(timings) * 1000, 2),
+        'rss_delta_mb': round((peak_kb - baseline_kb) / 1024, 1),
+        'decoded_size': list(size),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[2, 5, 8, 12, 20])
+    parser.add_argument('--max-dimension', type=int, default=1600)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--worker', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.worker[0], args.worker[1], args.max_dimension, args.repeats)))
+        return
+
+    results = []
+    print(f"{'MP':>5} {'size':>11} {'bytes':>8} {'full ms':>8} {'draft ms':>9} {'full MB':>8} {'draft MB':>9}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in args.megapixels:
+            path = os.path.join(directory, f'{megapixels}mp.jpg')
+            width, height = make_photo(path, megapixels)
+
+            run = {'megapixels': megapixels, 'size': [width, height], 'file_bytes': os.path.getsize(path)}
+            for mode in ('full', 'working'):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--worker', mode, path,
+                     '--max-dimension', str(args.max_dimension), '--repeats', str(args.repeats)],
+                    check=True, capture_output=True, text=True).stdout
+                run[mode] = json.loads(output)
+            results.append(run)
+
+            print(f"{megapixels:>5} {width:>5}x{height:<5} {run['file_bytes'] // 1024:>7}K "
+                  f"{run['full']['decode_ms']:>8} {run['working']['decode_ms']:>9} "
+                  f"{run['full']['rss_delta_mb']:>8} {run['working']['rss_delta_mb']:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'max_dimension': args.max_dimension, 'runs': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Time from process start to the first request served by web and background workers.
+
+Every run starts a fresh interpreter, the way gunicorn, the CLI and the
+bulk import pool do, and reports milestones in milliseconds since the
+process was launched:
+
+    web                 import app, create_app(), first page, first dashboard
+                        (logged in) and first attendance photo (processed inline)
+    attendance_worker   first attendance photo processed by the background pool
+    import_worker       first face encoded by a spawned bulk-import process
+                        (measured from creating the pool)
+
+The web run also records which recognition and image libraries were loaded
+when the first page was served.
+
+Usage:
+    python benchmarks/startup_benchmark.py --runs 10 --json startup.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decode_benchmark import make_photo, peak_rss_kb  # noqa: E402
+
+# Teacher the runs log in as, created by the parent process
+BENCHMARK_USERNAME = 'startup-benchmark'
+BENCHMARK_PASSWORD = 'startup-benchmark'
+
+# Loaded lazily by the app; reported for the first page served
+HEAVY_MODULES = ('numpy', 'PIL.Image', 'recognition_backends', 'face_recognition_service', 'boto3')
+
+ROLES = ('web', 'attendance_worker', 'import_worker')
+
+
+class Milestones:
+    """Milliseconds since the process was launched, by name"""
+
+    def __init__(self, launched):
+        self.launched = launched
+        self.values = {}
+
+    def mark(self, name):
+        self.values[name] = round((time.time() - self.launched) * 1000, 1)
+
+
+def check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.path} failed with status {response.status_code}")
+    return response
+
+
+def logged_in_client():
+    """Create the app and a test client logged in as the benchmark teacher"""
+    from app import create_app
+
+    app = create_app()
+    logging.disable(logging.INFO)
+    client = app.test_client()
+    check(client.post('/login', data={'username': BENCHMARK_USERNAME, 'password': BENCHMARK_PASSWORD}))
+    return client
+
+
+def run_web(milestones, photo, class_id):
+    from app import create_app
+    milestones.mark('import_app')
+
+    app = create_app()
+    milestones.mark('create_app')
+    logging.disable(logging.INFO)
+
+    client = app.test_client()
+    check(client.get('/login'))
+    milestones.mark('first_response')
+    loaded = {module: module in sys.modules for module in HEAVY_MODULES}
+    rss_mb = round(peak_rss_kb() / 1024, 1)
+
+    check(client.post('/login', data={'username': BENCHMARK_USERNAME, 'password': BENCHMARK_PASSWORD}))
+    check(client.get('/dashboard'))
+    milestones.mark('first_dashboard')
+
+    response = check(client.post(f'/api/capture_image?class_id={class_id}', data=photo, content_type='image/jpeg'))
+    if not response.get_json()['success']:
+        raise RuntimeError(response.get_json()['message'])
+    milestones.mark('first_attendance')
+
+    return {'loaded_at_first_response': loaded, 'peak_rss_at_first_response_mb': rss_mb}
+
+
+def run_attendance_worker(milestones, photo, class_id):
+    client = logged_in_client()
+    milestones.mark('ready')
+
+    response = check(client.post(f'/api/capture_image?class_id={class_id}', data=photo, content_type='image/jpeg'))
+    status_url = response.get_json()['status_url']
+    while check(client.get(status_url)).get_json()['status'] == 'processing':
+        time.sleep(0.002)
+    milestones.mark('first_job_done')
+    return {}
+
+
+def run_import_worker(milestones, photo, class_id):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # The same pool student_import creates for a bulk import
+    from face_recognition_service import encode_face_bytes
+    from recognition_backends import configure_recognition_backend
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=configure_recognition_backend, initargs=('mock', 0)) as pool:
+        pool.submit(encode_face_bytes, photo).result()
+        milestones.values['pool_first_result'] = round((time.perf_counter() - started) * 1000, 1)
+    return {}
+
+
+RUNNERS = {
+    'web': run_web,
+    'attendance_worker': run_attendance_worker,
+    'import_worker': run_import_worker,
+}
+
+
+def worker(role, photo_path, class_id, launched):
+    """Runs inside the fresh interpreter"""
+    with open(photo_path, 'rb') as f:
+        photo = f.read()
+
+    milestones = Milestones(launched)
+    result = RUNNERS[role](milestones, photo, class_id)
+    result['milestones_ms'] = milestones.values
+    result['peak_rss_mb'] = round(peak_rss_kb() / 1024, 1)
+    return result
+
+
+def prepare_database():
+    """Create the schema, a teacher and a class; returns the class ID"""
+    from app import create_app, db
+    from models import User, Class
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        teacher = User.query.filter_by(username=BENCHMARK_USERNAME).first()
+        if teacher is None:
+            teacher = User(username=BENCHMARK_USERNAME, email='startup-benchmark@example.com')
+            teacher.set_password(BENCHMARK_PASSWORD)
+            db.session.add(teacher)
+            db.session.flush()
+            db.session.add(Class(name='Startup benchmark', teacher_id=teacher.id))
+            db.session.commit()
+        return Class.query.filter_by(teacher_id=teacher.id).first().id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='Database URL (default: a new SQLite database in a temporary directory)')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes per role')
+    parser.add_argument('--roles', nargs='+', choices=ROLES, default=list(ROLES))
+    parser.add_argument('--megapixels', type=float, default=2, help='Size of the attendance photo')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--worker', nargs=4, metavar=('ROLE', 'PHOTO', 'CLASS_ID', 'LAUNCHED'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        role, photo_path, class_id, launched = args.worker
+        print(json.dumps(worker(role, photo_path, int(class_id), float(launched))))
+        return
+
+    workdir = tempfile.mkdtemp(prefix='sgis-startup-')
+    os.environ["DATABASE_URL"] = args.database or f"sqlite:///{os.path.join(workdir, 'startup.db')}"
+    os.environ["STORAGE_ROOT"] = os.path.join(workdir, 'storage')
+    os.environ["FACE_INDEX_PATH"] = os.path.join(workdir, 'face_index.npz')
+
+    photo_path = os.path.join(workdir, 'classroom.jpg')
+    make_photo(photo_path, args.megapixels)
+    class_id = prepare_database()
+
+    # Web workers process photos inside the request; the attendance worker run uses the background pool
+    environments = {
+        'web': dict(os.environ, ATTENDANCE_WORKERS='0'),
+        'attendance_worker': dict(os.environ, ATTENDANCE_WORKERS='2'),
+        'import_worker': dict(os.environ),
+    }
+
+    from app_benchmark import git_revision
+
+    results = {
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'roles': {},
+    }
+
+    print(f"{'role':<18} {'milestone':<18} {'median ms':>10} {'min ms':>8}")
+    for role in args.roles:
+        runs = []
+        for _ in range(args.runs):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--worker', role, photo_path, str(class_id), repr(time.time())],
+                check=True, capture_output=True, text=True, env=environments[role]).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        summary = {'milestones_ms': {}, 'peak_rss_mb': statistics.median(run['peak_rss_mb'] for run in runs)}
+        for milestone in runs[0]['milestones_ms']:
+            values = [run['milestones_ms'][milestone] for run in runs]
+            summary['milestones_ms'][milestone] = {'median': round(statistics.median(values), 1), 'min': min(values)}
+            print(f"{role:<18} {milestone:<18} {summary['milestones_ms'][milestone]['median']:>10.1f} {min(values):>8.1f}")
+        if 'loaded_at_first_response' in runs[0]:
+            summary['loaded_at_first_response'] = runs[0]['loaded_at_first_response']
+            summary['peak_rss_at_first_response_mb'] = statistics.median(
+                run['peak_rss_at_first_response_mb'] for run in runs)
+        results['roles'][role] = summary
+
+    if 'web' in results['roles']:
+        web = results['roles']['web']
+        loaded = [module for module, is_loaded in web['loaded_at_first_response'].items() if is_loaded]
+        print(f"Loaded at the first web response: {', '.join(loaded) or 'none of ' + ', '.join(HEAVY_MODULES)} "
+              f"(peak RSS {web['peak_rss_at_first_response_mb']} MB)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import json
+import logging
+
+import click
+from flask import Blueprint
+from sqlalchemy import delete, func, inspect, select, text
+
+from app import db
+from models import Student, AttendanceRecord
+from utils import pack_face_encoding
+from attendance_rollups import rebuild_rollups
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Commands import the recognition modules (NumPy, Pillow) they need when run,
+# so loading the CLI (and the app, which registers these commands) stays fast
+
+# Commands are registered at the top level: flask --app main init-db
+bp = Blueprint('commands', __name__, cli_group=None)
+
+
+@bp.cli.command('init-db')
+def init_db():
+    """Create the database tables that do not exist yet."""
+    # create_all() never alters existing tables; upgrades use the migrate-* commands
+    db.create_all()
+    click.echo(f'Created missing tables in {db.engine.url.render_as_string(hide_password=True)}')
+
+
+@bp.cli.command('migrate-face-encodings')
+@click.option('--chunk-size', default=500, show_default=True,
+              help='Number of students converted per transaction.')
+@click.option('--keep-json', is_flag=True,
+              help='Keep the legacy JSON column populated after conversion.')
+def migrate_face_encodings(chunk_size, keep_json):
+    """Convert JSON face encodings to the packed binary column."""
+    from encoding_cache import invalidate_class_encodings
+
+    # Older databases predate the binary column and init-db (db.create_all()) never alters tables
+    columns = {column['name'] for column in inspect(db.engine).get_columns(Student.__tablename__)}
+    if 'face_encoding_data' not in columns:
+        column_type = Student.__table__.c.face_encoding_data.type.compile(dialect=db.engine.dialect)
+        with db.engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE {Student.__tablename__} ADD COLUMN face_encoding_data {column_type}'))
+        click.echo('Added face_encoding_data column')
+
+    converted = 0
+    failed = 0
+    last_id = 0
+
+    # Walk the table by primary key in short transactions so no lock is held for long
+    while True:
+        rows = (db.session.query(Student.id, Student.face_encoding)
+                .filter(Student.id > last_id,
+                        Student.face_encoding.isnot(None),
+                        Student.face_encoding_data.is_(None))
+                .order_by(Student.id)
+                .limit(chunk_size)
+                .all())
+        if not rows:
+            break
+
+        updates = []
+        for student_id, face_encoding in rows:
+            try:
+                updates.append({
+                    'id': student_id,
+                    'face_encoding_data': pack_face_encoding(json.loads(face_encoding)),
+                    'face_encoding': face_encoding if keep_json else None,
+                })
+            except (ValueError, TypeError) as e:
+                logger.error(f"Could not convert face encoding of student {student_id}: {str(e)}")
+                failed += 1
+
+        if updates:
+            db.session.execute(db.update(Student), updates)
+        db.session.commit()
+
+        converted += len(updates)
+        last_id = rows[-1][0]
+        click.echo(f'Converted {converted} face encodings')
+
+    invalidate_class_encodings()
+    click.echo(f'Done: {converted} converted, {failed} failed')
+
+
+@bp.cli.command('build-face-index')
+@click.option('--nlist', type=int, default=None,
+              help='Number of index buckets (default: about sqrt of the number of students).')
+def build_face_index(nlist):
+    """Retrain and save the institution-wide face index."""
+    from face_index import get_face_index_store
+
+    index = get_face_index_store().build(nlist=nlist)
+    click.echo(f'Indexed {len(index)} face encodings in {index.nlist} buckets')
+
+
+@bp.cli.command('rebuild-attendance-rollups')
+def rebuild_attendance_rollups():
+    """Recompute the attendance rollup tables from the raw records."""
+    class_rows, student_rows = rebuild_rollups()
+    db.session.commit()
+    click.echo(f'Rebuilt {class_rows} class/day rows and {student_rows} student/class rows')
+
+
+@bp.cli.command('migrate-attendance-records')
+def migrate_attendance_records():
+    """Remove duplicate attendance records and add the unique (session, student) index."""
+    index, = [index for index in AttendanceRecord.__table__.indexes if index.name == 'uq_attendance_record_session_student']
+    if index.name in {existing['name'] for existing in inspect(db.engine).get_indexes(AttendanceRecord.__tablename__)}:
+        click.echo('Unique index already exists')
+        return
+
+    # Keep the most recent record of each student in each session
+    keep = (select(func.max(AttendanceRecord.id))
+            .group_by(AttendanceRecord.session_id, AttendanceRecord.student_id))
+    removed = db.session.execute(delete(AttendanceRecord).where(AttendanceRecord.id.not_in(keep))).rowcount
+    if removed:
+        # The duplicates were counted in the rollups too
+        rebuild_rollups()
+    db.session.commit()
+
+    index.create(db.engine)
+    click.echo(f'Removed {removed} duplicate records and added the unique index')
+
+
+@bp.cli.command('generate-synthetic-data')
+@click.option('--teachers', default=50, show_default=True)
+@click.option('--classes', default=500, show_default=True)
+@click.option('--students', default=50000, show_default=True)
+@click.option('--days', default=730, show_default=True, help='Days of attendance history.')
+@click.option('--sessions-per-week', default=2, show_default=True, help='Sessions per class per week (at most 5).')
+@click.option('--seed', default=0, show_default=True)
+def generate_synthetic_data(teachers, classes, students, days, sessions_per_week, seed):
+    """Fill an empty database with synthetic data for load tests and benchmarks."""
+    from synthetic_data import SYNTHETIC_PASSWORD, SYNTHETIC_USERNAME, generate_dataset
+
+    try:
+        counts = generate_dataset(teachers=teachers, classes=classes, students=students, days=days,
+                                  sessions_per_week=sessions_per_week, seed=seed, progress=click.echo)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(json.dumps(counts))
+    click.echo(f'Log in as {SYNTHETIC_USERNAME.format(0)} with password "{SYNTHETIC_PASSWORD}"')
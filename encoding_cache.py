@@ -0,0 +1,153 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from app import db
+from models import Student
+from utils import unpack_face_encodings
+from metrics import register_cache
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Face encodings of one class, ready to hand to match_faces
+#   student_ids: ids of every student in the class (int64)
+#   encoded_ids: ids of the students that have a face encoding (int64)
+#   encodings:   (len(encoded_ids), D) float32 matrix, row i belongs to encoded_ids[i]
+ClassEncodings = namedtuple('ClassEncodings', ['student_ids', 'encoded_ids', 'encodings'])
+
+
+class ClassEncodingCache:
+    """
+    Process-level LRU cache of per-class face encoding matrices.
+
+    Entries are evicted least-recently-used first once either the number of
+    cached classes or their total size exceeds the configured bounds. Entries
+    also expire after max_age seconds so that changes made by other worker
+    processes are eventually picked up.
+    """
+
+    def __init__(self, max_classes=256, max_bytes=64 * 1024 * 1024, max_age=300):
+        self.max_classes = max_classes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()  # class_id -> (loaded_at, ClassEncodings, nbytes)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, class_id):
+        """
+        Get the encodings of a class, loading them from the database on a miss.
+
+        Args:
+            class_id: ID of the class
+
+        Returns:
+            ClassEncodings: Cached encodings for the class
+        """
+        class_id = int(class_id)
+
+        with self._lock:
+            entry = self._entries.get(class_id)
+            if entry is not None and time.monotonic() - entry[0] <= self.max_age:
+                self._entries.move_to_end(class_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        encodings = load_class_encodings(class_id)
+        self._put(class_id, encodings)
+        return encodings
+
+    def invalidate(self, class_id=None):
+        """
+        Drop the cached encodings of a class, or of every class if class_id is None.
+
+        Args:
+            class_id: ID of the class to invalidate (default: all classes)
+        """
+        with self._lock:
+            if class_id is None:
+                self._entries.clear()
+                self._total_bytes = 0
+                return
+
+            entry = self._entries.pop(int(class_id), None)
+            if entry is not None:
+                self._total_bytes -= entry[2]
+
+    def _put(self, class_id, encodings):
+        nbytes = encodings.student_ids.nbytes + encodings.encoded_ids.nbytes + encodings.encodings.nbytes
+
+        with self._lock:
+            previous = self._entries.pop(class_id, None)
+            if previous is not None:
+                self._total_bytes -= previous[2]
+
+            self._entries[class_id] = (time.monotonic(), encodings, nbytes)
+            self._total_bytes += nbytes
+
+            # Evict least recently used classes, but always keep the one just loaded
+            while len(self._entries) > 1 and (len(self._entries) > self.max_classes
+                                              or self._total_bytes > self.max_bytes):
+                _, (_, _, evicted_bytes) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_bytes
+
+
+def load_class_encodings(class_id):
+    """
+    Load the face encodings of every student in a class from the database.
+
+    Args:
+        class_id: ID of the class
+
+    Returns:
+        ClassEncodings: Read-only id vectors and float32 encoding matrix
+    """
+    rows = (db.session.query(Student.id, Student.face_encoding_data, Student.face_encoding)
+            .filter(Student.class_id == class_id)
+            .order_by(Student.id)
+            .all())
+
+    student_ids = np.array([row[0] for row in rows], dtype=np.int64)
+
+    # Packed encodings decode in one go; rows not yet migrated fall back to JSON
+    packed_rows = [row for row in rows if row[1]]
+    legacy_rows = [row for row in rows if not row[1] and row[2]]
+
+    matrices = []
+    if packed_rows:
+        matrices.append(unpack_face_encodings([row[1] for row in packed_rows]))
+    if legacy_rows:
+        matrices.append(np.array([json.loads(row[2]) for row in legacy_rows], dtype=np.float32))
+
+    encoded_ids = np.array([row[0] for row in packed_rows + legacy_rows], dtype=np.int64)
+    encodings = np.vstack(matrices) if matrices else np.empty((0, 128), dtype=np.float32)
+
+    # Entries are shared between requests, so make sure nobody modifies them in place
+    for array in (student_ids, encoded_ids, encodings):
+        array.setflags(write=False)
+
+    logger.info(f"Loaded {len(encoded_ids)} face encodings for class {class_id}")
+    return ClassEncodings(student_ids, encoded_ids, encodings)
+
+
+# Shared cache for this process
+class_encoding_cache = ClassEncodingCache()
+register_cache('class_encodings', class_encoding_cache)
+
+
+def get_class_encodings(class_id):
+    """Get the cached face encodings of a class"""
+    return class_encoding_cache.get(class_id)
+
+
+def invalidate_class_encodings(class_id=None):
+    """Invalidate the cached face encodings of a class (or of all classes)"""
+    class_encoding_cache.invalidate(class_id)
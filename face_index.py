@@ -0,0 +1,417 @@
+import os
+import json
+import struct
+import logging
+import threading
+
+import numpy as np
+from flask import current_app
+
+from app import db
+from models import Student
+from utils import (pack_face_encoding, unpack_face_encoding, unpack_face_encodings,
+                   create_folder_if_not_exists, FACE_ENCODING_HEADER, FACE_ENCODING_DTYPE)
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Update log record: little-endian int64 student id followed by a packed face encoding
+LOG_RECORD_ID = struct.Struct('<q')
+
+
+class _InvertedList:
+    """Growable (ids, vectors) store for the encodings assigned to one centroid"""
+
+    def __init__(self, dimension, capacity=16):
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.vectors = np.empty((capacity, dimension), dtype=np.float32)
+        self.norms = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+
+    def extend(self, ids, vectors):
+        required = self.size + len(ids)
+        if required > len(self.ids):
+            capacity = max(required, 2 * len(self.ids))
+            self.ids = np.resize(self.ids, capacity)
+            self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+            self.norms = np.resize(self.norms, capacity)
+        self.ids[self.size:required] = ids
+        self.vectors[self.size:required] = vectors
+        self.norms[self.size:required] = (self.vectors[self.size:required] ** 2).sum(axis=1)
+        self.size = required
+
+    def remove(self, student_id):
+        positions = np.flatnonzero(self.ids[:self.size] == student_id)
+        if not len(positions):
+            return
+        # Swap the last entry into the hole
+        position = positions[0]
+        self.size -= 1
+        self.ids[position] = self.ids[self.size]
+        self.vectors[position] = self.vectors[self.size]
+        self.norms[position] = self.norms[self.size]
+
+
+class IVFFaceIndex:
+    """
+    Inverted-file approximate nearest-neighbour index over face encodings.
+
+    Encodings are bucketed by their nearest k-means centroid. A query only
+    scans the buckets of its nprobe nearest centroids, so its cost grows with
+    nprobe * (N / nlist) instead of N.
+    """
+
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self._centroid_norms = (self.centroids * self.centroids).sum(axis=1)
+        self._lists = [_InvertedList(self.dimension) for _ in range(len(self.centroids))]
+        self._assignments = {}  # student_id -> list number
+        self.log_offset = 0
+
+    @property
+    def dimension(self):
+        return self.centroids.shape[1]
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self._assignments)
+
+    @classmethod
+    def train(cls, encodings, nlist=None, iterations=15, sample_size=None, seed=0):
+        """
+        Learn the coarse quantizer with k-means.
+
+        Args:
+            encodings: (N, D) array of training encodings
+            nlist: Number of buckets (default: about sqrt(N))
+            iterations: Number of k-means iterations
+            sample_size: Maximum number of encodings used for training (default: 64 per bucket)
+            seed: Random seed for the initial centroids and sampling
+
+        Returns:
+            IVFFaceIndex: Empty index with trained centroids
+        """
+        encodings = np.asarray(encodings, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        if nlist is None:
+            nlist = int(np.sqrt(len(encodings)))
+        nlist = max(1, min(nlist, len(encodings)))
+
+        sample_size = sample_size or 64 * nlist
+        if len(encodings) > sample_size:
+            encodings = encodings[rng.choice(len(encodings), sample_size, replace=False)]
+
+        centroids = encodings[rng.choice(len(encodings), nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = _nearest_centroids(encodings, centroids, (centroids * centroids).sum(axis=1), 1)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, encodings)
+            counts = np.bincount(assignments, minlength=nlist)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+        return cls(centroids)
+
+    def add(self, student_ids, encodings):
+        """
+        Insert or replace the encodings of the given students.
+
+        Args:
+            student_ids: Sequence of Student.id values
+            encodings: (len(student_ids), D) array of encodings
+        """
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dimension)
+        if not len(encodings):
+            return
+
+        student_ids = np.asarray(student_ids, dtype=np.int64)
+
+        # If a student appears more than once, the last encoding wins
+        _, last_positions = np.unique(student_ids[::-1], return_index=True)
+        if len(last_positions) != len(student_ids):
+            keep = np.sort(len(student_ids) - 1 - last_positions)
+            student_ids, encodings = student_ids[keep], encodings[keep]
+
+        buckets = _nearest_centroids(encodings, self.centroids, self._centroid_norms, 1)[:, 0]
+
+        for student_id in student_ids.tolist():
+            previous = self._assignments.pop(student_id, None)
+            if previous is not None:
+                self._lists[previous].remove(student_id)
+
+        self._extend(student_ids, buckets, encodings)
+
+    def _extend(self, student_ids, buckets, encodings):
+        # Group by bucket so each inverted list grows once per call
+        order = np.argsort(buckets, kind='stable')
+        student_ids, buckets, encodings = student_ids[order], buckets[order], encodings[order]
+        boundaries = np.flatnonzero(np.diff(buckets)) + 1
+
+        for ids, bucket_run, vectors in zip(np.split(student_ids, boundaries),
+                                            np.split(buckets, boundaries),
+                                            np.split(encodings, boundaries)):
+            self._lists[int(bucket_run[0])].extend(ids, vectors)
+
+        self._assignments.update(zip(student_ids.tolist(), buckets.tolist()))
+
+    def search(self, encodings, nprobe=8, allowed_ids=None):
+        """
+        Find the closest indexed encoding for each query encoding.
+
+        Args:
+            encodings: (Q, D) array of query encodings
+            nprobe: Number of buckets scanned per query
+            allowed_ids: Optional array of student ids; only these are searched
+
+        Returns:
+            tuple: (student_ids, distances) - arrays of length Q, student id -1 and
+                   distance inf where nothing was found
+        """
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dimension)
+        student_ids = np.full(len(queries), -1, dtype=np.int64)
+        distances = np.full(len(queries), np.inf, dtype=np.float32)
+
+        if not len(queries) or not len(self):
+            return student_ids, distances
+
+        probes = _nearest_centroids(queries, self.centroids, self._centroid_norms, min(nprobe, self.nlist))
+        best_scores = np.full(len(queries), np.inf, dtype=np.float32)
+
+        # Scan bucket by bucket so every bucket is compared against all of its queries in one product
+        probe_buckets = probes.ravel()
+        probe_queries = np.repeat(np.arange(len(queries)), probes.shape[1])
+        order = np.argsort(probe_buckets, kind='stable')
+        probe_buckets, probe_queries = probe_buckets[order], probe_queries[order]
+        boundaries = np.flatnonzero(np.diff(probe_buckets)) + 1
+
+        for bucket_run, query_indices in zip(np.split(probe_buckets, boundaries), np.split(probe_queries, boundaries)):
+            inverted = self._lists[int(bucket_run[0])]
+            if not inverted.size:
+                continue
+
+            # |q - v|^2 without the |q|^2 term, which is constant per query
+            scores = inverted.norms[None, :inverted.size] - 2.0 * (queries[query_indices] @ inverted.vectors[:inverted.size].T)
+            if allowed_ids is not None:
+                scores[:, ~np.isin(inverted.ids[:inverted.size], allowed_ids)] = np.inf
+            best = np.argmin(scores, axis=1)
+            best_bucket_scores = scores[np.arange(len(query_indices)), best]
+
+            improved = best_bucket_scores < best_scores[query_indices]
+            best_scores[query_indices[improved]] = best_bucket_scores[improved]
+            student_ids[query_indices[improved]] = inverted.ids[best[improved]]
+
+        found = student_ids >= 0
+        squared = best_scores[found] + (queries[found] ** 2).sum(axis=1)
+        distances[found] = np.sqrt(np.maximum(squared, 0))
+        return student_ids, distances
+
+    def save(self, path):
+        """Atomically write the index to an .npz file"""
+        ids = [inverted.ids[:inverted.size] for inverted in self._lists]
+        vectors = [inverted.vectors[:inverted.size] for inverted in self._lists]
+        buckets = [np.full(inverted.size, bucket, dtype=np.int64) for bucket, inverted in enumerate(self._lists)]
+
+        temp_path = f"{path}.tmp.{os.getpid()}"
+        with open(temp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, ids=np.concatenate(ids), buckets=np.concatenate(buckets),
+                     vectors=np.concatenate(vectors), log_offset=np.array(self.log_offset, dtype=np.int64))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save()"""
+        with np.load(path) as data:
+            index = cls(data['centroids'])
+            index.log_offset = int(data['log_offset'])
+            if len(data['ids']):
+                index._extend(data['ids'], data['buckets'], data['vectors'])
+        return index
+
+
+def _nearest_centroids(vectors, centroids, centroid_norms, count):
+    """Return the indices of the `count` nearest centroids of each vector"""
+    # |v|^2 is the same for every centroid of a row, so it does not affect the ranking
+    scores = centroid_norms[None, :] - 2.0 * (vectors @ centroids.T)
+    if count == 1:
+        return np.argmin(scores, axis=1)[:, None]
+    nearest = np.argpartition(scores, count - 1, axis=1)[:, :count]
+    return nearest
+
+
+class FaceIndexStore:
+    """
+    Persistent institution-wide face index.
+
+    The trained index is kept in an .npz snapshot. Registrations are appended
+    to a small update log next to it, which every process replays before
+    searching, so all workers see new students without reloading the snapshot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = f"{path}.log"
+        self.record_size = LOG_RECORD_ID.size + FACE_ENCODING_HEADER.size
+        self._index = None
+        self._lock = threading.RLock()
+
+    def get(self):
+        """Get the index, loading or building it on first use and applying pending updates"""
+        with self._lock:
+            if self._index is None:
+                if os.path.exists(self.path):
+                    self._index = IVFFaceIndex.load(self.path)
+                    logger.info(f"Loaded face index with {len(self._index)} encodings from {self.path}")
+                else:
+                    self._index = self.build()
+            self._replay_log()
+            return self._index
+
+    def build(self, nlist=None):
+        """
+        Train a fresh index over every stored Student encoding and save it.
+
+        Args:
+            nlist: Number of buckets (default: about sqrt(N))
+
+        Returns:
+            IVFFaceIndex: The new index
+        """
+        # Anything logged after this offset may be missing from the query below, so it gets replayed
+        log_offset = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        student_ids, encodings = load_all_encodings()
+
+        if len(encodings):
+            index = IVFFaceIndex.train(encodings, nlist=nlist)
+            index.add(student_ids, encodings)
+        else:
+            index = IVFFaceIndex(np.zeros((1, 128), dtype=np.float32))
+        index.log_offset = log_offset
+
+        create_folder_if_not_exists(os.path.dirname(os.path.abspath(self.path)))
+        index.save(self.path)
+        logger.info(f"Built face index with {len(index)} encodings in {index.nlist} buckets")
+
+        with self._lock:
+            self._index = index
+        return index
+
+    def add(self, student_id, encoding):
+        """Record a new or changed Student encoding"""
+        self.add_many([student_id], [encoding])
+
+    def add_many(self, student_ids, encodings):
+        """Record several new or changed Student encodings"""
+        create_folder_if_not_exists(os.path.dirname(os.path.abspath(self.path)))
+        records = b''.join(LOG_RECORD_ID.pack(student_id) + pack_face_encoding(encoding)
+                           for student_id, encoding in zip(student_ids, encodings))
+
+        # A single append-mode write, so concurrent writers never interleave records
+        with open(self.log_path, 'ab') as f:
+            f.write(records)
+
+    def _replay_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        if os.path.getsize(self.log_path) <= self._index.log_offset:
+            return
+
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._index.log_offset)
+            data = f.read()
+
+        record_size = self.record_size + self._index.dimension * np.dtype(FACE_ENCODING_DTYPE).itemsize
+        complete = len(data) - len(data) % record_size
+        student_ids = []
+        encodings = []
+
+        for offset in range(0, complete, record_size):
+            student_ids.append(LOG_RECORD_ID.unpack_from(data, offset)[0])
+            encodings.append(unpack_face_encoding(data[offset + LOG_RECORD_ID.size:offset + record_size]))
+
+        if student_ids:
+            self._index.add(student_ids, np.vstack(encodings))
+        self._index.log_offset += complete
+
+
+def load_all_encodings(chunk_size=5000):
+    """
+    Load every stored Student encoding.
+
+    Args:
+        chunk_size: Number of rows fetched per round trip
+
+    Returns:
+        tuple: (student_ids, encodings) - int64 array and (N, D) float32 matrix
+    """
+    query = (db.session.query(Student.id, Student.face_encoding_data, Student.face_encoding)
+             .filter((Student.face_encoding_data.isnot(None)) | (Student.face_encoding.isnot(None)))
+             .order_by(Student.id)
+             .execution_options(yield_per=chunk_size))
+
+    packed = []
+    legacy = []
+    for student_id, face_encoding_data, face_encoding in query:
+        if face_encoding_data:
+            packed.append((student_id, face_encoding_data))
+        else:
+            legacy.append((student_id, face_encoding))
+
+    matrices = []
+    if packed:
+        matrices.append(unpack_face_encodings([data for _, data in packed]))
+    if legacy:
+        matrices.append(np.array([json.loads(data) for _, data in legacy], dtype=np.float32))
+
+    student_ids = np.array([student_id for student_id, _ in packed + legacy], dtype=np.int64)
+    encodings = np.vstack(matrices) if matrices else np.empty((0, 128), dtype=np.float32)
+    return student_ids, encodings
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_face_index_store():
+    """Get the face index store configured for the current app"""
+    path = current_app.config["FACE_INDEX_PATH"]
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = FaceIndexStore(path)
+        return _stores[path]
+
+
+def identify_faces(face_encodings, tolerance=0.6, nprobe=8, allowed_ids=None):
+    """
+    Identify detected faces against the registered students.
+
+    Each student is assigned to at most one face (the closest one).
+
+    Args:
+        face_encodings: List of encodings from detect_faces_in_image
+        tolerance: Maximum distance for a match
+        nprobe: Number of index buckets scanned per face
+        allowed_ids: Optional sequence of Student.id to search; None searches every student
+
+    Returns:
+        list: (student_id, confidence) per face, student_id None if unknown
+    """
+    if allowed_ids is not None:
+        allowed_ids = np.asarray(allowed_ids, dtype=np.int64)
+    student_ids, distances = get_face_index_store().get().search(face_encodings, nprobe=nprobe, allowed_ids=allowed_ids)
+
+    best_face = {}
+    for face_index, (student_id, distance) in enumerate(zip(student_ids.tolist(), distances.tolist())):
+        if student_id < 0 or distance > tolerance:
+            continue
+        if student_id not in best_face or distance < distances[best_face[student_id]]:
+            best_face[student_id] = face_index
+
+    results = [(None, 0.0)] * len(student_ids)
+    for student_id, face_index in best_face.items():
+        results[face_index] = (student_id, 1.0 - float(distances[face_index]))
+    return results
@@ -1,86 +1,119 @@
 import logging
-import random
 import numpy as np
-from io import BytesIO
 from PIL import Image
 from werkzeug.datastructures import FileStorage
+from utils import BufferReader
+from image_preprocessing import load_working_image, scale_face_locations
+from recognition_backends import get_recognition_backend
+from metrics import stage_timer
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Working resolutions: images are decoded at most this large (longest side, in pixels)
+DETECTION_MAX_DIMENSION = 1600
+ENCODING_MAX_DIMENSION = 640
+
+# Number of pyramid levels searched by detect_faces_in_image (1 = single scale)
+DETECTION_PYRAMID_LEVELS = 1
+
+def open_image(file):
+    """
+    Open an image without copying the upload it comes from.
+    
+    Args:
+        file: A FileStorage object, file-like object, bytes-like buffer (e.g. from utils.read_upload)
+              or an already decoded PIL image (e.g. a video frame)
+        
+    Returns:
+        PIL.Image.Image: The lazily decoded image
+    """
+    if isinstance(file, Image.Image):
+        return file
+    
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        return Image.open(BufferReader(file))
+    
+    if isinstance(file, FileStorage):
+        # Reset file pointer to beginning and read straight from the upload stream
+        file.seek(0)
+        return Image.open(file.stream)
+    
+    return Image.open(file)
+
 def encode_face_image(file):
     """
     Encode a face in an image.
     
     Args:
-        file: A FileStorage object or file-like object containing the image
+        file: A FileStorage object, file-like object or bytes-like buffer containing the image
         
     Returns:
-        list: Mock face encoding if a face was found, None otherwise
+        list: Face encoding if a face was found, None otherwise
     """
     try:
-        # Read image file to verify it's a valid image
-        if isinstance(file, FileStorage):
-            # Reset file pointer to beginning
-            file.seek(0)
-            image_data = file.read()
-            image = Image.open(BytesIO(image_data))
-        else:
-            image = Image.open(file)
-            
-        # For demo purposes, generate a random encoding vector
-        # Real face_recognition would generate a 128-dimensional encoding
-        encoding = [random.uniform(-1, 1) for _ in range(128)]
+        # Decode at a reduced resolution; a face crop never needs the full photo
+        working = load_working_image(open_image(file), ENCODING_MAX_DIMENSION)
+        
+        encodings = get_recognition_backend().encode(working.image)
+        if len(encodings) == 0:
+            return None
         
-        logger.info("Generated mock face encoding")
-        return encoding
+        logger.info("Generated face encoding")
+        return encodings[0].tolist()
     
     except Exception as e:
         logger.error(f"Error encoding face: {str(e)}")
         return None
 
-def detect_faces_in_image(file):
+def encode_face_bytes(image_data):
+    """
+    Encode a face in an in-memory image.
+    
+    A module-level wrapper around encode_face_image so it can be sent to worker processes.
+    
+    Args:
+        image_data: Raw bytes of the image
+        
+    Returns:
+        list: Face encoding if a face was found, None otherwise
+    """
+    return encode_face_image(image_data)
+
+def detect_faces_in_image(file, pyramid_levels=None):
     """
     Detect all faces in a classroom image.
     
+    The image is decoded at DETECTION_MAX_DIMENSION and, with more than one
+    pyramid level, searched at several scales. Face locations are always
+    returned in the coordinates of the original image.
+    
     Args:
-        file: A FileStorage object or file-like object containing the image
+        file: A FileStorage object, file-like object or bytes-like buffer containing the image
+        pyramid_levels: Number of scales to search (default: DETECTION_PYRAMID_LEVELS)
         
     Returns:
-        tuple: (face_locations, face_encodings) - mock lists of face locations and encodings
+        tuple: (face_locations, face_encodings) - lists of face locations and encodings
     """
+    if pyramid_levels is None:
+        pyramid_levels = DETECTION_PYRAMID_LEVELS
+    
     try:
-        # Read image file to verify it's a valid image
-        if isinstance(file, FileStorage):
-            # Reset file pointer to beginning
-            file.seek(0)
-            image_data = file.read()
-            image = Image.open(BytesIO(image_data))
-        else:
-            image = Image.open(file)
-            
-        # For demo purposes, generate mock data
-        # Generate random number of detected faces (1-10)
-        num_faces = random.randint(5, 15)
-        
-        # Mock face locations (format: top, right, bottom, left)
-        face_locations = []
-        face_encodings = []
-        
-        for _ in range(num_faces):
-            # Generate random face locations
-            top = random.randint(0, 300)
-            right = random.randint(400, 600)
-            bottom = random.randint(top + 100, top + 200)
-            left = random.randint(100, right - 100)
-            
-            face_locations.append((top, right, bottom, left))
-            
-            # Generate random face encoding for each detected face
-            encoding = [random.uniform(-1, 1) for _ in range(128)]
-            face_encodings.append(encoding)
+        backend = get_recognition_backend()
         
-        logger.info(f"Generated {num_faces} mock face detections")
+        # Decode at working resolution instead of the full camera resolution
+        with stage_timer('decode'):
+            working = load_working_image(open_image(file), DETECTION_MAX_DIMENSION)
+        
+        # Face locations (format: top, right, bottom, left) in working image coordinates
+        with stage_timer('detect'):
+            face_locations = backend.detect(working.image, pyramid_levels)
+        with stage_timer('encode'):
+            face_encodings = list(backend.encode(working.image, face_locations)) if face_locations else []
+        
+        face_locations = scale_face_locations(face_locations, working.scale)
+        
+        logger.info(f"Detected {len(face_locations)} faces with the {backend.name} backend")
         return face_locations, face_encodings
     
     except Exception as e:
@@ -99,22 +132,89 @@ def compare_faces(known_face_encoding, face_encodings, tolerance=0.6):
     Returns:
         tuple: (is_present, confidence) - boolean indicating if student is present and confidence score
     """
+    face_indices, confidences = match_faces([known_face_encoding], face_encodings, tolerance)
+    return bool(face_indices[0] >= 0), float(confidences[0])
+
+def match_faces(known_face_encodings, face_encodings, tolerance=0.6):
+    """
+    Match every known face encoding against every detected face in one pass.
+    
+    Faces are assigned one-to-one by the configured backend's match_batch,
+    so a single detected face can never count for two students.
+    
+    Args:
+        known_face_encodings: Sequence or (N, D) array of registered student encodings
+        face_encodings: Sequence or (M, D) array of encodings from the classroom photo
+        tolerance: Maximum distance for two encodings to be considered a match
+        
+    Returns:
+        tuple: (face_indices, confidences) - for each known encoding, the index of the
+               matched detected face (-1 if unmatched) and the match confidence (0 if unmatched)
+    """
+    num_known = len(known_face_encodings)
+    
     try:
-        if not face_encodings:
-            return False, 0
+        face_indices, confidences = get_recognition_backend().match_batch(known_face_encodings, face_encodings, tolerance)
         
-        # In mock implementation, use random comparison for demo
-        # Real implementation would calculate actual distances
+        logger.info(f"Matched {int((face_indices >= 0).sum())} of {num_known} students "
+                    f"against {len(face_encodings)} detected faces")
+        return face_indices, confidences
+    
+    except Exception as e:
+        logger.error(f"Error matching faces: {str(e)}")
+        return np.full(num_known, -1, dtype=np.intp), np.zeros(num_known, dtype=np.float32)
+
+def merge_photo_faces(photo_face_encodings, tolerance=0.45):
+    """
+    Merge faces seen in several photos of the same room into one list of people.
+    
+    Photos are folded in one at a time: each face is matched one-to-one
+    against the people found so far (faces in the same photo are always
+    different people) and either joins the closest one or becomes a new
+    person. A person's encoding is the mean of their faces.
+    
+    Args:
+        photo_face_encodings: One sequence or (M, D) array of face encodings per photo
+        tolerance: Maximum distance for two faces to be the same person; stricter
+                   than the matching tolerance so two students are not merged
         
-        # 70% chance of being recognized if there are faces in the image
-        is_present = random.random() < 0.7
+    Returns:
+        tuple: (encodings, labels) - (people, D) float32 array of merged encodings and,
+               per photo, an array giving the person index of each of its faces
+    """
+    sums = []
+    counts = []
+    labels = []
+    
+    for face_encodings in photo_face_encodings:
+        if len(face_encodings) == 0:
+            labels.append(np.empty(0, dtype=np.intp))
+            continue
+        
+        faces = np.asarray(face_encodings, dtype=np.float64)
+        photo_labels = np.full(len(faces), -1, dtype=np.intp)
+        
+        if sums:
+            people = np.array(sums) / np.array(counts)[:, None]
+            face_indices, _ = match_faces(people, faces, tolerance)
+            
+            for person, face_index in enumerate(face_indices):
+                if face_index >= 0:
+                    photo_labels[face_index] = person
+                    sums[person] = sums[person] + faces[face_index]
+                    counts[person] += 1
         
-        # Random confidence between 0.65 and 0.95 if present
-        confidence = random.uniform(0.65, 0.95) if is_present else 0
+        for face_index in np.flatnonzero(photo_labels < 0):
+            photo_labels[face_index] = len(sums)
+            sums.append(faces[face_index])
+            counts.append(1)
         
-        logger.info(f"Mock face comparison result: present={is_present}, confidence={confidence:.2f}")
-        return is_present, float(confidence)
+        labels.append(photo_labels)
     
-    except Exception as e:
-        logger.error(f"Error comparing faces: {str(e)}")
-        return False, 0
+    if not sums:
+        return np.empty((0, 0), dtype=np.float32), labels
+    
+    encodings = (np.array(sums) / np.array(counts)[:, None]).astype(np.float32)
+    logger.info(f"Merged {sum(len(photo_labels) for photo_labels in labels)} faces from "
+                f"{len(labels)} photos into {len(encodings)} people")
+    return encodings, labels
@@ -0,0 +1,121 @@
+import io
+import hmac
+import hashlib
+import logging
+
+from flask import current_app, url_for
+
+from aws_service import upload_file_to_s3, read_file
+from storage import get_storage
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Derivative name -> longest side in pixels
+DERIVATIVE_SIZES = {
+    'thumbnail': 200,
+    'medium': 1024,
+}
+
+DERIVATIVE_PREFIX = 'derivatives'
+DERIVATIVE_QUALITY = 82
+
+
+def derivative_path(path, size):
+    """Storage path of a derivative of the file at path"""
+    return f"{DERIVATIVE_PREFIX}/{size}/{path}"
+
+
+def derivative_signature(path, size):
+    """HMAC that authorizes serving a derivative; it never expires, so the URL stays cacheable"""
+    message = f"{size}\n{path}".encode('utf-8')
+    return hmac.new(current_app.secret_key.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def verify_derivative_signature(path, size, signature):
+    return hmac.compare_digest(signature, derivative_signature(path, size))
+
+
+def derivative_url(path, size):
+    """
+    URL of a resized copy of a stored image, served with long-lived caching headers.
+
+    The derivative itself is only generated when the URL is first requested.
+
+    Args:
+        path: Storage path of the original image
+        size: Derivative name, one of DERIVATIVE_SIZES
+
+    Returns:
+        str: URL of the derivative, or None if path is empty
+    """
+    if not path:
+        return None
+    return url_for('main.image_derivative', size=size, path=path, signature=derivative_signature(path, size))
+
+
+def generate_derivatives(path, sizes=None):
+    """
+    Resize a stored image and store the results next to the original.
+
+    The original is decoded once, at the largest requested size, and each
+    smaller size is resized from that.
+
+    Args:
+        path: Storage path of the original image
+        sizes: Derivative names to generate (default: all of DERIVATIVE_SIZES)
+
+    Returns:
+        list: Names of the derivatives that were stored
+    """
+    # Pillow is only needed here; serving and signing derivative URLs do without it
+    from PIL import Image
+    from image_preprocessing import load_working_image
+
+    sizes = sorted(sizes or DERIVATIVE_SIZES, key=DERIVATIVE_SIZES.get, reverse=True)
+
+    original = read_file(path)
+    if original is None:
+        return []
+
+    generated = []
+    try:
+        image = load_working_image(Image.open(io.BytesIO(original)), DERIVATIVE_SIZES[sizes[0]]).image
+
+        for size in sizes:
+            image.thumbnail((DERIVATIVE_SIZES[size], DERIVATIVE_SIZES[size]), Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=DERIVATIVE_QUALITY, optimize=True, progressive=True)
+
+            success, message = upload_file_to_s3(output.getbuffer(), derivative_path(path, size), content_type='image/jpeg')
+            if not success:
+                logger.error(f"Error storing {size} derivative of {path}: {message}")
+                continue
+
+            generated.append(size)
+            logger.info(f"Generated {size} derivative of {path} ({len(original)} -> {output.tell()} bytes)")
+
+    except Exception as e:
+        logger.error(f"Error generating derivatives of {path}: {str(e)}")
+
+    return generated
+
+
+def get_derivative_info(path, size):
+    """
+    Get the metadata of a derivative, generating the derivative on first use.
+
+    Args:
+        path: Storage path of the original image
+        size: Derivative name, one of DERIVATIVE_SIZES
+
+    Returns:
+        StoredFile: Metadata of the stored derivative, or None if it cannot be produced
+    """
+    storage = get_storage()
+    info = storage.head(derivative_path(path, size))
+
+    if info is None and generate_derivatives(path, [size]):
+        info = storage.head(derivative_path(path, size))
+
+    return info
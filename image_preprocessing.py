@@ -0,0 +1,139 @@
+import logging
+from collections import namedtuple
+
+from PIL import Image
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# A decoded image at working resolution
+#   image:         RGB PIL image
+#   original_size: (width, height) of the uploaded image
+#   scale:         (x, y) factors that map working coordinates back to the original
+WorkingImage = namedtuple('WorkingImage', ['image', 'original_size', 'scale'])
+
+# A draft-decoded image at most this much larger than the target is used as is;
+# resampling it would cost more than the decode saved
+RESIZE_TOLERANCE = 1.3
+
+# How much smaller than the target a draft scale may be. Halving a photo up to twice
+# the target while decoding is cheaper than a full decode and resize, and with this
+# ratio every JPEG larger than RESIZE_TOLERANCE x the target has a DCT scale that
+# lands between target / DRAFT_UNDERSHOOT and RESIZE_TOLERANCE x target
+DRAFT_UNDERSHOOT = 2 / RESIZE_TOLERANCE
+
+
+def load_working_image(image, max_dimension):
+    """
+    Decode an image at (about) a target resolution without a full-size decode.
+
+    For JPEGs the decoder is put in draft mode, which scales by 1/2, 1/4 or
+    1/8 in the DCT domain while decoding. It may pick the scale just below
+    the target (down to target / DRAFT_UNDERSHOOT), so a photo up to twice
+    the target is halved while decoding instead of being decoded at full
+    size and resized. Other formats, and JPEGs still more than
+    RESIZE_TOLERANCE over the target, are resized after decoding.
+
+    Args:
+        image: PIL image as returned by Image.open (not yet loaded)
+        max_dimension: Maximum width/height of the working image
+
+    Returns:
+        WorkingImage: The decoded image and the scale back to original coordinates
+    """
+    original_size = image.size
+    width, height = original_size
+
+    if max(original_size) > max_dimension:
+        ratio = max_dimension / max(original_size)
+        target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+
+        # Only has an effect for JPEGs; picks the smallest DCT scale still >= target / DRAFT_UNDERSHOOT
+        image.draft('RGB', (max(1, int(target[0] / DRAFT_UNDERSHOOT)), max(1, int(target[1] / DRAFT_UNDERSHOOT))))
+        image = image.convert('RGB')
+
+        if max(image.size) > max_dimension * RESIZE_TOLERANCE:
+            image = image.resize(target, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    else:
+        image = image.convert('RGB')
+
+    scale = (width / image.width, height / image.height)
+    logger.debug(f"Decoded {original_size} image at working size {image.size}")
+    return WorkingImage(image, original_size, scale)
+
+
+def build_image_pyramid(image, levels, factor=0.5, min_dimension=160):
+    """
+    Build progressively smaller copies of an image for multi-scale detection.
+
+    Args:
+        image: Working-resolution PIL image (the first level)
+        levels: Maximum number of levels, including the image itself
+        factor: Size ratio between consecutive levels
+        min_dimension: Smallest width/height a level may have
+
+    Returns:
+        list: (image, scale) pairs, where scale maps level coordinates back to the first level
+    """
+    pyramid = [(image, 1.0)]
+    scale = 1.0
+
+    while len(pyramid) < levels:
+        width = round(image.width * factor)
+        height = round(image.height * factor)
+        if min(width, height) < min_dimension:
+            break
+
+        image = image.resize((width, height), Image.Resampling.BILINEAR)
+        scale /= factor
+        pyramid.append((image, scale))
+
+    return pyramid
+
+
+def scale_face_locations(face_locations, scale):
+    """
+    Map face locations from a reduced image back to original coordinates.
+
+    Args:
+        face_locations: List of (top, right, bottom, left) tuples
+        scale: (x, y) scale factors, or a single factor for both axes
+
+    Returns:
+        list: (top, right, bottom, left) tuples of ints in original coordinates
+    """
+    scale_x, scale_y = scale if isinstance(scale, tuple) else (scale, scale)
+    return [(int(round(top * scale_y)), int(round(right * scale_x)),
+             int(round(bottom * scale_y)), int(round(left * scale_x)))
+            for top, right, bottom, left in face_locations]
+
+
+def merge_face_locations(face_locations, iou_threshold=0.5):
+    """
+    Drop face boxes that overlap an earlier box (e.g. the same face found at two pyramid levels).
+
+    Args:
+        face_locations: List of (top, right, bottom, left) tuples, preferred boxes first
+        iou_threshold: Intersection-over-union above which two boxes are the same face
+
+    Returns:
+        list: Indices of the boxes that were kept
+    """
+    kept = []
+    for index, (top, right, bottom, left) in enumerate(face_locations):
+        area = max(0, bottom - top) * max(0, right - left)
+        duplicate = False
+
+        for kept_index in kept:
+            k_top, k_right, k_bottom, k_left = face_locations[kept_index]
+            overlap = (max(0, min(bottom, k_bottom) - max(top, k_top))
+                       * max(0, min(right, k_right) - max(left, k_left)))
+            union = area + max(0, k_bottom - k_top) * max(0, k_right - k_left) - overlap
+            if union and overlap / union > iou_threshold:
+                duplicate = True
+                break
+
+        if not duplicate:
+            kept.append(index)
+
+    return kept
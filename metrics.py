@@ -0,0 +1,208 @@
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Every metric of this process, in registration order
+_registry = []
+_registry_lock = threading.Lock()
+
+# Caches with hit/miss counters: name -> object with 'hits' and 'misses' attributes
+_caches = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values.
+
+    Recording is a dictionary update under a lock, so instrumentation costs
+    next to nothing; the text format is only produced when /metrics is scraped.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        with _registry_lock:
+            _registry.append(self)
+
+    def _check_labels(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            samples = list(self._values.items())
+        for labelvalues, value in sorted(samples):
+            lines.extend(self._render_sample(labelvalues, value))
+        return lines
+
+    def _render_sample(self, labelvalues, value):
+        return [f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    """A total that only goes up, such as a number of requests"""
+
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        self._check_labels(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Histogram(Metric):
+    """Distribution of observed values (e.g. durations in seconds) over fixed buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        self._check_labels(labelvalues)
+        position = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            sample = self._values.get(labelvalues)
+            if sample is None:
+                # Per-bucket (not cumulative) counts, then the sum of all values
+                sample = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            sample[position] += 1
+            sample[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observe the duration of a block, in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def _render_sample(self, labelvalues, sample):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), sample[:-1]):
+            cumulative += count
+            labels = _format_labels(self.labelnames, labelvalues, f'le="{_format_value(float(bound))}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f'{self.name}_sum{labels} {_format_value(sample[-1])}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+REQUEST_DURATION = Histogram('sgis_http_request_duration_seconds',
+                             'Time spent handling HTTP requests, by endpoint.',
+                             ['method', 'endpoint', 'status'])
+
+STAGE_DURATION = Histogram('sgis_attendance_stage_duration_seconds',
+                           'Time spent in each stage of attendance processing.',
+                           ['stage'])
+
+SQL_QUERY_DURATION = Histogram('sgis_sql_query_duration_seconds',
+                               'Time spent executing SQL statements (the count is the number of statements).',
+                               buckets=SQL_BUCKETS)
+
+
+def stage_timer(stage):
+    """
+    Time a named stage of attendance processing.
+
+        with stage_timer('upload'):
+            upload_files(...)
+
+    Args:
+        stage: Stage name, used as the 'stage' label
+
+    Returns:
+        Context manager that records the duration of its block
+    """
+    return STAGE_DURATION.time(stage)
+
+
+def register_cache(name, cache):
+    """
+    Report the hit rate of a cache.
+
+    Args:
+        name: Cache name, used as the 'cache' label
+        cache: Object with 'hits' and 'misses' counters, read when metrics are rendered
+    """
+    _caches[name] = cache
+
+
+def _render_caches():
+    stats = [(name, cache.hits, cache.misses) for name, cache in sorted(_caches.items())]
+
+    lines = ['# HELP sgis_cache_hits_total Cache lookups that found an entry.',
+             '# TYPE sgis_cache_hits_total counter']
+    lines.extend(f'sgis_cache_hits_total{{cache="{_escape(name)}"}} {hits}' for name, hits, _ in stats)
+
+    lines.extend(['# HELP sgis_cache_misses_total Cache lookups that found no usable entry.',
+                  '# TYPE sgis_cache_misses_total counter'])
+    lines.extend(f'sgis_cache_misses_total{{cache="{_escape(name)}"}} {misses}' for name, _, misses in stats)
+
+    lines.extend(['# HELP sgis_cache_hit_ratio Share of cache lookups that were hits since the process started.',
+                  '# TYPE sgis_cache_hit_ratio gauge'])
+    lines.extend(f'sgis_cache_hit_ratio{{cache="{_escape(name)}"}} {_format_value(hits / (hits + misses) if hits + misses else 0.0)}'
+                 for name, hits, misses in stats)
+    return lines
+
+
+def render_metrics():
+    """
+    Render every metric of this process in the Prometheus text format.
+
+    Each worker process keeps its own metrics; scrape every worker (or run a
+    single one) to see them all.
+
+    Returns:
+        str: The exposition text
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    lines.extend(_render_caches())
+    return '\n'.join(lines) + '\n'
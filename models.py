@@ -1,7 +1,9 @@
+import json
 from datetime import datetime
 from app import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from utils import pack_face_encoding, unpack_face_encoding, pack_face_detections, unpack_face_detections
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -45,13 +47,26 @@ class Student(db.Model):
     student_id = db.Column(db.String(20), unique=True, nullable=False)
     email = db.Column(db.String(120))
     class_id = db.Column(db.Integer, db.ForeignKey('class.id'), nullable=False)
-    face_encoding = db.Column(db.Text)  # JSON string of face encoding
+    face_encoding = db.Column(db.Text)  # Legacy JSON string of face encoding (see migrate-face-encodings)
+    face_encoding_data = db.Column(db.LargeBinary)  # Packed float32 face encoding (see utils.pack_face_encoding)
     face_image_path = db.Column(db.String(255))  # Path/URL to student's face image in S3
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationship
     attendance_records = db.relationship('AttendanceRecord', backref='student', lazy=True)
     
+    def set_face_encoding(self, encoding):
+        self.face_encoding_data = pack_face_encoding(encoding) if encoding is not None else None
+        self.face_encoding = None
+        
+    def get_face_encoding(self):
+        if self.face_encoding_data:
+            return unpack_face_encoding(self.face_encoding_data)
+        if self.face_encoding:
+            import numpy as np
+            return np.array(json.loads(self.face_encoding), dtype=np.float32)
+        return None
+    
     def __repr__(self):
         return f'<Student {self.name} ({self.student_id})>'
 
@@ -66,14 +81,18 @@ class AttendanceSession(db.Model):
     status = db.Column(db.String(20), default='in_progress')  # in_progress, completed, failed
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Relationship
+    # Relationships
     attendance_records = db.relationship('AttendanceRecord', backref='session', lazy=True)
+    photos = db.relationship('SessionPhoto', backref='session', lazy=True, order_by='SessionPhoto.position')
     
     def __repr__(self):
-        return f'<AttendanceSession {self.id} for {self.class_obj.name} on {self.session_date}>'
+        return f'<AttendanceSession {self.id} for class {self.class_id} on {self.session_date}>'
 
 
 class AttendanceRecord(db.Model):
+    # One record per student and session; records are upserted against this index
+    __table_args__ = (db.Index('uq_attendance_record_session_student', 'session_id', 'student_id', unique=True),)
+    
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('attendance_session.id'), nullable=False)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
@@ -82,4 +101,56 @@ class AttendanceRecord(db.Model):
     recorded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __repr__(self):
-        return f'<AttendanceRecord {self.student.name} - {self.status}>'
+        return f'<AttendanceRecord {self.session_id}/{self.student_id} - {self.status}>'
+
+
+class SessionPhoto(db.Model):
+    """One of the photos of an attendance session; the first is also AttendanceSession.image_path"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('attendance_session.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # Photo index within the session
+    image_path = db.Column(db.String(255))  # Path/URL to the photo in storage
+    
+    def __repr__(self):
+        return f'<SessionPhoto {self.session_id}#{self.position}>'
+
+
+class SessionDetections(db.Model):
+    """Faces detected in a session's photos, kept so the session can be re-matched without re-detection"""
+    session_id = db.Column(db.Integer, db.ForeignKey('attendance_session.id'), primary_key=True)
+    face_count = db.Column(db.Integer, nullable=False, default=0)
+    data = db.Column(db.LargeBinary, nullable=False)  # Packed boxes and encodings (see utils.pack_face_detections)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def set_detections(self, face_locations, face_encodings, photo_indices=None):
+        self.data = pack_face_detections(face_locations, face_encodings, photo_indices)
+        self.face_count = len(face_locations)
+        
+    def get_detections(self):
+        return unpack_face_detections(self.data)
+    
+    def __repr__(self):
+        return f'<SessionDetections {self.session_id} ({self.face_count} faces)>'
+
+
+class ClassAttendanceRollup(db.Model):
+    """Attendance totals per class and day, maintained by attendance_rollups"""
+    class_id = db.Column(db.Integer, db.ForeignKey('class.id'), primary_key=True)
+    session_date = db.Column(db.Date, primary_key=True)
+    session_count = db.Column(db.Integer, nullable=False, default=0)  # Completed sessions
+    present_count = db.Column(db.Integer, nullable=False, default=0)  # Present records
+    record_count = db.Column(db.Integer, nullable=False, default=0)  # All records
+    
+    def __repr__(self):
+        return f'<ClassAttendanceRollup {self.class_id} {self.session_date}>'
+
+
+class StudentAttendanceRollup(db.Model):
+    """Attendance totals per student and class, maintained by attendance_rollups"""
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), primary_key=True)
+    class_id = db.Column(db.Integer, db.ForeignKey('class.id'), primary_key=True)
+    session_count = db.Column(db.Integer, nullable=False, default=0)  # Records across completed sessions
+    present_count = db.Column(db.Integer, nullable=False, default=0)  # Present records
+    
+    def __repr__(self):
+        return f'<StudentAttendanceRollup {self.student_id} {self.class_id}>'
@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import SQL_QUERY_DURATION
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Counters started by count_queries() on this thread
+_local = threading.local()
+
+
+class QueryStats:
+    """Number of SQL statements executed and the time spent in the database"""
+
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        self.duration = 0.0  # Seconds
+        # The SQL itself is only kept where it is asked for, so long requests do not pile it up
+        self.statements = [] if keep_statements else None
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        if self.statements is not None:
+            self.statements.append(statement)
+
+    def __repr__(self):
+        return f'<QueryStats {self.count} queries in {self.duration * 1000:.1f} ms>'
+
+
+def request_query_stats():
+    """Get the QueryStats of the current request (or app context), or None outside one"""
+    if not has_app_context():
+        return None
+    return g.get('query_stats')
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements executed on this thread inside the block.
+
+    Requests made through the test client run on the calling thread, so
+    this is how a query budget is asserted for a route:
+
+        with count_queries() as stats:
+            client.get('/dashboard')
+        assert stats.count <= 6, stats.statements
+
+    Yields:
+        QueryStats: Updated as statements execute, with their SQL in 'statements'
+    """
+    stats = QueryStats(keep_statements=True)
+    counters = _local.__dict__.setdefault('counters', [])
+    counters.append(stats)
+    try:
+        yield stats
+    finally:
+        counters.remove(stats)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start_times'].pop()
+    SQL_QUERY_DURATION.observe(duration)
+
+    stats = request_query_stats()
+    if stats is not None:
+        stats.record(statement, duration)
+
+    for counter in getattr(_local, 'counters', ()):
+        counter.record(statement, duration)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute; drop its start time so the
+    # pooled connection does not accumulate them
+    start_times = context.connection.info.get('query_start_times') if context.connection is not None else None
+    if start_times and context.execution_context is not None:
+        start_times.pop()
+
+
+def start_query_stats():
+    g.query_stats = QueryStats()
+
+
+def add_query_stats_headers(response):
+    stats = request_query_stats()
+    if stats is None:
+        return response
+
+    logger.debug(f"{request.method} {request.path}: {stats.count} queries in {stats.duration * 1000:.1f} ms")
+
+    if current_app.debug or current_app.config["SQL_DEBUG_HEADERS"]:
+        response.headers['X-SQL-Query-Count'] = str(stats.count)
+        response.headers['X-SQL-Query-Time'] = f'{stats.duration * 1000:.1f}'
+    return response
+
+
+def init_app(app):
+    """Count the SQL statements of each request of an app (see add_query_stats_headers)"""
+    app.before_request(start_query_stats)
+    app.after_request(add_query_stats_headers)
@@ -0,0 +1,333 @@
+import re
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+
+import numpy as np
+from flask import current_app, has_app_context
+
+from image_preprocessing import build_image_pyramid, scale_face_locations, merge_face_locations
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Length of a face encoding
+ENCODING_DIMENSION = 128
+
+
+class RecognitionBackend:
+    """
+    Interface of a face recognition engine.
+
+    Images are decoded PIL images at working resolution. Face locations are
+    (top, right, bottom, left) tuples in the coordinates of the image passed
+    in, and encodings are the rows of an (N, ENCODING_DIMENSION) float32 array.
+    """
+
+    name = None
+
+    def detect(self, image, pyramid_levels=1):
+        """
+        Find the faces in an image.
+
+        The default implementation searches each level of an image pyramid
+        with detect_single_scale and merges the faces found at several scales.
+
+        Args:
+            image: Decoded PIL image
+            pyramid_levels: Number of scales to search
+
+        Returns:
+            list: Face locations in image coordinates
+        """
+        face_locations = []
+
+        for level, (level_image, level_scale) in enumerate(build_image_pyramid(image, pyramid_levels)):
+            face_locations.extend(scale_face_locations(self.detect_single_scale(level_image, level), level_scale))
+
+        if pyramid_levels > 1:
+            # The same face is often found at neighbouring scales
+            face_locations = [face_locations[index] for index in merge_face_locations(face_locations)]
+
+        return face_locations
+
+    def detect_single_scale(self, image, level):
+        """Find the faces in one pyramid level (level 0 is the image itself)"""
+        raise NotImplementedError
+
+    def encode(self, image, face_locations=None):
+        """
+        Encode faces.
+
+        Args:
+            image: Decoded PIL image
+            face_locations: Faces to encode, as returned by detect; None encodes the
+                            image as a single face (e.g. a student portrait)
+
+        Returns:
+            numpy.ndarray: (N, ENCODING_DIMENSION) float32 array, one row per face
+        """
+        raise NotImplementedError
+
+    def match_batch(self, known_face_encodings, face_encodings, tolerance=0.6):
+        """
+        Match every known face encoding against every detected face in one pass.
+
+        The full distance matrix is computed with NumPy and faces are assigned
+        one-to-one, closest pair first, so a single detected face can never
+        count for two students.
+
+        Args:
+            known_face_encodings: Sequence or (N, D) array of registered student encodings
+            face_encodings: Sequence or (M, D) array of detected face encodings
+            tolerance: Maximum distance for two encodings to be considered a match
+
+        Returns:
+            tuple: (face_indices, confidences) - for each known encoding, the index of the
+                   matched detected face (-1 if unmatched) and the match confidence (0 if unmatched)
+        """
+        known = np.asarray(known_face_encodings, dtype=np.float64)
+        num_known = len(known)
+        face_indices = np.full(num_known, -1, dtype=np.intp)
+        confidences = np.zeros(num_known, dtype=np.float32)
+
+        if num_known == 0 or len(face_encodings) == 0:
+            return face_indices, confidences
+
+        faces = np.asarray(face_encodings, dtype=np.float64)
+        num_faces = len(faces)
+
+        # Pairwise euclidean distances via |a|^2 + |b|^2 - 2ab
+        distances = ((known * known).sum(axis=1)[:, None]
+                     + (faces * faces).sum(axis=1)[None, :]
+                     - 2.0 * (known @ faces.T))
+        np.maximum(distances, 0, out=distances)
+        np.sqrt(distances, out=distances)
+
+        # Greedy one-to-one assignment over the pairs within tolerance
+        flat_distances = distances.ravel()
+        candidates = np.flatnonzero(flat_distances <= tolerance)
+        candidates = candidates[np.argsort(flat_distances[candidates], kind='stable')]
+
+        face_taken = np.zeros(num_faces, dtype=bool)
+        max_matches = min(num_known, num_faces)
+        matched = 0
+
+        for flat_index in candidates:
+            known_index, face_index = divmod(int(flat_index), num_faces)
+            if face_indices[known_index] >= 0 or face_taken[face_index]:
+                continue
+
+            face_indices[known_index] = face_index
+            confidences[known_index] = 1.0 - flat_distances[flat_index]
+            face_taken[face_index] = True
+
+            matched += 1
+            if matched == max_matches:
+                break
+
+        return face_indices, confidences
+
+
+class MockRecognitionBackend(RecognitionBackend):
+    """
+    Random faces and encodings, for demos without a recognition engine.
+
+    Random encodings are never within tolerance of each other, so matching
+    first puts about PRESENT_PROBABILITY of the registered students in the
+    photo, as the original demo did.
+    """
+
+    name = 'mock'
+
+    # Chance that a registered student is found in a photo
+    PRESENT_PROBABILITY = 0.7
+    # Distance between a placed student and their registered encoding (confidence 0.65 to 0.95)
+    PLACED_DISTANCE = (0.05, 0.35)
+
+    def detect_single_scale(self, image, level):
+        num_faces = np.random.randint(5, 16) if level == 0 else np.random.randint(0, 3)
+        width, height = image.size
+
+        sizes = np.maximum(1, (min(width, height) * np.random.uniform(0.05, 0.15, num_faces)).astype(int))
+        tops = (np.random.random_sample(num_faces) * (np.maximum(0, height - sizes) + 1)).astype(int)
+        lefts = (np.random.random_sample(num_faces) * (np.maximum(0, width - sizes) + 1)).astype(int)
+
+        return list(zip(tops.tolist(), (lefts + sizes).tolist(), (tops + sizes).tolist(), lefts.tolist()))
+
+    def encode(self, image, face_locations=None):
+        num_faces = 1 if face_locations is None else len(face_locations)
+        return np.random.uniform(-1, 1, (num_faces, ENCODING_DIMENSION)).astype(np.float32)
+
+    def match_batch(self, known_face_encodings, face_encodings, tolerance=0.6):
+        known = np.asarray(known_face_encodings, dtype=np.float64)
+        faces = np.array(face_encodings, dtype=np.float64)
+
+        if len(known) and len(faces):
+            # Each placed student replaces a different detected face with their own encoding plus noise
+            present = np.flatnonzero(np.random.random_sample(len(known)) < self.PRESENT_PROBABILITY)
+            present = np.random.permutation(present)[:len(faces)]
+            slots = np.random.permutation(len(faces))[:len(present)]
+
+            noise = np.random.normal(0, 1, (len(present), known.shape[1]))
+            noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+            distances = np.minimum(np.random.uniform(*self.PLACED_DISTANCE, len(present)), tolerance)
+            faces[slots] = known[present] + noise * distances[:, None]
+
+        return super().match_batch(known, faces, tolerance)
+
+
+class SyntheticRecognitionBackend(RecognitionBackend):
+    """
+    Deterministic faces for load tests and benchmarks.
+
+    Everything is derived from a hash of the decoded pixels and the seed, so
+    the same photo always gives the same faces and encodings. Each face
+    belongs to one of `population` identities; an identity has a fixed base
+    encoding and every capture of it adds a little noise, well within the
+    matching tolerance, while different identities are far apart.
+
+    Images may name the identities they show in a 'synthetic_faces' PNG text
+    chunk or a 'synthetic_faces=3,17,42' JPEG comment, so generated student
+    portraits and classroom photos can be made to match. Untagged images get
+    identities drawn from their hash.
+    """
+
+    name = 'synthetic'
+
+    # Per-component spread of identity encodings (distinct identities are ~1.3 apart)
+    IDENTITY_SCALE = 0.08
+    # Per-component capture noise (captures of one identity are ~0.25 apart)
+    NOISE_SCALE = 0.015
+
+    TAG = 'synthetic_faces'
+
+    def __init__(self, seed=0, population=10000):
+        self.seed = seed
+        self.population = population
+        # Cached per backend so the seed is part of the key
+        self._identity_encoding = lru_cache(maxsize=65536)(self._make_identity_encoding)
+
+    def _make_identity_encoding(self, identity):
+        rng = np.random.default_rng([self.seed, identity])
+        return rng.normal(0, self.IDENTITY_SCALE, ENCODING_DIMENSION).astype(np.float32)
+
+    def identity_encodings(self, identities):
+        """Base encodings of identities, as an (N, ENCODING_DIMENSION) float32 array"""
+        if len(identities) == 0:
+            return np.empty((0, ENCODING_DIMENSION), dtype=np.float32)
+        return np.stack([self._identity_encoding(int(identity)) for identity in identities])
+
+    def _image_rng(self, image, stream):
+        digest = hashlib.sha256(image.tobytes()).digest()
+        return np.random.default_rng([self.seed, stream, int.from_bytes(digest[:16], 'little')])
+
+    def _tagged_identities(self, image):
+        tag = image.info.get(self.TAG)
+        if tag is None:
+            comment = image.info.get('comment', b'')
+            if isinstance(comment, bytes):
+                comment = comment.decode('ascii', 'ignore')
+            match = re.match(rf'{self.TAG}=([\d,]*)', comment)
+            tag = match.group(1) if match else None
+
+        if tag is None:
+            return None
+        return [int(identity) for identity in tag.split(',') if identity]
+
+    def _layout(self, image):
+        """Face boxes (N, 4) and identities (N,) of an image"""
+        rng = self._image_rng(image, 0)
+
+        identities = self._tagged_identities(image)
+        if identities is None:
+            identities = rng.integers(0, self.population, rng.integers(5, 16))
+        identities = np.asarray(identities, dtype=np.int64)
+        num_faces = len(identities)
+
+        width, height = image.size
+        sizes = np.maximum(1, (min(width, height) * rng.uniform(0.05, 0.15, num_faces)).astype(np.int64))
+        tops = (rng.random(num_faces) * (np.maximum(0, height - sizes) + 1)).astype(np.int64)
+        lefts = (rng.random(num_faces) * (np.maximum(0, width - sizes) + 1)).astype(np.int64)
+
+        boxes = np.stack([tops, lefts + sizes, tops + sizes, lefts], axis=1)
+        return boxes, identities
+
+    def detect(self, image, pyramid_levels=1):
+        # Boxes are placed relative to the image, so every scale finds the same faces
+        boxes, _ = self._layout(image)
+        return [tuple(box) for box in boxes.tolist()]
+
+    def encode(self, image, face_locations=None):
+        boxes, identities = self._layout(image)
+
+        if face_locations is None:
+            # A portrait: its first tagged identity, or one drawn from its hash
+            identities = identities[:1] if len(identities) else self._image_rng(image, 2).integers(0, self.population, 1)
+        elif len(face_locations) == 0:
+            return np.empty((0, ENCODING_DIMENSION), dtype=np.float32)
+        else:
+            # Each location belongs to the face whose box centre is closest to its own
+            locations = np.asarray(face_locations, dtype=np.float64)
+            centres = np.stack([locations[:, 0] + locations[:, 2], locations[:, 1] + locations[:, 3]], axis=1)
+            box_centres = np.stack([boxes[:, 0] + boxes[:, 2], boxes[:, 1] + boxes[:, 3]], axis=1)
+            nearest = ((centres[:, None, :] - box_centres[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+            identities = identities[nearest]
+
+        noise = self._image_rng(image, 1).normal(0, self.NOISE_SCALE, (len(identities), ENCODING_DIMENSION))
+        return (self.identity_encodings(identities) + noise).astype(np.float32)
+
+
+RECOGNITION_BACKENDS = {
+    MockRecognitionBackend.name: MockRecognitionBackend,
+    SyntheticRecognitionBackend.name: SyntheticRecognitionBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def configure_recognition_backend(name='mock', seed=0):
+    """
+    Select the recognition backend used by this process.
+
+    Called on first use with RECOGNITION_BACKEND and RECOGNITION_SEED (see
+    get_recognition_backend), and as the initializer of worker processes so
+    they use the same backend.
+
+    Args:
+        name: Backend name, one of RECOGNITION_BACKENDS
+        seed: Seed of the synthetic backend
+
+    Returns:
+        RecognitionBackend: The configured backend
+    """
+    global _backend
+
+    if name not in RECOGNITION_BACKENDS:
+        raise ValueError(f"Unknown recognition backend: {name}")
+
+    with _backend_lock:
+        if name == SyntheticRecognitionBackend.name:
+            _backend = SyntheticRecognitionBackend(seed=seed)
+        else:
+            _backend = RECOGNITION_BACKENDS[name]()
+        logger.info(f"Using {name} recognition backend")
+        return _backend
+
+
+def get_recognition_backend():
+    """
+    Get the configured recognition backend.
+
+    The first call inside the app configures the one named by the app's
+    RECOGNITION_BACKEND setting, so processes that never recognize faces
+    never load it; outside the app the mock backend is the default.
+    """
+    if _backend is None:
+        if has_app_context():
+            return configure_recognition_backend(current_app.config["RECOGNITION_BACKEND"],
+                                                 seed=current_app.config["RECOGNITION_SEED"])
+        return configure_recognition_backend()
+    return _backend
@@ -1,30 +1,45 @@
 import os
+import io
+import csv
+import time
+import hmac
+import zipfile
 import logging
 import json
 from datetime import datetime, date, timedelta
-from flask import render_template, redirect, url_for, flash, request, session, jsonify
+from flask import Blueprint, current_app, render_template, redirect, url_for, flash, request, session, jsonify, Response, stream_with_context, send_file, abort, g
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from sqlalchemy import func
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
 
-from app import app, db
-from models import User, Class, Student, AttendanceSession, AttendanceRecord
-from face_recognition_service import detect_faces_in_image, encode_face_image, compare_faces
+from app import db
+from models import (User, Class, Student, AttendanceSession, AttendanceRecord,
+                    ClassAttendanceRollup, StudentAttendanceRollup)
 from aws_service import upload_file_to_s3, get_file_url
+from storage import get_storage, LocalStorageBackend
+from image_derivatives import DERIVATIVE_SIZES, derivative_path, derivative_url, get_derivative_info, verify_derivative_signature
+from utils import read_upload
+from metrics import PROMETHEUS_CONTENT_TYPE, REQUEST_DURATION, render_metrics
+
+# Views that detect or match faces import the recognition modules (NumPy,
+# Pillow, the recognition backend) when first called, so workers start without them
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-@app.route('/')
+bp = Blueprint('main', __name__)
+
+@bp.route('/')
 def index():
     if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
+        return redirect(url_for('main.dashboard'))
+    return redirect(url_for('main.login'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     if request.method == 'POST':
         username = request.form.get('username')
@@ -35,16 +50,16 @@ def login():
         if user and user.check_password(password):
             login_user(user, remember=True)
             flash('Login successful!', 'success')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         else:
             flash('Invalid username or password.', 'error')
     
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     if request.method == 'POST':
         username = request.form.get('username')
@@ -68,7 +83,7 @@ def register():
             db.session.add(new_user)
             db.session.commit()
             flash('Registration successful. Please login.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         except Exception as e:
             db.session.rollback()
             logger.error(f"Error registering new user: {str(e)}")
@@ -76,53 +91,66 @@ def register():
     
     return render_template('register.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('You have been logged out.', 'success')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
+
+def teacher_student_counts():
+    """Number of students per class of the current user, counted in SQL instead of loading every student"""
+    return dict(db.session.query(Student.class_id, func.count(Student.id))
+                .join(Class)
+                .filter(Class.teacher_id == current_user.id)
+                .group_by(Student.class_id)
+                .all())
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 @login_required
 def dashboard():
     # Get classes taught by current user
     classes = Class.query.filter_by(teacher_id=current_user.id).all()
     
-    # Get recent attendance sessions
+    # Get recent attendance sessions, with their class from the join and their records in one more query
     recent_sessions = (AttendanceSession.query
                     .join(Class)
+                    .options(contains_eager(AttendanceSession.class_obj),
+                             selectinload(AttendanceSession.attendance_records))
                     .filter(Class.teacher_id == current_user.id)
                     .order_by(AttendanceSession.created_at.desc())
                     .limit(5)
                     .all())
     
-    # Get attendance statistics for all classes
+    # Get attendance statistics for all classes from the rollup table
+    since = datetime.utcnow().date() - timedelta(days=30)
+    
+    student_counts = teacher_student_counts()
+    
+    # Sessions in the last 30 days and present records across them, per class
+    session_totals = {
+        class_id: (total_sessions, total_attendance)
+        for class_id, total_sessions, total_attendance in (
+            db.session.query(ClassAttendanceRollup.class_id,
+                             func.sum(ClassAttendanceRollup.session_count),
+                             func.sum(ClassAttendanceRollup.present_count))
+            .join(Class)
+            .filter(Class.teacher_id == current_user.id,
+                    ClassAttendanceRollup.session_date >= since)
+            .group_by(ClassAttendanceRollup.class_id)
+            .all())
+    }
+    
     attendance_stats = []
     for class_obj in classes:
-        # Get count of students in this class
-        student_count = Student.query.filter_by(class_id=class_obj.id).count()
-        
-        # Get attendance rate for the last 30 days
-        sessions = (AttendanceSession.query
-                  .filter_by(class_id=class_obj.id)
-                  .filter(AttendanceSession.session_date >= (datetime.utcnow().date() - timedelta(days=30)))
-                  .all())
-        
-        total_sessions = len(sessions)
-        total_attendance = 0
-        total_possible = 0
-        
-        for session in sessions:
-            present_count = (AttendanceRecord.query
-                          .filter_by(session_id=session.id, status='present')
-                          .count())
-            total_attendance += present_count
-            total_possible += student_count
+        student_count = student_counts.get(class_obj.id, 0)
+        total_sessions, total_attendance = session_totals.get(class_obj.id, (0, 0))
+        total_possible = total_sessions * student_count
         
         attendance_rate = (total_attendance / total_possible * 100) if total_possible > 0 else 0
         
         attendance_stats.append({
+            'class_id': class_obj.id,
             'class_name': class_obj.name,
             'student_count': student_count,
             'total_sessions': total_sessions,
@@ -132,9 +160,10 @@ def dashboard():
     return render_template('dashboard.html', 
                           classes=classes,
                           attendance_stats=attendance_stats,
+                          student_counts=student_counts,
                           recent_sessions=recent_sessions)
 
-@app.route('/classes', methods=['GET', 'POST'])
+@bp.route('/classes', methods=['GET', 'POST'])
 @login_required
 def manage_classes():
     if request.method == 'POST':
@@ -143,7 +172,7 @@ def manage_classes():
         
         if not name:
             flash('Class name is required.', 'error')
-            return redirect(url_for('manage_classes'))
+            return redirect(url_for('main.manage_classes'))
         
         new_class = Class(
             name=name,
@@ -161,9 +190,9 @@ def manage_classes():
             flash('An error occurred while creating the class.', 'error')
             
     classes = Class.query.filter_by(teacher_id=current_user.id).all()
-    return render_template('dashboard.html', classes=classes, active_tab='classes')
+    return render_template('dashboard.html', classes=classes, student_counts=teacher_student_counts(), active_tab='classes')
 
-@app.route('/classes/<int:class_id>')
+@bp.route('/classes/<int:class_id>')
 @login_required
 def view_class(class_id):
     class_obj = Class.query.get_or_404(class_id)
@@ -171,7 +200,7 @@ def view_class(class_id):
     # Check if user owns this class
     if class_obj.teacher_id != current_user.id:
         flash('You do not have permission to view this class.', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     students = Student.query.filter_by(class_id=class_id).all()
     
@@ -180,19 +209,29 @@ def view_class(class_id):
               .order_by(AttendanceSession.session_date.desc())
               .all())
     
+    # Thumbnails rather than the full-size uploads
+    student_photo_urls = {student.id: derivative_url(student.face_image_path, 'thumbnail') for student in students}
+    session_thumbnail_urls = {session.id: derivative_url(session.image_path, 'thumbnail') for session in sessions}
+    
     return render_template('dashboard.html', 
                           class_obj=class_obj, 
                           students=students, 
                           sessions=sessions,
+                          student_photo_urls=student_photo_urls,
+                          session_thumbnail_urls=session_thumbnail_urls,
                           active_tab='view_class')
 
-@app.route('/students/register', methods=['GET', 'POST'])
+@bp.route('/students/register', methods=['GET', 'POST'])
 @login_required
 def student_register():
     # Get all classes for this teacher
     classes = Class.query.filter_by(teacher_id=current_user.id).all()
     
     if request.method == 'POST':
+        from face_recognition_service import encode_face_image
+        from encoding_cache import invalidate_class_encodings
+        from face_index import get_face_index_store
+        
         name = request.form.get('name')
         student_id = request.form.get('student_id')
         email = request.form.get('email', '')
@@ -200,19 +239,19 @@ def student_register():
         
         if not all([name, student_id, class_id]):
             flash('Name, student ID, and class are required.', 'error')
-            return redirect(url_for('student_register'))
+            return redirect(url_for('main.student_register'))
         
         # Check if student ID already exists
         existing_student = Student.query.filter_by(student_id=student_id).first()
         if existing_student:
             flash('A student with this ID already exists.', 'error')
-            return redirect(url_for('student_register'))
+            return redirect(url_for('main.student_register'))
         
         # Check if teacher owns this class
         class_obj = Class.query.get(class_id)
         if not class_obj or class_obj.teacher_id != current_user.id:
             flash('Invalid class selection.', 'error')
-            return redirect(url_for('student_register'))
+            return redirect(url_for('main.student_register'))
         
         # Process student photo if provided
         face_encoding = None
@@ -225,30 +264,32 @@ def student_register():
                     # Generate a secure filename
                     filename = secure_filename(f"{student_id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.jpg")
                     
+                    # Read the photo once; encoding and upload share the buffer
+                    photo_data = read_upload(photo)
+                    
                     # Encode face
-                    face_encoding_array = encode_face_image(photo)
+                    face_encoding_array = encode_face_image(photo_data)
                     
                     if face_encoding_array is not None:
-                        # The face_encoding_array is already a list in our mock implementation
-                        face_encoding = json.dumps(face_encoding_array)
+                        face_encoding = face_encoding_array
                         
                         # Upload to S3
                         s3_path = f"student_photos/{filename}"
-                        success, message = upload_file_to_s3(photo, s3_path)
+                        success, message = upload_file_to_s3(photo_data, s3_path, content_type=photo.content_type)
                         
                         if success:
                             face_image_path = s3_path
                         else:
                             logger.error(f"S3 upload error: {message}")
                             flash('Error uploading photo. Please try again.', 'error')
-                            return redirect(url_for('student_register'))
+                            return redirect(url_for('main.student_register'))
                     else:
                         flash('No face detected in the photo. Please try another photo.', 'error')
-                        return redirect(url_for('student_register'))
+                        return redirect(url_for('main.student_register'))
                 except Exception as e:
                     logger.error(f"Error processing face image: {str(e)}")
                     flash('Error processing the photo. Please try again.', 'error')
-                    return redirect(url_for('student_register'))
+                    return redirect(url_for('main.student_register'))
         
         # Create new student
         new_student = Student(
@@ -256,171 +297,202 @@ def student_register():
             student_id=student_id,
             email=email,
             class_id=class_id,
-            face_encoding=face_encoding,
             face_image_path=face_image_path
         )
+        new_student.set_face_encoding(face_encoding)
         
         try:
             db.session.add(new_student)
             db.session.commit()
-            flash('Student registered successfully.', 'success')
-            return redirect(url_for('view_class', class_id=class_id))
+            invalidate_class_encodings(new_student.class_id)
         except Exception as e:
             db.session.rollback()
             logger.error(f"Error registering student: {str(e)}")
             flash('An error occurred while registering the student.', 'error')
+            return render_template('student_register.html', classes=classes)
+        
+        # The student is saved; a failed index update only delays cross-class identification
+        if face_encoding is not None:
+            try:
+                get_face_index_store().add(new_student.id, face_encoding)
+            except Exception as e:
+                logger.error(f"Error updating face index: {str(e)}")
+        
+        flash('Student registered successfully.', 'success')
+        return redirect(url_for('main.view_class', class_id=class_id))
     
     return render_template('student_register.html', classes=classes)
 
-@app.route('/attendance/take', methods=['GET', 'POST'])
+def wants_json():
+    """Whether the client asked for a JSON response (e.g. a fetch() from capture.js)"""
+    return request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+
+def attendance_error(message):
+    """Report a take_attendance error as JSON or as a flash message, depending on the client"""
+    if wants_json():
+        return jsonify({'success': False, 'message': message})
+    flash(message, 'error')
+    return redirect(url_for('main.take_attendance'))
+
+def idempotency_key():
+    """Client-chosen key identifying an attendance submission, from the Idempotency-Key header or form"""
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    return key.strip()[:255] if key else None
+
+@bp.route('/students/import', methods=['GET', 'POST'])
+@login_required
+def student_import():
+    # Get all classes for this teacher
+    classes = Class.query.filter_by(teacher_id=current_user.id).all()
+    results = None
+    
+    if request.method == 'POST':
+        from student_import import import_students
+        
+        class_id = request.form.get('class_id')
+        roster = request.files.get('roster')
+        photos = request.files.get('photos')
+        
+        if not class_id or not roster or not roster.filename:
+            flash('A class and a roster CSV are required.', 'error')
+            return redirect(url_for('main.student_import'))
+        
+        # Check if teacher owns this class
+        class_obj = Class.query.get(class_id)
+        if not class_obj or class_obj.teacher_id != current_user.id:
+            flash('Invalid class selection.', 'error')
+            return redirect(url_for('main.student_import'))
+        
+        try:
+            results = import_students(class_obj, roster, photos if photos and photos.filename else None)
+        except (UnicodeDecodeError, csv.Error, zipfile.BadZipFile) as e:
+            logger.error(f"Invalid bulk import files: {str(e)}")
+            flash('The roster must be a UTF-8 CSV file and the photos a zip archive.', 'error')
+            return redirect(url_for('main.student_import'))
+        
+        imported = sum(1 for result in results if result['status'] == 'imported')
+        
+        if wants_json():
+            return jsonify({'success': True, 'imported': imported, 'results': results})
+        
+        flash(f'Imported {imported} of {len(results)} students.', 'success' if imported == len(results) else 'warning')
+    
+    return render_template('student_import.html', classes=classes, results=results)
+
+@bp.route('/attendance/take', methods=['GET', 'POST'])
 @login_required
 def take_attendance():
     # Get all classes for this teacher
     classes = Class.query.filter_by(teacher_id=current_user.id).all()
     
     if request.method == 'POST':
+        from attendance_pipeline import start_attendance
+        
         class_id = request.form.get('class_id')
         
         if not class_id:
-            flash('Please select a class.', 'error')
-            return redirect(url_for('take_attendance'))
+            return attendance_error('Please select a class.')
         
         # Check if teacher owns this class
         class_obj = Class.query.get(class_id)
         if not class_obj or class_obj.teacher_id != current_user.id:
-            flash('Invalid class selection.', 'error')
-            return redirect(url_for('take_attendance'))
+            return attendance_error('Invalid class selection.')
         
-        # Check if classroom photo was provided
+        # Check if classroom photos were provided (several can cover a large room)
         if 'classroom_photo' not in request.files:
-            flash('No photo provided.', 'error')
-            return redirect(url_for('take_attendance'))
+            return attendance_error('No photo provided.')
         
-        classroom_photo = request.files['classroom_photo']
-        if not classroom_photo.filename:
-            flash('No photo selected.', 'error')
-            return redirect(url_for('take_attendance'))
+        classroom_photos = [photo for photo in request.files.getlist('classroom_photo') if photo.filename]
+        if not classroom_photos:
+            return attendance_error('No photo selected.')
         
-        try:
-            # Generate a secure filename
-            filename = secure_filename(f"class_{class_id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.jpg")
-            
-            # Create attendance session
-            session_date = date.today()
-            session_time = datetime.utcnow().time()
-            
-            new_session = AttendanceSession(
-                class_id=class_id,
-                session_date=session_date,
-                start_time=session_time,
-                status='processing'
-            )
-            
-            db.session.add(new_session)
-            db.session.flush()  # Get ID without committing
-            
-            # Upload to S3
-            s3_path = f"classroom_photos/{new_session.id}_{filename}"
-            success, message = upload_file_to_s3(classroom_photo, s3_path)
-            
-            if not success:
-                logger.error(f"S3 upload error: {message}")
-                db.session.rollback()
-                flash('Error uploading photo. Please try again.', 'error')
-                return redirect(url_for('take_attendance'))
-            
-            # Update session with image path
-            new_session.image_path = s3_path
-            
-            # Process attendance
-            # 1. Get all students in this class
-            students = Student.query.filter_by(class_id=class_id).all()
-            
-            if not students:
-                flash('No students registered in this class yet.', 'warning')
-                new_session.status = 'completed'
-                db.session.commit()
-                return redirect(url_for('view_attendance', session_id=new_session.id))
-            
-            # 2. Detect faces in classroom photo
-            face_locations, face_encodings = detect_faces_in_image(classroom_photo)
-            
-            if not face_locations:
-                flash('No faces detected in the classroom photo.', 'warning')
-                new_session.status = 'completed'
-                db.session.commit()
-                return redirect(url_for('view_attendance', session_id=new_session.id))
-            
-            # 3. Compare detected faces with student face encodings
-            present_students = []
-            
-            for student in students:
-                if student.face_encoding:
-                    student_encoding = json.loads(student.face_encoding)
-                    # Convert back to numpy array
-                    student_encoding = [float(value) for value in student_encoding]
-                    
-                    # Compare with each detected face
-                    is_present, confidence = compare_faces(student_encoding, face_encodings)
-                    
-                    status = 'present' if is_present else 'absent'
-                    
-                    # Create attendance record
-                    record = AttendanceRecord(
-                        session_id=new_session.id,
-                        student_id=student.id,
-                        status=status,
-                        confidence=confidence if is_present else 0
-                    )
-                    
-                    db.session.add(record)
-                    
-                    if is_present:
-                        present_students.append(student.name)
-                else:
-                    # No face encoding for this student
-                    record = AttendanceRecord(
-                        session_id=new_session.id,
-                        student_id=student.id,
-                        status='absent',
-                        confidence=0
-                    )
-                    db.session.add(record)
-            
-            # Complete the session
-            new_session.status = 'completed'
-            new_session.end_time = datetime.utcnow().time()
-            
-            db.session.commit()
-            
-            # Success message
-            if present_students:
-                flash(f'Attendance recorded successfully. Detected {len(present_students)} students.', 'success')
-            else:
-                flash('Attendance recorded, but no students were recognized.', 'warning')
-            
-            return redirect(url_for('view_attendance', session_id=new_session.id))
+        if len(classroom_photos) > current_app.config["ATTENDANCE_MAX_PHOTOS"]:
+            return attendance_error(f'Please select at most {current_app.config["ATTENDANCE_MAX_PHOTOS"]} photos.')
         
+        try:
+            new_session, created = start_attendance(class_obj, [read_upload(photo) for photo in classroom_photos],
+                                                    idempotency_key())
         except Exception as e:
             db.session.rollback()
             logger.error(f"Error processing attendance: {str(e)}")
-            flash('An error occurred while processing attendance.', 'error')
+            return attendance_error('An error occurred while processing attendance.')
+        
+        if new_session is None:
+            return attendance_error('The server is busy processing other attendance photos. Please try again shortly.')
+        
+        if wants_json():
+            return jsonify({
+                'success': True,
+                'duplicate': not created,
+                'session_id': new_session.id,
+                'status_url': url_for('main.attendance_status', session_id=new_session.id),
+                'redirect': url_for('main.view_attendance', session_id=new_session.id)
+            })
+        
+        if not created:
+            flash('This photo was already submitted; showing the existing attendance session.', 'info')
+            return redirect(url_for('main.view_attendance', session_id=new_session.id))
+        
+        flash('Attendance photo received and is being processed.', 'info')
+        return redirect(url_for('main.view_attendance', session_id=new_session.id))
     
-    return render_template('take_attendance.html', classes=classes)
+    return render_template('take_attendance.html', classes=classes, max_photos=current_app.config["ATTENDANCE_MAX_PHOTOS"])
 
-@app.route('/attendance/session/<int:session_id>')
+@bp.route('/api/attendance/session/<int:session_id>/status')
+@login_required
+def attendance_status(session_id):
+    from attendance_pipeline import expire_stale_session
+    from attendance_stream import finish_expired_streams
+    
+    attendance_session = AttendanceSession.query.get_or_404(session_id)
+    
+    # Check if teacher owns this class
+    if attendance_session.class_obj.teacher_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Invalid attendance session'}), 403
+    
+    if attendance_session.status == 'processing':
+        # A camera stream past its time budget records its attendance now
+        finish_expired_streams()
+        expire_stale_session(attendance_session)
+    
+    response = {
+        'success': True,
+        'session_id': attendance_session.id,
+        'status': attendance_session.status,
+        'redirect': url_for('main.view_attendance', session_id=attendance_session.id)
+    }
+    
+    if attendance_session.status != 'processing':
+        counts = dict(db.session.query(AttendanceRecord.status, func.count(AttendanceRecord.id))
+                      .filter(AttendanceRecord.session_id == session_id)
+                      .group_by(AttendanceRecord.status)
+                      .all())
+        response['present_count'] = counts.get('present', 0)
+        response['total_count'] = sum(counts.values())
+    
+    return jsonify(response)
+
+@bp.route('/attendance/session/<int:session_id>')
 @login_required
 def view_attendance(session_id):
-    session = AttendanceSession.query.get_or_404(session_id)
+    session = (AttendanceSession.query
+               .options(joinedload(AttendanceSession.class_obj))
+               .filter_by(id=session_id)
+               .first_or_404())
     
     # Check if teacher owns this class
     if session.class_obj.teacher_id != current_user.id:
         flash('You do not have permission to view this attendance record.', 'error')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
+    
+    if session.status == 'processing':
+        from attendance_stream import finish_expired_streams
+        finish_expired_streams()
     
     # Get attendance records for this session
     records = (AttendanceRecord.query
              .join(Student)
+             .options(contains_eager(AttendanceRecord.student))
              .filter(AttendanceRecord.session_id == session_id)
              .order_by(Student.name)
              .all())
@@ -428,17 +500,82 @@ def view_attendance(session_id):
     # Get class info
     class_obj = session.class_obj
     
-    # Get image URL
-    image_url = get_file_url(session.image_path) if session.image_path else None
+    # Get image URLs: a resized copy for display, the original for download
+    image_url = derivative_url(session.image_path, 'medium')
+    original_image_url = get_file_url(session.image_path) if session.image_path else None
+    student_photo_urls = {record.student_id: derivative_url(record.student.face_image_path, 'thumbnail')
+                          for record in records}
     
     return render_template('dashboard.html', 
                           active_tab='attendance',
                           session=session,
                           records=records,
                           class_obj=class_obj,
-                          image_url=image_url)
+                          image_url=image_url,
+                          original_image_url=original_image_url,
+                          student_photo_urls=student_photo_urls)
 
-@app.route('/attendance/reports')
+@bp.route('/attendance/session/<int:session_id>/rematch', methods=['POST'])
+@login_required
+def rematch_session(session_id):
+    from attendance_pipeline import rematch_attendance
+    
+    attendance_session = AttendanceSession.query.get_or_404(session_id)
+    
+    # Check if teacher owns this class
+    if attendance_session.class_obj.teacher_id != current_user.id:
+        if wants_json():
+            return jsonify({'success': False, 'message': 'Invalid attendance session'}), 403
+        flash('You do not have permission to modify this attendance record.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    success, message = rematch_attendance(session_id)
+    
+    if wants_json():
+        response = {'success': success, 'message': message, 'session_id': session_id}
+        if success:
+            counts = dict(db.session.query(AttendanceRecord.status, func.count(AttendanceRecord.id))
+                          .filter(AttendanceRecord.session_id == session_id)
+                          .group_by(AttendanceRecord.status)
+                          .all())
+            response['present_count'] = counts.get('present', 0)
+            response['total_count'] = sum(counts.values())
+        return jsonify(response)
+    
+    flash(message, 'success' if success else 'error')
+    return redirect(url_for('main.view_attendance', session_id=session_id))
+
+def report_session_filters(class_id, start_date=None, end_date=None):
+    """
+    Build the AttendanceSession filters for a class report.
+    
+    Only completed sessions are reported: the rollup tables count nothing else,
+    and a session still processing (or failed) has no records to count.
+    
+    Args:
+        class_id: ID of the class
+        start_date: Optional first session date (YYYY-MM-DD)
+        end_date: Optional last session date (YYYY-MM-DD)
+        
+    Returns:
+        list: SQLAlchemy filter expressions
+        
+    Raises:
+        ValueError: If a date is not in YYYY-MM-DD format
+    """
+    filters = [AttendanceSession.class_id == class_id, AttendanceSession.status == 'completed']
+    
+    if start_date:
+        start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+        filters.append(AttendanceSession.session_date >= start_date_obj)
+    
+    if end_date:
+        end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        filters.append(AttendanceSession.session_date <= end_date_obj)
+    
+    return filters
+
+@bp.route('/attendance/reports')
 @login_required
 def attendance_reports():
     # Get all classes taught by this teacher
@@ -455,35 +592,50 @@ def attendance_reports():
         class_obj = Class.query.get(class_id)
         if not class_obj or class_obj.teacher_id != current_user.id:
             flash('Invalid class selection.', 'error')
-            return redirect(url_for('attendance_reports'))
+            return redirect(url_for('main.attendance_reports'))
         
         # Build query for attendance sessions
-        query = AttendanceSession.query.filter_by(class_id=class_id)
-        
-        if start_date:
-            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
-            query = query.filter(AttendanceSession.session_date >= start_date_obj)
+        try:
+            session_filters = report_session_filters(class_id, start_date, end_date)
+        except ValueError:
+            flash('Invalid date. Please use the YYYY-MM-DD format.', 'error')
+            return redirect(url_for('main.attendance_reports', class_id=class_id))
         
-        if end_date:
-            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
-            query = query.filter(AttendanceSession.session_date <= end_date_obj)
+        sessions = (AttendanceSession.query
+                  .filter(*session_filters)
+                  .order_by(AttendanceSession.session_date.desc())
+                  .all())
         
-        sessions = query.order_by(AttendanceSession.session_date.desc()).all()
+        # Per-session record counts by status, grouped in the database rather than loading the records
+        session_counts = {}
+        for session_id, status, count in (db.session.query(AttendanceRecord.session_id, AttendanceRecord.status,
+                                                           func.count(AttendanceRecord.id))
+                                          .join(AttendanceSession)
+                                          .filter(*session_filters)
+                                          .group_by(AttendanceRecord.session_id, AttendanceRecord.status)):
+            session_counts.setdefault(session_id, {})[status] = count
         
         # Get all students in this class
         students = Student.query.filter_by(class_id=class_id).all()
         
+        # Count present records per student across the selected sessions
+        if start_date or end_date:
+            present_counts = dict(db.session.query(AttendanceRecord.student_id, func.count(AttendanceRecord.id))
+                                  .join(AttendanceSession)
+                                  .filter(AttendanceRecord.status == 'present', *session_filters)
+                                  .group_by(AttendanceRecord.student_id)
+                                  .all())
+        else:
+            # All-time totals are kept up to date in the rollup table
+            present_counts = dict(db.session.query(StudentAttendanceRollup.student_id, StudentAttendanceRollup.present_count)
+                                  .filter(StudentAttendanceRollup.class_id == class_id)
+                                  .all())
+        
         # Calculate attendance for each student
         student_attendance = []
         
         for student in students:
-            # Count attendance records
-            total_present = (AttendanceRecord.query
-                         .join(AttendanceSession)
-                         .filter(AttendanceRecord.student_id == student.id,
-                                AttendanceRecord.status == 'present',
-                                AttendanceSession.id.in_([s.id for s in sessions]))
-                         .count())
+            total_present = present_counts.get(student.id, 0)
             
             attendance_rate = (total_present / len(sessions) * 100) if sessions else 0
             
@@ -501,6 +653,7 @@ def attendance_reports():
         reports = {
             'class': class_obj,
             'sessions': sessions,
+            'session_counts': session_counts,
             'student_attendance': student_attendance,
             'start_date': start_date,
             'end_date': end_date
@@ -511,16 +664,154 @@ def attendance_reports():
                           reports=reports,
                           selected_class_id=class_id)
 
-@app.route('/api/capture_image', methods=['POST'])
+@bp.route('/attendance/reports/export')
+@login_required
+def export_attendance_report():
+    """Stream the student x session attendance matrix of a class as CSV"""
+    class_id = request.args.get('class_id', type=int)
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    
+    class_obj = Class.query.get(class_id) if class_id else None
+    if not class_obj or class_obj.teacher_id != current_user.id:
+        flash('Invalid class selection.', 'error')
+        return redirect(url_for('main.attendance_reports'))
+    
+    try:
+        session_filters = report_session_filters(class_id, start_date, end_date)
+    except ValueError:
+        flash('Invalid date. Please use the YYYY-MM-DD format.', 'error')
+        return redirect(url_for('main.attendance_reports', class_id=class_id))
+    
+    # Columns, oldest session first
+    sessions = (db.session.query(AttendanceSession.id, AttendanceSession.session_date, AttendanceSession.start_time)
+              .filter(*session_filters)
+              .order_by(AttendanceSession.session_date, AttendanceSession.start_time, AttendanceSession.id)
+              .all())
+    column_of = {session_id: column for column, (session_id, _, _) in enumerate(sessions)}
+    
+    # One row per (student, record); students without records still appear once. Records are
+    # limited to the sessions fetched above, so a session created meanwhile has no column to miss
+    rows = (db.session.query(Student.id, Student.student_id, Student.name,
+                             AttendanceRecord.session_id, AttendanceRecord.status)
+            .outerjoin(AttendanceRecord, (AttendanceRecord.student_id == Student.id)
+                       & AttendanceRecord.session_id.in_(list(column_of)))
+            .filter(Student.class_id == class_id)
+            .order_by(Student.name, Student.id)
+            .execution_options(yield_per=1000))
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        
+        def flush():
+            line = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return line
+        
+        writer.writerow(['Student ID', 'Name']
+                        + [f"{session_date.isoformat()} {start_time.strftime('%H:%M')}" for _, session_date, start_time in sessions]
+                        + ['Present', 'Attendance Rate'])
+        yield flush()
+        
+        def student_row(student_id, name, statuses):
+            present = statuses.count('present')
+            rate = round(present / len(sessions) * 100, 1) if sessions else 0
+            writer.writerow([student_id, name] + statuses + [present, rate])
+            return flush()
+        
+        current = None
+        statuses = None
+        for id_, student_id, name, session_id, status in rows:
+            if current is None or current[0] != id_:
+                if current is not None:
+                    yield student_row(current[1], current[2], statuses)
+                current = (id_, student_id, name)
+                statuses = [''] * len(sessions)
+            if session_id is not None:
+                statuses[column_of[session_id]] = status
+        
+        if current is not None:
+            yield student_row(current[1], current[2], statuses)
+    
+    filename = secure_filename(f"attendance_{class_obj.name}_{start_date or 'all'}_{end_date or 'all'}.csv")
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@bp.route('/api/identify', methods=['POST'])
+@login_required
+def identify_students():
+    """
+    Identify the faces in a photo: against the students of the teacher's own
+    classes, or against every registered student for administrators.
+    """
+    from face_recognition_service import detect_faces_in_image
+    from face_index import identify_faces
+    
+    if 'photo' not in request.files or not request.files['photo'].filename:
+        return jsonify({'success': False, 'message': 'No photo provided'})
+    
+    try:
+        allowed_ids = None
+        if current_user.role != 'admin':
+            allowed_ids = [student_id for student_id, in (db.session.query(Student.id)
+                                                         .join(Class)
+                                                         .filter(Class.teacher_id == current_user.id))]
+        
+        face_locations, face_encodings = detect_faces_in_image(read_upload(request.files['photo']))
+        matches = identify_faces(face_encodings, allowed_ids=allowed_ids)
+        
+        matched_ids = [student_id for student_id, _ in matches if student_id is not None]
+        students = {student.id: student for student in Student.query.filter(Student.id.in_(matched_ids)).all()} if matched_ids else {}
+        
+        faces = []
+        for location, (student_id, confidence) in zip(face_locations, matches):
+            student = students.get(student_id)
+            faces.append({
+                'location': list(location),
+                'student': {
+                    'id': student.id,
+                    'name': student.name,
+                    'student_id': student.student_id,
+                    'class_id': student.class_id
+                } if student else None,
+                'confidence': round(confidence, 3)
+            })
+        
+        return jsonify({'success': True, 'faces': faces})
+    
+    except Exception as e:
+        logger.error(f"Error in identify API: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+@bp.route('/api/capture_image', methods=['POST'])
 @login_required
 def capture_image():
-    if 'image_data' not in request.json:
-        return jsonify({'success': False, 'message': 'No image data provided'})
+    """
+    Take attendance from a camera frame.
+    
+    Accepts either a raw image body (image/* or application/octet-stream, with
+    class_id in the query string) or a multipart form with one or more 'image'
+    files (photos of different parts of the room) and a 'class_id' field.
+    """
+    from attendance_pipeline import start_attendance
     
     try:
-        # Get base64 image data
-        image_data = request.json['image_data']
-        class_id = request.json.get('class_id')
+        if request.mimetype == 'multipart/form-data':
+            class_id = request.form.get('class_id', type=int)
+            image_data = [data for data in map(read_upload, request.files.getlist('image')) if len(data)]
+            if len(image_data) > current_app.config["ATTENDANCE_MAX_PHOTOS"]:
+                return jsonify({'success': False, 'message': f'At most {current_app.config["ATTENDANCE_MAX_PHOTOS"]} images are allowed'})
+        elif request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+            class_id = request.args.get('class_id', type=int)
+            # Read the body straight from the stream into a single buffer
+            image_data = read_upload(request.stream, request.content_length)
+        else:
+            return jsonify({'success': False, 'message': 'Unsupported content type'}), 415
+        
+        if not image_data:
+            return jsonify({'success': False, 'message': 'No image data provided'})
         
         # Validate class_id
         if not class_id:
@@ -530,27 +821,229 @@ def capture_image():
         if not class_obj or class_obj.teacher_id != current_user.id:
             return jsonify({'success': False, 'message': 'Invalid class selection'})
         
-        # Process the image...
-        # This would involve:
-        # 1. Convert base64 to image
-        # 2. Upload to S3
-        # 3. Process attendance similar to take_attendance route
+        new_session, created = start_attendance(class_obj, image_data, idempotency_key())
+        if new_session is None:
+            return jsonify({'success': False, 'message': 'The server is busy processing other attendance photos. Please try again shortly.'})
         
-        # Since this is complex and would duplicate code, we'll return a placeholder response
         return jsonify({
-            'success': True, 
-            'message': 'Image captured successfully. Processing...',
-            'redirect': url_for('take_attendance')
+            'success': True,
+            'duplicate': not created,
+            'message': 'Image captured successfully. Processing...' if created else 'Image already submitted.',
+            'session_id': new_session.id,
+            'status_url': url_for('main.attendance_status', session_id=new_session.id),
+            'redirect': url_for('main.view_attendance', session_id=new_session.id)
         })
     
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error in capture_image API: {str(e)}")
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
 
-@app.errorhandler(404)
+def stream_response(progress):
+    """JSON for an attendance stream's progress, with where to go once it is done"""
+    response = dict(progress, success=True)
+    response['redirect'] = url_for('main.view_attendance', session_id=progress['session_id'])
+    return jsonify(response)
+
+def owned_stream(session_id):
+    """The open stream of a session the current teacher owns, or None"""
+    from attendance_stream import get_stream
+    
+    stream = get_stream(session_id)
+    if stream is None:
+        return None
+    class_obj = Class.query.get(stream.class_id)
+    return stream if class_obj and class_obj.teacher_id == current_user.id else None
+
+def closed_stream_response(session_id, **response):
+    """Response for a session without an open stream in this process"""
+    attendance_session = AttendanceSession.query.get_or_404(session_id)
+    if attendance_session.class_obj.teacher_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Invalid attendance session'}), 403
+    
+    if attendance_session.status == 'processing':
+        # Streams are kept by the process that started them; with several workers the
+        # load balancer must send all of a stream's requests to the same one
+        logger.warning(f"Request for attendance stream {session_id}, which is not open in this process")
+        return jsonify({'success': False, 'session_id': session_id,
+                        'message': 'This scan is not open on this server. Please start it again.'}), 409
+    
+    # Finished streams just report that they are done
+    response.update({'success': True, 'done': True, 'session_id': session_id,
+                     'redirect': url_for('main.view_attendance', session_id=session_id)})
+    return jsonify(response)
+
+@bp.route('/api/attendance/stream', methods=['POST'])
+@login_required
+def start_attendance_stream():
+    """
+    Start taking attendance from a stream of camera frames.
+    
+    Frames are then posted one at a time to frame_url until the response says
+    'done' (everyone found, or the time budget is spent), or finish_url is
+    called to stop early.
+    """
+    from attendance_stream import start_stream
+    
+    class_id = request.values.get('class_id', type=int)
+    class_obj = Class.query.get(class_id) if class_id else None
+    if not class_obj or class_obj.teacher_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Invalid class selection'})
+    
+    try:
+        stream = start_stream(class_obj)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error starting attendance stream: {str(e)}")
+        return jsonify({'success': False, 'message': 'An error occurred while starting attendance.'})
+    
+    response = dict(stream.progress(), success=True)
+    response.update({
+        'frame_url': url_for('main.attendance_stream_frame', session_id=stream.session_id),
+        'finish_url': url_for('main.finish_attendance_stream', session_id=stream.session_id),
+        'frame_interval': current_app.config["ATTENDANCE_STREAM_FRAME_INTERVAL"],
+        'redirect': url_for('main.view_attendance', session_id=stream.session_id)
+    })
+    return jsonify(response)
+
+@bp.route('/api/attendance/stream/<int:session_id>/frame', methods=['POST'])
+@login_required
+def attendance_stream_frame(session_id):
+    """Process one camera frame (raw image body) of an attendance stream"""
+    from attendance_stream import add_stream_frame
+    
+    stream = owned_stream(session_id)
+    if stream is None:
+        return closed_stream_response(session_id, processed=False)
+    
+    frame = read_upload(request.stream, request.content_length)
+    if not frame:
+        return jsonify({'success': False, 'message': 'No image data provided'})
+    
+    try:
+        return stream_response(add_stream_frame(stream, frame))
+    except Exception as e:
+        # The stream is closed and its session marked failed
+        db.session.rollback()
+        logger.error(f"Error processing attendance stream frame: {str(e)}")
+        return jsonify({'success': False, 'message': 'An error occurred while processing the frame.'})
+
+@bp.route('/api/attendance/stream/<int:session_id>/finish', methods=['POST'])
+@login_required
+def finish_attendance_stream(session_id):
+    from attendance_stream import finish_stream
+    
+    stream = owned_stream(session_id)
+    if stream is None:
+        return closed_stream_response(session_id)
+    
+    return stream_response(finish_stream(stream))
+
+@bp.route('/api/attendance/clip', methods=['POST'])
+@login_required
+def attendance_clip():
+    """
+    Take attendance from a short clip, as a raw body (with class_id in the query
+    string) or a multipart 'clip' file with a 'class_id' field.
+    """
+    from attendance_stream import process_clip
+    
+    if request.mimetype == 'multipart/form-data':
+        clip = request.files.get('clip')
+        clip_data = read_upload(clip) if clip else b''
+    else:
+        clip_data = read_upload(request.stream, request.content_length)
+    
+    class_id = request.values.get('class_id', type=int)
+    class_obj = Class.query.get(class_id) if class_id else None
+    if not class_obj or class_obj.teacher_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Invalid class selection'})
+    
+    if not clip_data:
+        return jsonify({'success': False, 'message': 'No clip provided'})
+    
+    try:
+        return stream_response(process_clip(class_obj, clip_data))
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error processing attendance clip: {str(e)}")
+        return jsonify({'success': False, 'message': 'The clip could not be read. Use an animated WebP, GIF or PNG.'})
+
+@bp.route('/files/<path:key>')
+def stored_file(key):
+    """Serve a file from local storage through a signed, expiring URL (see LocalStorageBackend.url)"""
+    storage = get_storage()
+    expires = request.args.get('expires', type=int)
+    
+    if (not isinstance(storage, LocalStorageBackend) or expires is None
+            or not storage.verify_signature(key, expires, request.args.get('signature', ''))):
+        abort(403)
+    
+    info = storage.head(key)
+    if info is None:
+        abort(404)
+    
+    return send_file(storage.open(key), mimetype=info.content_type, etag=info.etag,
+                     last_modified=info.uploaded_at, conditional=True)
+
+@bp.route('/images/<size>/<path:path>')
+@login_required
+def image_derivative(size, path):
+    """Serve a resized copy of a stored image, generating it on first request (see image_derivatives)"""
+    if size not in DERIVATIVE_SIZES:
+        abort(404)
+    if not verify_derivative_signature(path, size, request.args.get('signature', '')):
+        abort(403)
+    
+    info = get_derivative_info(path, size)
+    if info is None:
+        abort(404)
+    
+    # Derivatives of a path never change, so browsers may keep them and revalidate with the ETag
+    if request.if_none_match.contains(info.etag):
+        response = Response(status=304)
+    else:
+        response = Response(get_storage().get(derivative_path(path, size)), mimetype=info.content_type)
+    
+    response.set_etag(info.etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config["IMAGE_CACHE_MAX_AGE"]
+    return response
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+@bp.after_app_request
+def observe_request_duration(response):
+    started_at = g.get('request_started_at')
+    if started_at is not None:
+        # Labelled by endpoint rather than URL so session IDs etc. do not create new series
+        REQUEST_DURATION.observe(time.perf_counter() - started_at,
+                                 request.method, request.endpoint or 'unmatched', str(response.status_code))
+    return response
+
+def is_direct_local_request():
+    """Whether the request comes from this host itself, not through a proxy"""
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    """Metrics of this process in the Prometheus text format"""
+    token = current_app.config["METRICS_TOKEN"]
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+    elif not (current_app.debug or is_direct_local_request()):
+        # Without a token, endpoint names, traffic and SQL timings stay private
+        abort(404)
+    
+    return Response(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@bp.app_errorhandler(404)
 def page_not_found(e):
     return render_template('error.html', error="404 - Page Not Found"), 404
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def server_error(e):
     return render_template('error.html', error="500 - Internal Server Error"), 500
@@ -6,11 +6,13 @@ document.addEventListener('DOMContentLoaded', function() {
     const previewElement = document.getElementById('preview');
     const previewContainer = document.getElementById('preview-container');
     const retakeBtn = document.getElementById('retake-btn');
+    const scanBtn = document.getElementById('scan-btn');
     const classSelect = document.getElementById('class_id');
     const submitBtn = document.getElementById('submit-btn');
     const attendanceForm = document.getElementById('attendanceForm');
     const classroomPhotoInput = document.getElementById('classroom_photo');
     const processingSpinner = document.getElementById('processing-spinner');
+    const processingMessage = document.getElementById('processing-message');
     
     // Switch between camera and upload
     const cameraMethod = document.getElementById('camera-method');
@@ -23,6 +25,8 @@ document.addEventListener('DOMContentLoaded', function() {
     
     let stream = null;
     let photoTaken = false;
+    let capturedBlob = null;
+    let submissionKey = null;  // Sent as Idempotency-Key so resubmitting the same photo reuses its session
     
     // Initialize camera
     async function initCamera() {
@@ -88,6 +92,7 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Create a Blob and transfer to the file input
         canvas.toBlob(function(blob) {
+            capturedBlob = blob;
             const file = new File([blob], 'classroom_photo.jpg', { type: 'image/jpeg' });
             
             // Create a FileList-like object
@@ -98,6 +103,7 @@ document.addEventListener('DOMContentLoaded', function() {
             classroomPhotoInput.files = dataTransfer.files;
             
             photoTaken = true;
+            submissionKey = newSubmissionKey();
             updateSubmitButton();
         }, 'image/jpeg', 0.9);
     });
@@ -107,6 +113,7 @@ document.addEventListener('DOMContentLoaded', function() {
         videoContainer.style.display = 'block';
         previewContainer.style.display = 'none';
         photoTaken = false;
+        capturedBlob = null;
         classroomPhotoInput.value = '';
         updateSubmitButton();
     });
@@ -125,6 +132,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // Check if a file is already selected
             if (photoUploadInput.files.length > 0) {
                 photoTaken = true;
+                submissionKey = newSubmissionKey();
             } else {
                 photoTaken = false;
             }
@@ -140,7 +148,7 @@ document.addEventListener('DOMContentLoaded', function() {
         if (e.target.files.length > 0) {
             const file = e.target.files[0];
             
-            // Preview the uploaded image
+            // Preview the first uploaded image
             const reader = new FileReader();
             reader.onload = function(e) {
                 uploadPreview.src = e.target.result;
@@ -148,12 +156,15 @@ document.addEventListener('DOMContentLoaded', function() {
             };
             reader.readAsDataURL(file);
             
-            // Transfer the file to the hidden input
+            // Transfer the files to the hidden input (several photos can cover a large room)
             const dataTransfer = new DataTransfer();
-            dataTransfer.items.add(file);
+            for (const selected of e.target.files) {
+                dataTransfer.items.add(selected);
+            }
             classroomPhotoInput.files = dataTransfer.files;
             
             photoTaken = true;
+            submissionKey = newSubmissionKey();
             updateSubmitButton();
         } else {
             uploadPreviewContainer.style.display = 'none';
@@ -162,6 +173,14 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
     
+    // A fresh key for every new photo
+    function newSubmissionKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+    
     // Update submit button state
     function updateSubmitButton() {
         if (classSelect.value && photoTaken) {
@@ -174,9 +193,175 @@ document.addEventListener('DOMContentLoaded', function() {
     // Handle class selection
     classSelect.addEventListener('change', updateSubmitButton);
     
-    // Show loading spinner during form submission
-    attendanceForm.addEventListener('submit', function() {
+    // Show a processing message in the spinner
+    function setProcessingMessage(message) {
+        processingMessage.textContent = message;
+    }
+    
+    // Give up polling after this long; the session page shows the result once it is ready
+    const MAX_POLL_MS = 5 * 60 * 1000;
+    
+    // Poll the session status until background processing finishes
+    function pollStatus(statusUrl, startedAt = Date.now()) {
+        function pollAgain(delay, data) {
+            if (Date.now() - startedAt + delay > MAX_POLL_MS) {
+                if (data && data.redirect) {
+                    setProcessingMessage('Still processing. Opening the session page; refresh it later to see the result.');
+                    window.location.href = data.redirect;
+                } else {
+                    setProcessingMessage('Unable to check the attendance status. See the dashboard for the result.');
+                }
+                return;
+            }
+            setTimeout(() => pollStatus(statusUrl, startedAt), delay);
+        }
+        
+        fetch(statusUrl, { headers: { 'Accept': 'application/json' } })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message || 'Unable to check attendance status');
+                }
+                
+                if (data.status === 'processing') {
+                    pollAgain(1000, data);
+                    return;
+                }
+                
+                if (data.status === 'completed') {
+                    setProcessingMessage(`Done. Detected ${data.present_count} of ${data.total_count} students.`);
+                } else {
+                    setProcessingMessage('Processing failed.');
+                }
+                window.location.href = data.redirect;
+            })
+            .catch(err => {
+                console.error('Error polling attendance status:', err);
+                pollAgain(3000);
+            });
+    }
+    
+    // Grab the current camera frame as a JPEG blob
+    function grabFrame() {
+        return new Promise(resolve => {
+            const canvas = document.createElement('canvas');
+            canvas.width = videoElement.videoWidth;
+            canvas.height = videoElement.videoHeight;
+            canvas.getContext('2d').drawImage(videoElement, 0, 0, canvas.width, canvas.height);
+            canvas.toBlob(resolve, 'image/jpeg', 0.85);
+        });
+    }
+    
+    // Send frames until the server has recognized everyone or its time budget is spent
+    function streamFrames(attendanceStream) {
+        const interval = Math.max(attendanceStream.frame_interval * 1000, 250);
+        
+        function sendNextFrame() {
+            const started = Date.now();
+            grabFrame()
+                .then(blob => fetch(attendanceStream.frame_url, {
+                    method: 'POST',
+                    body: blob,
+                    headers: { 'Content-Type': 'image/jpeg', 'Accept': 'application/json' }
+                }))
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) {
+                        throw new Error(data.message || 'Unable to process frame');
+                    }
+                    
+                    setProcessingMessage(`Scanning... recognized ${data.matched_count} of ${data.total_count} students.`);
+                    if (data.done) {
+                        window.location.href = data.redirect;
+                        return;
+                    }
+                    setTimeout(sendNextFrame, Math.max(0, interval - (Date.now() - started)));
+                })
+                .catch(err => {
+                    // Keep whatever was recognized so far
+                    console.error('Error streaming frames:', err);
+                    fetch(attendanceStream.finish_url, { method: 'POST', headers: { 'Accept': 'application/json' } })
+                        .finally(() => { window.location.href = attendanceStream.redirect; });
+                });
+        }
+        
+        sendNextFrame();
+    }
+    
+    // Scan the classroom with a stream of frames instead of a single photo
+    scanBtn.addEventListener('click', function() {
+        if (!videoElement.srcObject) {
+            alert('Camera is not available. Please try the upload option.');
+            return;
+        }
+        if (!classSelect.value) {
+            alert('Please select a class first.');
+            return;
+        }
+        
+        processingSpinner.style.display = 'flex';
+        setProcessingMessage('Starting scan...');
+        
+        const body = new FormData();
+        body.append('class_id', classSelect.value);
+        
+        fetch(attendanceForm.dataset.streamUrl, { method: 'POST', body: body, headers: { 'Accept': 'application/json' } })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    processingSpinner.style.display = 'none';
+                    alert(data.message);
+                    return;
+                }
+                streamFrames(data);
+            })
+            .catch(err => {
+                console.error('Error starting scan:', err);
+                processingSpinner.style.display = 'none';
+                alert('Error starting the scan. Please try again.');
+            });
+    });
+    
+    // Submit in the background and poll for progress
+    attendanceForm.addEventListener('submit', function(e) {
+        e.preventDefault();
         processingSpinner.style.display = 'flex';
+        setProcessingMessage('Uploading photo...');
+        
+        let request;
+        if (cameraMethod.checked && capturedBlob) {
+            // Send the camera frame as raw JPEG bytes
+            const captureUrl = `${attendanceForm.dataset.captureUrl}?class_id=${encodeURIComponent(classSelect.value)}`;
+            request = fetch(captureUrl, {
+                method: 'POST',
+                body: capturedBlob,
+                headers: { 'Content-Type': 'image/jpeg', 'Accept': 'application/json', 'Idempotency-Key': submissionKey }
+            });
+        } else {
+            request = fetch(attendanceForm.action, {
+                method: 'POST',
+                body: new FormData(attendanceForm),
+                headers: { 'Accept': 'application/json', 'Idempotency-Key': submissionKey }
+            });
+        }
+        
+        request
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    processingSpinner.style.display = 'none';
+                    alert(data.message);
+                    return;
+                }
+                
+                setProcessingMessage('Analyzing faces and marking attendance...');
+                pollStatus(data.status_url);
+            })
+            .catch(err => {
+                console.error('Error submitting attendance:', err);
+                processingSpinner.style.display = 'none';
+                alert('Error submitting attendance. Please try again.');
+            });
     });
     
     // Initialize
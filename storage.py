@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import hmac
+import bisect
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, url_for
+
+from utils import BufferReader
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Metadata of a stored file
+#   key:          path of the file within the store (e.g. 'student_photos/abc.jpg')
+#   size:         size in bytes
+#   content_type: MIME type given when the file was stored
+#   uploaded_at:  Unix timestamp of the upload
+#   etag:         opaque identifier that changes whenever the content does
+StoredFile = namedtuple('StoredFile', ['key', 'size', 'content_type', 'uploaded_at', 'etag'])
+
+# Bytes copied per read when streaming a file to disk
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class KeyIndex:
+    """Sorted, thread-safe set of keys, so prefix listing costs O(log n + matches)"""
+
+    def __init__(self, keys=()):
+        self._keys = sorted(set(keys))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        with self._lock:
+            position = bisect.bisect_left(self._keys, key)
+            return position < len(self._keys) and self._keys[position] == key
+
+    def add(self, key):
+        with self._lock:
+            position = bisect.bisect_left(self._keys, key)
+            if position == len(self._keys) or self._keys[position] != key:
+                self._keys.insert(position, key)
+
+    def discard(self, key):
+        with self._lock:
+            position = bisect.bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+
+    def with_prefix(self, prefix=''):
+        """Keys starting with prefix, in sorted order"""
+        with self._lock:
+            # All keys with the prefix form one contiguous run starting here
+            position = bisect.bisect_left(self._keys, prefix)
+            matches = []
+            while position < len(self._keys) and self._keys[position].startswith(prefix):
+                matches.append(self._keys[position])
+                position += 1
+            return matches
+
+
+class StorageBackend:
+    """
+    Interface of a file store.
+
+    Keys are '/'-separated paths such as 'classroom_photos/12_class_3.jpg'.
+    Methods raise on failure; aws_service turns errors into the
+    (success, message) results the rest of the application expects.
+    """
+
+    def put(self, key, file_obj, content_type='application/octet-stream'):
+        """Store the contents of a binary file object under key, replacing any existing file"""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Return the contents of a file as bytes; raises KeyError if it does not exist"""
+        raise NotImplementedError
+
+    def head(self, key):
+        """Return the StoredFile metadata of a file, or None if it does not exist"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete a file; returns False if it did not exist"""
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        """Return the keys starting with prefix, in sorted order"""
+        raise NotImplementedError
+
+    def url(self, key, expiration=3600):
+        """Return a URL granting read access to a file for expiration seconds"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.head(key) is not None
+
+    def put_many(self, files, max_workers=8):
+        """
+        Store several files concurrently.
+
+        Args:
+            files: Iterable of (key, file_obj, content_type) tuples
+            max_workers: Maximum number of concurrent uploads
+
+        Returns:
+            dict: key -> None on success or the exception raised for that file
+        """
+        def put(item):
+            key, file_obj, content_type = item
+            try:
+                self.put(key, file_obj, content_type)
+                return key, None
+            except Exception as e:
+                return key, e
+
+        files = list(files)
+        if len(files) <= 1:
+            return dict(put(item) for item in files)
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage') as pool:
+            return dict(pool.map(put, files))
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Files on local disk.
+
+    Each file is stored under a hash of its key, sharded into two levels of
+    directories (root/ab/cd/abcd...) so no directory grows too large, with a
+    small JSON metadata file next to it. Writes go to a temporary file that is
+    renamed into place, so readers never see a partial file.
+    """
+
+    def __init__(self, root, secret_key):
+        self.root = root
+        self._secret_key = secret_key.encode() if isinstance(secret_key, str) else secret_key
+        self._index = None
+        self._index_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _get_index(self):
+        with self._index_lock:
+            if self._index is None:
+                # Rebuilt from the metadata files once per process
+                keys = []
+                for directory, _, filenames in os.walk(self.root):
+                    for filename in filenames:
+                        if filename.endswith('.json') and not filename.startswith('.'):
+                            try:
+                                with open(os.path.join(directory, filename)) as f:
+                                    keys.append(json.load(f)['key'])
+                            except (OSError, ValueError, KeyError) as e:
+                                logger.warning(f"Skipping unreadable storage metadata {filename}: {str(e)}")
+                self._index = KeyIndex(keys)
+                logger.info(f"Indexed {len(self._index)} stored files under {self.root}")
+            return self._index
+
+    def _write_atomic(self, path, chunks):
+        directory = os.path.dirname(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def put(self, key, file_obj, content_type='application/octet-stream'):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        size = 0
+        digest = hashlib.md5(usedforsecurity=False)
+
+        def chunks():
+            nonlocal size
+            while True:
+                chunk = file_obj.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                digest.update(chunk)
+                yield chunk
+
+        self._write_atomic(path, chunks())
+
+        metadata = {
+            'key': key,
+            'size': size,
+            'content_type': content_type,
+            'uploaded_at': time.time(),
+            'etag': digest.hexdigest(),
+        }
+        self._write_atomic(path + '.json', [json.dumps(metadata).encode('utf-8')])
+
+        if self._index is not None:
+            self._index.add(key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def open(self, key):
+        """Open a stored file for reading; raises KeyError if it does not exist"""
+        try:
+            return open(self._path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def head(self, key):
+        try:
+            with open(self._path(key) + '.json') as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return None
+        return StoredFile(metadata['key'], metadata['size'], metadata['content_type'],
+                          metadata['uploaded_at'], metadata['etag'])
+
+    def exists(self, key):
+        return os.path.exists(self._path(key) + '.json')
+
+    def delete(self, key):
+        path = self._path(key)
+        try:
+            # Metadata first: a file without metadata is invisible to head() and list()
+            os.remove(path + '.json')
+        except FileNotFoundError:
+            return False
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        if self._index is not None:
+            self._index.discard(key)
+        return True
+
+    def list(self, prefix=''):
+        return self._get_index().with_prefix(prefix)
+
+    def signature(self, key, expires):
+        """HMAC that lets stored_file serve key until the Unix time expires"""
+        return hmac.new(self._secret_key, f'{key}\n{expires}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def verify_signature(self, key, expires, signature):
+        """Whether a URL signature for key is genuine and has not expired"""
+        return expires >= time.time() and hmac.compare_digest(signature, self.signature(key, expires))
+
+    def url(self, key, expiration=3600):
+        if not self.exists(key):
+            return None
+        expires = int(time.time()) + expiration
+        return url_for('main.stored_file', key=key, expires=expires, signature=self.signature(key, expires))
+
+
+class S3StorageBackend(StorageBackend):
+    """
+    Files in an S3 bucket or an S3-compatible service (MinIO, Ceph, ...).
+
+    One client, and with it one connection pool, is shared by all threads.
+    Large files are uploaded in parallel multipart chunks.
+    """
+
+    def __init__(self, bucket, region=None, access_key=None, secret_key=None, endpoint_url=None,
+                 max_pool_connections=16, multipart_threshold=8 * 1024 * 1024):
+        try:
+            import boto3
+            from botocore.config import Config
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError("The S3 storage backend requires boto3 (pip install boto3)")
+
+        self.bucket = bucket
+        self._client = boto3.session.Session().client(
+            's3',
+            region_name=region or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+            endpoint_url=endpoint_url or None,
+            config=Config(max_pool_connections=max_pool_connections,
+                          retries={'max_attempts': 3, 'mode': 'standard'})
+        )
+        self._transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                               multipart_chunksize=multipart_threshold,
+                                               max_concurrency=max(1, max_pool_connections // 2))
+
+    def _is_missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def put(self, key, file_obj, content_type='application/octet-stream'):
+        self._client.upload_fileobj(file_obj, self.bucket, key,
+                                    ExtraArgs={'ContentType': content_type},
+                                    Config=self._transfer_config)
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self._client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except ClientError as e:
+            if self._is_missing(e):
+                raise KeyError(key)
+            raise
+
+    def head(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            response = self._client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return StoredFile(key, response['ContentLength'], response.get('ContentType'),
+                          response['LastModified'].timestamp(), response['ETag'].strip('"'))
+
+    def delete(self, key):
+        # S3 deletes are idempotent and do not report whether the key existed
+        self._client.delete_object(Bucket=self.bucket, Key=key)
+        return True
+
+    def list(self, prefix=''):
+        # S3 lists keys in sorted order and filters by prefix on the server
+        keys = []
+        for page in self._client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+        return keys
+
+    def url(self, key, expiration=3600):
+        return self._client.generate_presigned_url('get_object',
+                                                   Params={'Bucket': self.bucket, 'Key': key},
+                                                   ExpiresIn=expiration)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_storage():
+    """Get the storage backend configured for the current app"""
+    config = current_app.config
+    backend = config["STORAGE_BACKEND"]
+
+    if backend == 'local':
+        key = (backend, config["STORAGE_ROOT"])
+    elif backend == 's3':
+        key = (backend, config["S3_ENDPOINT_URL"], config["S3_BUCKET"])
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+    with _backends_lock:
+        if key not in _backends:
+            if backend == 'local':
+                _backends[key] = LocalStorageBackend(config["STORAGE_ROOT"], current_app.secret_key)
+            else:
+                _backends[key] = S3StorageBackend(
+                    config["S3_BUCKET"],
+                    region=config["AWS_REGION"],
+                    access_key=config["AWS_ACCESS_KEY"],
+                    secret_key=config["AWS_SECRET_KEY"],
+                    endpoint_url=config["S3_ENDPOINT_URL"],
+                    max_pool_connections=config["S3_MAX_POOL_CONNECTIONS"],
+                    multipart_threshold=config["S3_MULTIPART_THRESHOLD"]
+                )
+            logger.info(f"Using {backend} storage backend")
+        return _backends[key]
+
+
+def as_file(file_obj):
+    """Wrap bytes-like buffers in a reader and rewind file objects, without copying"""
+    if isinstance(file_obj, (bytes, bytearray, memoryview)):
+        return BufferReader(file_obj)
+    file_obj.seek(0)
+    return file_obj
@@ -0,0 +1,208 @@
+import os
+import csv
+import logging
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import insert
+from flask import current_app
+
+from app import db
+from models import Student
+from face_recognition_service import encode_face_bytes
+from recognition_backends import configure_recognition_backend
+from aws_service import upload_files, delete_file
+from encoding_cache import invalidate_class_encodings
+from face_index import get_face_index_store
+from utils import generate_filename, pack_face_encoding
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Below this many photos, starting worker processes costs more than it saves
+MIN_PHOTOS_FOR_PROCESS_POOL = 8
+
+
+def import_students(class_obj, roster_file, photos_file=None):
+    """
+    Enroll a roster of students, with optional photos, into a class.
+
+    The roster is a CSV with 'name' and 'student_id' columns and optional
+    'email' and 'photo' columns, where 'photo' is the path of an image inside
+    the zip archive (or just its file name, if no other file has that name).
+    Rows with errors are skipped; all other rows are inserted together.
+
+    Args:
+        class_obj: Class to enroll the students in
+        roster_file: FileStorage or file-like object holding the CSV roster
+        photos_file: Optional FileStorage or file-like object holding a zip of photos
+
+    Returns:
+        list: One dict per roster row with 'row', 'student_id', 'name', 'status'
+              ('imported' or 'error') and 'message'
+    """
+    results = []
+    pending = []  # (result, row) pairs still on track to be imported
+
+    # 1. Parse and validate the roster
+    lines = roster_file.read().decode('utf-8-sig').splitlines()
+    seen_ids = set()
+
+    for line_number, raw_row in enumerate(csv.DictReader(lines), start=2):
+        row = {key.strip().lower(): (value or '').strip() for key, value in raw_row.items() if key}
+        result = {
+            'row': line_number,
+            'student_id': row.get('student_id', ''),
+            'name': row.get('name', ''),
+            'status': 'error',
+            'message': ''
+        }
+        results.append(result)
+
+        if not result['name'] or not result['student_id']:
+            result['message'] = 'Name and student ID are required.'
+        elif result['student_id'] in seen_ids:
+            result['message'] = 'Duplicate student ID in roster.'
+        else:
+            seen_ids.add(result['student_id'])
+            pending.append((result, row))
+
+    # 2. Check student ID uniqueness against the database in one query
+    if seen_ids:
+        existing_ids = {student_id for (student_id,) in
+                        db.session.query(Student.student_id).filter(Student.student_id.in_(seen_ids))}
+        pending = _reject(pending, lambda result, row: result['student_id'] in existing_ids,
+                          'A student with this ID already exists.')
+
+    # 3. Pull the photos out of the archive
+    photos = {}  # student_id -> image bytes
+    photo_bytes = 0
+    archive = zipfile.ZipFile(photos_file) if photos_file else None
+    try:
+        members = {}  # path in the archive -> ZipInfo
+        members_by_name = {}  # file name -> ZipInfos of every member with that name
+        if archive is not None:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    members[info.filename] = info
+                    members_by_name.setdefault(os.path.basename(info.filename), []).append(info)
+
+        for result, row in pending:
+            if not row.get('photo'):
+                continue
+            photo = row['photo'].replace('\\', '/').removeprefix('./')
+            info = members.get(photo)
+            candidates = members_by_name.get(photo, []) if info is None else [info]
+            if len(candidates) > 1:
+                # Photos with the same name in different folders must not be silently mixed up
+                result['message'] = 'Several photos in the archive have this name; give its path in the archive.'
+                continue
+            info = candidates[0] if candidates else None
+            if info is None:
+                result['message'] = 'Photo not found in archive.'
+            elif info.file_size > current_app.config["MAX_CONTENT_LENGTH"]:
+                result['message'] = 'Photo is too large.'
+            elif photo_bytes + info.file_size > current_app.config["BULK_IMPORT_MAX_BYTES"]:
+                # A small, highly compressed archive can expand to far more than was uploaded
+                result['message'] = 'The photos in this import exceed the total size limit; import the rest separately.'
+            else:
+                photo_bytes += info.file_size
+                photos[result['student_id']] = archive.read(info)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    pending = _reject(pending, lambda result, row: result['message'], None)
+
+    # 4. Encode faces across worker processes
+    photo_ids = [result['student_id'] for result, _ in pending if result['student_id'] in photos]
+    encodings = dict(zip(photo_ids, _encode_photos([photos[student_id] for student_id in photo_ids])))
+    pending = _reject(pending, lambda result, row: result['student_id'] in encodings and encodings[result['student_id']] is None,
+                      'No face detected in the photo.')
+
+    # 5. Upload photos concurrently
+    photo_paths = {
+        result['student_id']: f"student_photos/{generate_filename(result['student_id'], 'jpg')}"
+        for result, _ in pending if result['student_id'] in photos
+    }
+    uploaded = _upload_photos({photo_paths[student_id]: photos[student_id] for student_id in photo_paths})
+    pending = _reject(pending, lambda result, row: result['student_id'] in photo_paths and not uploaded[photo_paths[result['student_id']]],
+                      'Error uploading photo.')
+
+    # 6. Insert all remaining students at once
+    if pending:
+        values = [{
+            'name': result['name'],
+            'student_id': result['student_id'],
+            'email': row.get('email', ''),
+            'class_id': class_obj.id,
+            'face_encoding_data': pack_face_encoding(encodings[result['student_id']]) if result['student_id'] in encodings else None,
+            'face_image_path': photo_paths.get(result['student_id'])
+        } for result, row in pending]
+
+        try:
+            ids = db.session.scalars(insert(Student).returning(Student.id, sort_by_parameter_order=True), values).all()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error bulk inserting students: {str(e)}")
+            # No student refers to the photos just uploaded
+            _delete_photos([path for path, success in uploaded.items() if success])
+            for result, _ in pending:
+                result['message'] = 'An error occurred while saving the student.'
+            return results
+
+        for result, _ in pending:
+            result['status'] = 'imported'
+
+        invalidate_class_encodings(class_obj.id)
+
+        # The students are saved; a failed index update only delays cross-class identification
+        indexed = [(student_id, encodings[result['student_id']])
+                   for student_id, (result, _) in zip(ids, pending) if result['student_id'] in encodings]
+        if indexed:
+            try:
+                get_face_index_store().add_many(*zip(*indexed))
+            except Exception as e:
+                logger.error(f"Error updating face index: {str(e)}")
+
+    logger.info(f"Imported {len(pending)} of {len(results)} roster rows into class {class_obj.id}")
+    return results
+
+
+def _reject(pending, predicate, message):
+    """Drop the pending rows matching predicate, recording message on them if given"""
+    remaining = []
+    for result, row in pending:
+        if predicate(result, row):
+            if message:
+                result['message'] = message
+        else:
+            remaining.append((result, row))
+    return remaining
+
+
+def _encode_photos(photos):
+    if len(photos) < MIN_PHOTOS_FOR_PROCESS_POOL or current_app.config["BULK_IMPORT_PROCESSES"] <= 1:
+        return [encode_face_bytes(photo) for photo in photos]
+
+    # Spawned workers only import the recognition module, not the running web app,
+    # so they are told which recognition backend to use
+    with ProcessPoolExecutor(max_workers=current_app.config["BULK_IMPORT_PROCESSES"],
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=configure_recognition_backend,
+                             initargs=(current_app.config["RECOGNITION_BACKEND"], current_app.config["RECOGNITION_SEED"])) as pool:
+        return list(pool.map(encode_face_bytes, photos, chunksize=4))
+
+
+def _upload_photos(photos):
+    results = upload_files({path: (data, 'image/jpeg') for path, data in photos.items()},
+                           max_workers=current_app.config["BULK_IMPORT_UPLOAD_THREADS"])
+    return {path: success for path, (success, _) in results.items()}
+
+
+def _delete_photos(paths):
+    # Only after a failed insert, so not worth a thread pool (which would need the app context too)
+    deleted = sum(delete_file(path) for path in paths)
+    logger.info(f"Deleted {deleted} of {len(paths)} uploaded photos")
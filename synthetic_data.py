@@ -0,0 +1,215 @@
+import io
+import logging
+from datetime import datetime, date, time, timedelta
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from flask import current_app
+
+from app import db
+from models import User, Class, Student, AttendanceSession, AttendanceRecord
+from recognition_backends import ENCODING_DIMENSION, SyntheticRecognitionBackend, get_recognition_backend
+from encoding_cache import invalidate_class_encodings
+from attendance_rollups import rebuild_rollups
+from utils import pack_face_encoding
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Generated teachers are synthetic-teacher-0, synthetic-teacher-1, ... with this password
+SYNTHETIC_USERNAME = 'synthetic-teacher-{}'
+SYNTHETIC_PASSWORD = 'synthetic'
+
+# Generated student IDs; the number is also the student's synthetic face identity
+SYNTHETIC_STUDENT_ID = 'SYN-{:07d}'
+
+# Rows sent per INSERT batch
+INSERT_CHUNK_SIZE = 20000
+
+
+def synthetic_backend():
+    """The synthetic recognition backend the app uses, or one with the app's seed"""
+    backend = get_recognition_backend()
+    if isinstance(backend, SyntheticRecognitionBackend):
+        return backend
+    return SyntheticRecognitionBackend(seed=current_app.config["RECOGNITION_SEED"])
+
+
+def student_identity(student_id):
+    """Synthetic face identity of a generated student, from its student ID (e.g. 'SYN-0000042' -> 42)"""
+    return int(student_id.split('-', 1)[1])
+
+
+def classroom_photo(identities, width=1600, height=1200, seed=0):
+    """
+    A JPEG classroom photo showing the given synthetic identities.
+
+    The pixels are smooth gradients plus noise (so decoding costs what a
+    real photo does) and the identities are named in the JPEG comment read
+    by the synthetic recognition backend. Different seeds give different
+    photos, so repeated submissions are not deduplicated.
+
+    Args:
+        identities: Synthetic face identities in the photo
+        width: Width in pixels
+        height: Height in pixels
+        seed: Seed of the pixel noise
+
+    Returns:
+        bytes: The encoded JPEG
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width * 200, y / height * 200, (x + y) / (width + height) * 255], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, size=base.shape), 0, 255).astype(np.uint8)
+
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, 'JPEG', quality=90,
+                                 comment=f"synthetic_faces={','.join(str(int(identity)) for identity in identities)}")
+    return output.getvalue()
+
+
+def generate_dataset(teachers=50, classes=500, students=50000, days=730, sessions_per_week=2,
+                     seed=0, progress=None):
+    """
+    Fill the database with synthetic teachers, classes, students and attendance history.
+
+    Students are spread evenly over the classes and get face encodings of
+    the synthetic recognition backend, so classroom_photo() photos of them
+    are recognized. Every class meets on sessions_per_week fixed weekdays
+    over the last `days` days; each student has their own attendance rate.
+    The rollup tables are rebuilt at the end. Everything is derived from
+    seed, so the same arguments always give the same data.
+
+    Args:
+        teachers: Number of teachers
+        classes: Number of classes, assigned to teachers round-robin
+        students: Number of students
+        days: Days of attendance history, ending yesterday
+        sessions_per_week: Sessions per class per week (at most 5)
+        seed: Random seed
+        progress: Optional callable receiving progress messages
+
+    Returns:
+        dict: Number of rows generated per table
+    """
+    progress = progress or logger.info
+    rng = np.random.default_rng(seed)
+
+    if User.query.filter_by(username=SYNTHETIC_USERNAME.format(0)).first() is not None:
+        raise ValueError("The database already contains synthetic data; use an empty database")
+
+    # 1. Teachers share one password hash; hashing is deliberately slow
+    password_hash = generate_password_hash(SYNTHETIC_PASSWORD)
+    teacher_ids = db.session.scalars(
+        insert(User).returning(User.id, sort_by_parameter_order=True),
+        [{'username': SYNTHETIC_USERNAME.format(index),
+          'email': f'synthetic-teacher-{index}@example.com',
+          'password_hash': password_hash,
+          'role': 'teacher'} for index in range(teachers)]
+    ).all()
+
+    # 2. Classes
+    class_ids = db.session.scalars(
+        insert(Class).returning(Class.id, sort_by_parameter_order=True),
+        [{'name': f'Synthetic class {index}',
+          'description': 'Generated for benchmarking',
+          'teacher_id': teacher_ids[index % teachers]} for index in range(classes)]
+    ).all()
+    db.session.commit()
+    progress(f'Generated {teachers} teachers and {classes} classes')
+
+    # 3. Students with synthetic face encodings
+    backend = synthetic_backend()
+    student_class = rng.permutation(np.arange(students) % classes)
+    class_students = [[] for _ in range(classes)]
+    student_rates = {}
+
+    for start in range(0, students, INSERT_CHUNK_SIZE):
+        identities = np.arange(start, min(start + INSERT_CHUNK_SIZE, students))
+        encodings = backend.identity_encodings(identities) + rng.normal(
+            0, backend.NOISE_SCALE, (len(identities), ENCODING_DIMENSION)).astype(np.float32)
+
+        ids = db.session.scalars(
+            insert(Student).returning(Student.id, sort_by_parameter_order=True),
+            [{'name': f'Student {identity}',
+              'student_id': SYNTHETIC_STUDENT_ID.format(identity),
+              'email': f'student-{identity}@example.com',
+              'class_id': class_ids[student_class[identity]],
+              'face_encoding_data': pack_face_encoding(encoding)} for identity, encoding in zip(identities, encodings)]
+        ).all()
+        db.session.commit()
+
+        # Each student attends with their own probability (mostly 70-95%)
+        for identity, student_id, rate in zip(identities, ids, rng.beta(8, 2, len(ids))):
+            class_students[student_class[identity]].append(student_id)
+            student_rates[student_id] = rate
+        progress(f'Generated {start + len(ids)} students')
+
+    # 4. Sessions and records, class by class
+    today = date.today()
+    first_day = today - timedelta(days=days)
+    session_count = 0
+    record_count = 0
+    records = []
+
+    def flush_records():
+        nonlocal records
+        if records:
+            db.session.execute(insert(AttendanceRecord), records)
+            db.session.commit()
+            records = []
+
+    for index, class_id in enumerate(class_ids):
+        weekdays = set(rng.choice(5, min(sessions_per_week, 5), replace=False).tolist())
+        start_time = time(8 + int(rng.integers(0, 8)))
+        session_dates = [first_day + timedelta(days=offset) for offset in range(days)
+                         if (first_day + timedelta(days=offset)).weekday() in weekdays]
+        if not session_dates:
+            continue
+
+        session_ids = db.session.scalars(
+            insert(AttendanceSession).returning(AttendanceSession.id, sort_by_parameter_order=True),
+            [{'class_id': class_id,
+              'session_date': session_date,
+              'start_time': start_time,
+              'end_time': time(start_time.hour, 50),
+              'status': 'completed',
+              'created_at': datetime.combine(session_date, start_time)} for session_date in session_dates]
+        ).all()
+        session_count += len(session_ids)
+
+        enrolled = class_students[index]
+        if enrolled:
+            rates = np.array([student_rates[student_id] for student_id in enrolled])
+            present = rng.random((len(session_ids), len(enrolled))) < rates
+            confidences = np.where(present, rng.uniform(0.6, 0.95, present.shape), 0.0)
+
+            for session_id, session_date, session_present, session_confidences in zip(
+                    session_ids, session_dates, present.tolist(), confidences.tolist()):
+                recorded_at = datetime.combine(session_date, start_time)
+                records.extend({'session_id': session_id,
+                                'student_id': student_id,
+                                'status': 'present' if is_present else 'absent',
+                                'confidence': confidence,
+                                'recorded_at': recorded_at}
+                               for student_id, is_present, confidence in zip(enrolled, session_present, session_confidences))
+            record_count += present.size
+
+        if len(records) >= INSERT_CHUNK_SIZE:
+            flush_records()
+            progress(f'Generated sessions for {index + 1} of {classes} classes ({record_count} records)')
+
+    flush_records()
+
+    # 5. Dashboards and reports read the rollups
+    rebuild_rollups()
+    db.session.commit()
+    invalidate_class_encodings()
+
+    counts = {'teachers': teachers, 'classes': classes, 'students': students,
+              'sessions': session_count, 'records': record_count}
+    progress(f'Generated {session_count} sessions and {record_count} attendance records')
+    return counts
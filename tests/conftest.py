@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """The application on an in-memory SQLite database, processing photos inside the request"""
+    workdir = tmp_path_factory.mktemp('sgis')
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'STORAGE_ROOT': str(workdir / 'storage'),
+        'FACE_INDEX_PATH': str(workdir / 'face_index.npz'),
+        'ATTENDANCE_WORKERS': 0,
+    })
+
+    with app.app_context():
+        db.create_all()
+
+    # No app context stays pushed: each request must get its own, as in production
+    return app
@@ -0,0 +1,47 @@
+"""
+create_app() builds independent applications.
+"""
+from app import create_app, db
+from models import User
+
+
+def make_app(tmp_path, **config):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'STORAGE_ROOT': str(tmp_path / 'storage'),
+        'FACE_INDEX_PATH': str(tmp_path / 'face_index.npz'),
+        'ATTENDANCE_WORKERS': 0,
+        **config,
+    })
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def test_each_call_returns_an_independent_app(tmp_path):
+    first = make_app(tmp_path / 'first', ATTENDANCE_MAX_PHOTOS=2)
+    second = make_app(tmp_path / 'second')
+
+    assert first is not second
+    assert first.config['ATTENDANCE_MAX_PHOTOS'] == 2
+    assert second.config['ATTENDANCE_MAX_PHOTOS'] != 2
+
+    # Each app has its own database
+    with first.app_context():
+        teacher = User(username='factory-teacher', email='factory-teacher@example.com')
+        teacher.set_password('password')
+        db.session.add(teacher)
+        db.session.commit()
+    with second.app_context():
+        assert User.query.filter_by(username='factory-teacher').first() is None
+
+    assert first.test_client().post('/login', data={'username': 'factory-teacher',
+                                                    'password': 'password'}).status_code == 302
+    assert second.test_client().post('/login', data={'username': 'factory-teacher',
+                                                     'password': 'password'}).status_code == 200
+
+    # Both get the routes, request hooks and CLI commands
+    for app in (first, second):
+        assert app.test_client().get('/dashboard').status_code == 302
+        assert 'init-db' in app.cli.list_commands(None)
@@ -0,0 +1,151 @@
+"""
+Taking attendance from classroom photos, end to end through the capture API.
+"""
+import io
+import itertools
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import db
+from models import User, Class, Student, AttendanceRecord
+from recognition_backends import ENCODING_DIMENSION
+
+_teacher_numbers = itertools.count()
+
+
+def seed_class(students):
+    """Create a teacher with one class of enrolled students; returns (username, class ID)"""
+    username = f'attendance-teacher-{next(_teacher_numbers)}'
+    teacher = User(username=username, email=f'{username}@example.com')
+    teacher.set_password('password')
+    db.session.add(teacher)
+    db.session.flush()
+
+    class_obj = Class(name=f'{username} class', teacher_id=teacher.id)
+    db.session.add(class_obj)
+    db.session.flush()
+
+    for number in range(students):
+        student = Student(name=f'Student {number}', student_id=f'{username}-{number}', class_id=class_obj.id)
+        student.set_face_encoding(np.random.uniform(-1, 1, ENCODING_DIMENSION))
+        db.session.add(student)
+
+    db.session.commit()
+    return username, class_obj.id
+
+
+def logged_in_client(app, username):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': 'password'})
+    assert response.status_code == 302
+    return client
+
+
+def classroom_photo(seed=0):
+    output = io.BytesIO()
+    Image.new('RGB', (640, 480), (seed % 256, 90, 160)).save(output, 'JPEG')
+    return output.getvalue()
+
+
+@pytest.fixture
+def demo_class(app):
+    np.random.seed(0)
+    with app.app_context():
+        return seed_class(students=5)
+
+
+def test_demo_session_marks_students_present(app, demo_class):
+    username, class_id = demo_class
+    client = logged_in_client(app, username)
+
+    response = client.post(f'/api/capture_image?class_id={class_id}', data=classroom_photo(),
+                           content_type='image/jpeg').get_json()
+    assert response['success'], response
+
+    with app.app_context():
+        statuses = [record.status for record in
+                    AttendanceRecord.query.filter_by(session_id=response['session_id']).all()]
+
+    assert len(statuses) == 5
+    assert statuses.count('present') >= 1
+
+
+def capture(client, class_id, photo, key=None):
+    headers = {'Idempotency-Key': key} if key else {}
+    response = client.post(f'/api/capture_image?class_id={class_id}', data=photo,
+                           content_type='image/jpeg', headers=headers).get_json()
+    assert response['success'], response
+    return response
+
+
+def test_resubmission_returns_the_existing_session(app, demo_class):
+    username, class_id = demo_class
+    client = logged_in_client(app, username)
+
+    first = capture(client, class_id, classroom_photo(1), key='submission-1')
+    assert not first['duplicate']
+
+    # The same bytes again
+    same_photo = capture(client, class_id, classroom_photo(1))
+    assert same_photo['duplicate']
+    assert same_photo['session_id'] == first['session_id']
+
+    # Another photo sent with the same Idempotency-Key
+    same_key = capture(client, class_id, classroom_photo(2), key='submission-1')
+    assert same_key['duplicate']
+    assert same_key['session_id'] == first['session_id']
+
+    other = capture(client, class_id, classroom_photo(3))
+    assert not other['duplicate']
+    assert other['session_id'] != first['session_id']
+
+
+def test_resubmission_waits_for_a_session_being_created(app, demo_class):
+    import attendance_pipeline
+
+    username, class_id = demo_class
+    client = logged_in_client(app, username)
+    first = capture(client, class_id, classroom_photo(4))
+
+    # An identical submission has reserved its key but not committed its session yet
+    with app.app_context(), attendance_pipeline._submissions_lock:
+        pending = attendance_pipeline._reserve_submission([(class_id, 'key', 'submission-2')])
+
+    def commit_session():
+        pending.session_id = first['session_id']
+        pending.ready.set()
+
+    timer = threading.Timer(0.2, commit_session)
+    timer.start()
+    try:
+        response = capture(client, class_id, classroom_photo(5), key='submission-2')
+    finally:
+        timer.join()
+
+    assert response['duplicate']
+    assert response['session_id'] == first['session_id']
+
+
+def test_sessions_are_committed_outside_the_submissions_lock(app, demo_class):
+    import attendance_pipeline
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    username, class_id = demo_class
+    client = logged_in_client(app, username)
+
+    lock_held = []
+
+    def before_commit(session):
+        lock_held.append(attendance_pipeline._submissions_lock.locked())
+
+    event.listen(Session, 'before_commit', before_commit)
+    try:
+        capture(client, class_id, classroom_photo(6))
+    finally:
+        event.remove(Session, 'before_commit', before_commit)
+
+    assert lock_held and not any(lock_held)
@@ -0,0 +1,242 @@
+"""
+Attendance records and the rollup tables kept alongside them.
+
+Writing a session's records must be idempotent, and however the records
+got there, the incrementally maintained rollups must equal what
+rebuild-attendance-rollups computes from the records.
+"""
+import itertools
+from datetime import date
+
+import numpy as np
+import pytest
+from sqlalchemy import text
+
+from app import db
+from models import (User, Class, Student, AttendanceSession, AttendanceRecord, SessionDetections,
+                    ClassAttendanceRollup, StudentAttendanceRollup)
+from attendance_rollups import UPSERT_INSERTS, rebuild_rollups
+from attendance_pipeline import record_attendance, write_attendance_records
+from recognition_backends import ENCODING_DIMENSION
+
+_teacher_numbers = itertools.count()
+
+
+def seed_class(students):
+    """Create a teacher with one class; returns (class ID, student IDs)"""
+    username = f'records-teacher-{next(_teacher_numbers)}'
+    teacher = User(username=username, email=f'{username}@example.com')
+    teacher.set_password('password')
+    db.session.add(teacher)
+    db.session.flush()
+
+    class_obj = Class(name=f'{username} class', teacher_id=teacher.id)
+    db.session.add(class_obj)
+    db.session.flush()
+
+    student_objs = [Student(name=f'Student {number}', student_id=f'{username}-{number}', class_id=class_obj.id)
+                    for number in range(students)]
+    db.session.add_all(student_objs)
+    db.session.commit()
+    return class_obj.id, [student.id for student in student_objs]
+
+
+def add_session(class_id, status='processing'):
+    attendance_session = AttendanceSession(class_id=class_id, session_date=date.today(), status=status)
+    db.session.add(attendance_session)
+    db.session.commit()
+    return attendance_session
+
+
+def record_statuses(session_id):
+    return sorted(db.session.query(AttendanceRecord.student_id, AttendanceRecord.status)
+                  .filter(AttendanceRecord.session_id == session_id))
+
+
+def rollup_rows(class_id):
+    """Both rollup tables' rows of a class, as comparable tuples"""
+    class_rows = sorted(db.session.query(ClassAttendanceRollup.session_date, ClassAttendanceRollup.session_count,
+                                         ClassAttendanceRollup.present_count, ClassAttendanceRollup.record_count)
+                        .filter(ClassAttendanceRollup.class_id == class_id))
+    student_rows = sorted(db.session.query(StudentAttendanceRollup.student_id, StudentAttendanceRollup.session_count,
+                                           StudentAttendanceRollup.present_count)
+                          .filter(StudentAttendanceRollup.class_id == class_id))
+    return class_rows, student_rows
+
+
+def assert_rollups_match_rebuild(class_id):
+    maintained = rollup_rows(class_id)
+    rebuild_rollups()
+    db.session.commit()
+    assert maintained == rollup_rows(class_id)
+
+
+@pytest.fixture(params=['upsert', 'portable'])
+def dialect_support(request, monkeypatch):
+    """Run with INSERT ... ON CONFLICT and with the portable delete-and-insert fallback"""
+    if request.param == 'portable':
+        monkeypatch.delitem(UPSERT_INSERTS, 'sqlite')
+    return request.param
+
+
+def test_writing_records_twice_never_duplicates(app, dialect_support):
+    with app.app_context():
+        class_id, student_ids = seed_class(students=3)
+        attendance_session = add_session(class_id)
+
+        first = {student_id: 'present' for student_id in student_ids}
+        write_attendance_records(attendance_session.id, first, dict.fromkeys(student_ids, 0.9))
+        db.session.commit()
+
+        second = {**first, student_ids[0]: 'absent'}
+        write_attendance_records(attendance_session.id, second, dict.fromkeys(student_ids, 0.8))
+        db.session.commit()
+
+        assert record_statuses(attendance_session.id) == sorted(second.items())
+        assert {confidence for confidence, in db.session.query(AttendanceRecord.confidence)
+                .filter(AttendanceRecord.session_id == attendance_session.id)} == {0.8}
+
+
+def test_recording_a_session_again_replaces_its_rollup_share(app, dialect_support):
+    with app.app_context():
+        class_id, student_ids = seed_class(students=4)
+        earlier_session = add_session(class_id)
+        record_attendance(earlier_session, dict.fromkeys(student_ids, 'present'), dict.fromkeys(student_ids, 0.9))
+        db.session.commit()
+
+        attendance_session = add_session(class_id)
+        statuses = {student_id: 'present' if number % 2 else 'absent' for number, student_id in enumerate(student_ids)}
+        confidences = {student_id: 0.9 if status == 'present' else 0 for student_id, status in statuses.items()}
+        record_attendance(attendance_session, statuses, confidences)
+        db.session.commit()
+
+        # A retry of the same session, with a different outcome
+        retried = {**statuses, student_ids[0]: 'present'}
+        record_attendance(attendance_session, retried, {**confidences, student_ids[0]: 0.7})
+        db.session.commit()
+
+        assert attendance_session.status == 'completed'
+        assert record_statuses(attendance_session.id) == sorted(retried.items())
+
+        class_rows, _ = rollup_rows(class_id)
+        assert class_rows == [(date.today(), 2, 4 + 3, 8)]
+        assert_rollups_match_rebuild(class_id)
+
+
+def test_migrate_attendance_records_removes_duplicates_before_adding_the_index(app):
+    with app.app_context():
+        class_id, student_ids = seed_class(students=2)
+        session_id = add_session(class_id, status='completed').id
+
+        # A database from before the unique index, with a student recorded twice
+        db.session.execute(text('DROP INDEX uq_attendance_record_session_student'))
+        db.session.add_all([
+            AttendanceRecord(session_id=session_id, student_id=student_ids[0], status='absent'),
+            AttendanceRecord(session_id=session_id, student_id=student_ids[1], status='absent'),
+            AttendanceRecord(session_id=session_id, student_id=student_ids[0], status='present'),
+        ])
+        db.session.commit()
+        rebuild_rollups()
+        db.session.commit()
+        assert rollup_rows(class_id)[0] == [(date.today(), 1, 1, 3)]
+
+    result = app.test_cli_runner().invoke(args=['migrate-attendance-records'])
+    assert result.exit_code == 0, result.output
+    assert 'Removed 1 duplicate records' in result.output
+
+    with app.app_context():
+        # The most recent record of each student is kept
+        assert record_statuses(session_id) == [(student_ids[0], 'present'), (student_ids[1], 'absent')]
+        assert rollup_rows(class_id)[0] == [(date.today(), 1, 1, 2)]
+        assert_rollups_match_rebuild(class_id)
+
+        # The index is back, so writing the records again cannot duplicate them
+        indexes = db.session.execute(text("PRAGMA index_list('attendance_record')")).all()
+        assert 'uq_attendance_record_session_student' in {index[1] for index in indexes}
+
+
+@pytest.fixture
+def exact_matching(monkeypatch):
+    """Match faces by distance alone; the mock backend places random students in every photo"""
+    import recognition_backends
+    monkeypatch.setattr(recognition_backends, '_backend', recognition_backends.SyntheticRecognitionBackend())
+
+
+def test_rematch_after_enrolling_updates_records_and_rollups(app, exact_matching):
+    from encoding_cache import invalidate_class_encodings
+    from attendance_pipeline import rematch_attendance
+
+    rng = np.random.default_rng(0)
+    faces = rng.normal(0, 1, (3, ENCODING_DIMENSION)).astype(np.float32)
+
+    with app.app_context():
+        class_id, student_ids = seed_class(students=2)
+        first, second = db.session.query(Student).filter(Student.id.in_(student_ids)).order_by(Student.id)
+        # The first student is in the photo; the second's enrolled face is not
+        first.set_face_encoding(faces[0])
+        second.set_face_encoding(rng.normal(0, 1, ENCODING_DIMENSION))
+        db.session.commit()
+
+        earlier_session = add_session(class_id)
+        record_attendance(earlier_session, {first.id: 'present', second.id: 'absent'}, {first.id: 0.9, second.id: 0})
+
+        attendance_session = add_session(class_id)
+        detections = SessionDetections(session_id=attendance_session.id)
+        detections.set_detections([(0, 10, 10, 0)] * 3, faces)
+        db.session.add(detections)
+        record_attendance(attendance_session, {first.id: 'present', second.id: 'absent'}, {first.id: 0.9, second.id: 0})
+        db.session.commit()
+        invalidate_class_encodings(class_id)
+
+        # The second student re-enrolls with a photo matching a face in the session, and a new
+        # student, also in the photo, joins the class
+        second.set_face_encoding(faces[1])
+        newcomer = Student(name='Newcomer', student_id=f'{second.student_id}-new', class_id=class_id)
+        newcomer.set_face_encoding(faces[2])
+        db.session.add(newcomer)
+        db.session.commit()
+        invalidate_class_encodings(class_id)
+
+        success, message = rematch_attendance(attendance_session.id)
+        assert success, message
+        assert '2 records changed' in message
+
+        assert record_statuses(attendance_session.id) == sorted([(first.id, 'present'), (second.id, 'present'),
+                                                                 (newcomer.id, 'present')])
+        # The earlier session is untouched
+        assert record_statuses(earlier_session.id) == sorted([(first.id, 'present'), (second.id, 'absent')])
+
+        class_rows, student_rows = rollup_rows(class_id)
+        assert class_rows == [(date.today(), 2, 4, 5)]
+        assert student_rows == sorted([(first.id, 2, 2), (second.id, 2, 1), (newcomer.id, 1, 1)])
+        assert_rollups_match_rebuild(class_id)
+
+
+def test_report_rates_count_completed_sessions_only(app):
+    from flask import template_rendered
+
+    with app.app_context():
+        class_id, student_ids = seed_class(students=2)
+        username = db.session.get(Class, class_id).teacher.username
+        completed = add_session(class_id)
+        record_attendance(completed, {student_ids[0]: 'present', student_ids[1]: 'absent'},
+                          {student_ids[0]: 0.9, student_ids[1]: 0})
+        db.session.commit()
+        completed_id = completed.id
+        # Neither has records nor is counted in the rollups
+        add_session(class_id, status='processing')
+        add_session(class_id, status='failed')
+
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'password'})
+
+    rendered = []
+    with template_rendered.connected_to(lambda sender, template, context: rendered.append(context), app):
+        for url in (f'/attendance/reports?class_id={class_id}',
+                    f'/attendance/reports?class_id={class_id}&start_date={date.today()}'):
+            assert client.get(url).status_code == 200
+
+    for context in rendered:
+        reports = context['reports']
+        assert [attendance_session.id for attendance_session in reports['sessions']] == [completed_id]
+        assert sorted(row['attendance_rate'] for row in reports['student_attendance']) == [0, 100]
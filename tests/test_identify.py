@@ -0,0 +1,66 @@
+"""
+Identifying students in a photo through the institution-wide face index.
+"""
+import io
+
+import pytest
+
+import recognition_backends
+from app import db
+from models import User, Class, Student
+from synthetic_data import classroom_photo
+
+
+@pytest.fixture
+def synthetic_backend(monkeypatch):
+    """Faces named in the photo's JPEG comment, with encodings close to their identity's"""
+    backend = recognition_backends.SyntheticRecognitionBackend()
+    monkeypatch.setattr(recognition_backends, '_backend', backend)
+    return backend
+
+
+def seed_teacher(username, identities, synthetic_backend, role='teacher'):
+    """Create a teacher with one class whose students have the given synthetic identities"""
+    teacher = User(username=username, email=f'{username}@example.com', role=role)
+    teacher.set_password('password')
+    db.session.add(teacher)
+    db.session.flush()
+
+    class_obj = Class(name=f'{username} class', teacher_id=teacher.id)
+    db.session.add(class_obj)
+    db.session.flush()
+
+    students = []
+    for identity, encoding in zip(identities, synthetic_backend.identity_encodings(identities)):
+        student = Student(name=f'{username} student {identity}', student_id=f'{username}-{identity}',
+                          class_id=class_obj.id)
+        student.set_face_encoding(encoding)
+        students.append(student)
+    db.session.add_all(students)
+    db.session.commit()
+    return [student.id for student in students]
+
+
+def identified_ids(app, username, photo):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'password'})
+    response = client.post('/api/identify', data={'photo': (io.BytesIO(photo), 'photo.jpg')},
+                           content_type='multipart/form-data').get_json()
+    assert response['success'], response
+    return {face['student']['id'] for face in response['faces'] if face['student']}
+
+
+def test_teachers_identify_only_their_own_students(app, synthetic_backend):
+    from face_index import get_face_index_store
+
+    with app.app_context():
+        own_ids = seed_teacher('identify-teacher', [101, 102], synthetic_backend)
+        other_ids = seed_teacher('identify-other-teacher', [201, 202], synthetic_backend)
+        seed_teacher('identify-admin', [], synthetic_backend, role='admin')
+        get_face_index_store().build()
+
+    photo = classroom_photo([101, 102, 201, 202], width=800, height=600)
+
+    assert identified_ids(app, 'identify-teacher', photo) == set(own_ids)
+    assert identified_ids(app, 'identify-other-teacher', photo) == set(other_ids)
+    assert identified_ids(app, 'identify-admin', photo) == set(own_ids + other_ids)
@@ -0,0 +1,24 @@
+"""
+Access to the Prometheus /metrics endpoint.
+"""
+
+
+def test_metrics_without_a_token_are_only_served_locally(app):
+    client = app.test_client()
+
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 404
+    # A proxy on the same host forwarding an outside request
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'}).status_code == 404
+
+
+def test_metrics_require_the_token_when_set(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    client = app.test_client()
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                          environ_base={'REMOTE_ADDR': '203.0.113.7'})
+    assert response.status_code == 200
+    assert b'# TYPE' in response.data
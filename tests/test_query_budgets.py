@@ -0,0 +1,121 @@
+"""
+SQL statement budgets of the main pages.
+
+Each page must run a fixed number of statements however many classes,
+students and sessions the teacher has; a lazy relationship load or a
+per-class query in a loop shows up here as a growing count.
+"""
+import itertools
+from datetime import date, timedelta
+
+import pytest
+
+from app import db
+from models import User, Class, Student, AttendanceSession, AttendanceRecord
+from attendance_rollups import rebuild_rollups
+from query_stats import count_queries
+
+# Statements per page, including loading the logged-in user
+DASHBOARD_BUDGET = 6
+ATTENDANCE_REPORTS_BUDGET = 6
+VIEW_ATTENDANCE_BUDGET = 3
+
+_teacher_numbers = itertools.count()
+
+
+def seed_teacher(classes, students_per_class, sessions_per_class):
+    """Create a teacher with classes, students and completed sessions; returns (username, class IDs, session IDs)"""
+    username = f'teacher-{next(_teacher_numbers)}'
+    teacher = User(username=username, email=f'{username}@example.com')
+    teacher.set_password('password')
+    db.session.add(teacher)
+    db.session.flush()
+
+    class_ids = []
+    session_ids = []
+    for class_number in range(classes):
+        class_obj = Class(name=f'{username} class {class_number}', teacher_id=teacher.id)
+        db.session.add(class_obj)
+        db.session.flush()
+        class_ids.append(class_obj.id)
+
+        students = [Student(name=f'Student {number}', student_id=f'{username}-{class_number}-{number}',
+                            class_id=class_obj.id) for number in range(students_per_class)]
+        db.session.add_all(students)
+        db.session.flush()
+
+        for day in range(sessions_per_class):
+            attendance_session = AttendanceSession(class_id=class_obj.id, status='completed',
+                                                   session_date=date.today() - timedelta(days=day))
+            db.session.add(attendance_session)
+            db.session.flush()
+            session_ids.append(attendance_session.id)
+            db.session.add_all(AttendanceRecord(session_id=attendance_session.id, student_id=student.id,
+                                                status='present' if (day + number) % 3 else 'absent')
+                               for number, student in enumerate(students))
+
+    rebuild_rollups()
+    db.session.commit()
+    return username, class_ids, session_ids
+
+
+def logged_in_client(app, username):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': 'password'})
+    assert response.status_code == 302
+    return client
+
+
+def count_statements(client, url):
+    with count_queries() as stats:
+        response = client.get(url)
+    assert response.status_code == 200, url
+    return stats
+
+
+@pytest.fixture(scope='module')
+def small(app):
+    with app.app_context():
+        return seed_teacher(classes=1, students_per_class=2, sessions_per_class=1)
+
+
+@pytest.fixture(scope='module')
+def large(app):
+    with app.app_context():
+        return seed_teacher(classes=8, students_per_class=15, sessions_per_class=12)
+
+
+def test_dashboard_budget(app, small, large):
+    counts = []
+    for username, _, _ in (small, large):
+        stats = count_statements(logged_in_client(app, username), '/dashboard')
+        assert stats.count <= DASHBOARD_BUDGET, stats.statements
+        counts.append(stats.count)
+
+    assert counts[0] == counts[1]
+
+
+def test_attendance_reports_budget(app, small, large):
+    counts = []
+    for username, class_ids, _ in (small, large):
+        client = logged_in_client(app, username)
+        for url in (f'/attendance/reports?class_id={class_ids[-1]}',
+                    f'/attendance/reports?class_id={class_ids[-1]}&start_date={date.today() - timedelta(days=7)}'):
+            stats = count_statements(client, url)
+            assert stats.count <= ATTENDANCE_REPORTS_BUDGET, stats.statements
+            counts.append(stats.count)
+            # Records are only ever counted, never loaded one row each
+            assert not [statement for statement in stats.statements
+                        if 'FROM attendance_record' in statement and 'GROUP BY' not in statement], stats.statements
+
+    assert counts[:2] == counts[2:]
+
+
+def test_view_attendance_budget(app, small, large):
+    counts = []
+    for username, _, session_ids in (small, large):
+        stats = count_statements(logged_in_client(app, username), f'/attendance/session/{session_ids[-1]}')
+        assert stats.count <= VIEW_ATTENDANCE_BUDGET, stats.statements
+        counts.append(stats.count)
+
+    assert counts[0] == counts[1]
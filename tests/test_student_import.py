@@ -0,0 +1,96 @@
+"""
+Bulk student enrollment from a CSV roster and a zip of photos.
+"""
+import io
+import itertools
+import zipfile
+
+import pytest
+from PIL import Image
+
+from app import db
+from models import User, Class, Student
+from storage import get_storage
+
+_teacher_numbers = itertools.count()
+
+
+@pytest.fixture
+def class_obj(app):
+    with app.app_context():
+        username = f'import-teacher-{next(_teacher_numbers)}'
+        teacher = User(username=username, email=f'{username}@example.com')
+        teacher.set_password('password')
+        db.session.add(teacher)
+        db.session.flush()
+        class_obj = Class(name=f'{username} class', teacher_id=teacher.id)
+        db.session.add(class_obj)
+        db.session.commit()
+        return class_obj.id
+
+
+def photo(seed):
+    output = io.BytesIO()
+    Image.new('RGB', (120, 160), (seed, 120, 80)).save(output, 'JPEG')
+    return output.getvalue()
+
+
+def archive(members):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w') as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+    output.seek(0)
+    return output
+
+
+def roster(prefix, rows):
+    lines = ['name,student_id,photo'] + [f'Student {number},{prefix}-{number},{photo_name}'
+                                         for number, photo_name in enumerate(rows)]
+    return io.BytesIO('\n'.join(lines).encode())
+
+
+def run_import(app, class_id, roster_file, photos_file):
+    from student_import import import_students
+
+    with app.test_request_context():
+        return import_students(db.session.get(Class, class_id), roster_file, photos_file)
+
+
+def test_photos_are_matched_by_path_and_unambiguous_name(app, class_obj):
+    photos = archive({'a/same.jpg': photo(1), 'b/same.jpg': photo(2), 'b/unique.jpg': photo(3)})
+    results = run_import(app, class_obj, roster('paths', ['a/same.jpg', 'b/same.jpg', 'unique.jpg', 'same.jpg']),
+                         photos)
+
+    assert [result['status'] for result in results] == ['imported', 'imported', 'imported', 'error']
+    assert 'Several photos in the archive' in results[3]['message']
+
+    with app.app_context():
+        stored = {student.student_id: get_storage().get(student.face_image_path)
+                  for student in Student.query.filter(Student.student_id.like('paths-%'))}
+    assert stored == {'paths-0': photo(1), 'paths-1': photo(2), 'paths-2': photo(3)}
+
+
+def test_failed_insert_deletes_the_uploaded_photos(app, class_obj, monkeypatch):
+    import student_import
+
+    uploaded = []
+    upload_photos = student_import._upload_photos
+
+    def record_uploads(photos):
+        uploaded.extend(photos)
+        return upload_photos(photos)
+
+    def fail_insert(*args, **kwargs):
+        raise RuntimeError('insert failed')
+
+    monkeypatch.setattr(student_import, '_upload_photos', record_uploads)
+    monkeypatch.setattr(db.session, 'scalars', fail_insert)
+
+    results = run_import(app, class_obj, roster('orphans', ['one.jpg', 'two.jpg']),
+                         archive({'one.jpg': photo(4), 'two.jpg': photo(5)}))
+
+    assert [result['status'] for result in results] == ['error', 'error']
+    assert len(uploaded) == 2
+    with app.app_context():
+        assert not [path for path in uploaded if get_storage().exists(path)]
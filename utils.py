@@ -1,19 +1,36 @@
+import io
 import os
 import json
+import struct
 import logging
-import numpy as np
 from datetime import datetime, date
 from flask import current_app
 from werkzeug.utils import secure_filename
 
 logger = logging.getLogger(__name__)
 
+# NumPy is imported inside the functions that use it, so modules needing only
+# the small helpers here (most of the web app) load without it
+
+# Binary face encoding layout: little-endian uint16 version, uint16 dimension,
+# followed by `dimension` little-endian float32 values
+FACE_ENCODING_VERSION = 1
+FACE_ENCODING_HEADER = struct.Struct('<HH')
+FACE_ENCODING_DTYPE = '<f4'
+
+# Binary detection layout: little-endian uint16 version, uint16 dimension, uint32
+# face count, followed by `count` (top, right, bottom, left) int32 boxes, `count`
+# int32 photo indices (version 2 only) and `count` x `dimension` float32 encodings
+FACE_DETECTIONS_VERSION = 2
+FACE_DETECTIONS_HEADER = struct.Struct('<HHI')
+FACE_LOCATION_DTYPE = '<i4'
+
 class DateTimeEncoder(json.JSONEncoder):
     """Custom encoder for datetime objects to JSON"""
     def default(self, obj):
         if isinstance(obj, (datetime, date)):
             return obj.isoformat()
-        elif isinstance(obj, np.ndarray):
+        elif hasattr(obj, 'tolist'):  # NumPy arrays
             return obj.tolist()
         return super(DateTimeEncoder, self).default(obj)
 
@@ -117,3 +134,210 @@ def paginate(items, page, per_page):
     total_pages = (len(items) + per_page - 1) // per_page
     
     return paginated_items, total_pages
+
+def pack_face_encoding(encoding):
+    """
+    Serialize a face encoding to its compact binary form
+    
+    Args:
+        encoding: Sequence or 1-D array of floats
+        
+    Returns:
+        bytes: Versioned header followed by raw float32 values
+    """
+    import numpy as np
+    values = np.asarray(encoding, dtype=FACE_ENCODING_DTYPE).ravel()
+    return FACE_ENCODING_HEADER.pack(FACE_ENCODING_VERSION, len(values)) + values.tobytes()
+
+def unpack_face_encoding(data):
+    """
+    Deserialize a face encoding produced by pack_face_encoding
+    
+    Args:
+        data: Bytes-like object holding a packed face encoding
+        
+    Returns:
+        numpy.ndarray: 1-D float32 array
+        
+    Raises:
+        ValueError: If the header is unknown or the payload is truncated
+    """
+    import numpy as np
+    view = memoryview(data)
+    if len(view) < FACE_ENCODING_HEADER.size:
+        raise ValueError("Face encoding data is too short")
+    
+    version, dimension = FACE_ENCODING_HEADER.unpack_from(view)
+    if version != FACE_ENCODING_VERSION:
+        raise ValueError(f"Unsupported face encoding version: {version}")
+    
+    expected_size = FACE_ENCODING_HEADER.size + dimension * np.dtype(FACE_ENCODING_DTYPE).itemsize
+    if len(view) != expected_size:
+        raise ValueError(f"Face encoding data has {len(view)} bytes, expected {expected_size}")
+    
+    return np.frombuffer(view, dtype=FACE_ENCODING_DTYPE, offset=FACE_ENCODING_HEADER.size).astype(np.float32)
+
+def unpack_face_encodings(blobs):
+    """
+    Deserialize many packed face encodings into a single matrix
+    
+    Args:
+        blobs: Sequence of packed face encodings, all of the same dimension
+        
+    Returns:
+        numpy.ndarray: (len(blobs), dimension) float32 matrix
+    """
+    import numpy as np
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+    
+    header = bytes(memoryview(blobs[0])[:FACE_ENCODING_HEADER.size])
+    version, dimension = FACE_ENCODING_HEADER.unpack(header)
+    expected_size = FACE_ENCODING_HEADER.size + dimension * np.dtype(FACE_ENCODING_DTYPE).itemsize
+    
+    if version != FACE_ENCODING_VERSION:
+        raise ValueError(f"Unsupported face encoding version: {version}")
+    for blob in blobs:
+        if len(blob) != expected_size or bytes(memoryview(blob)[:FACE_ENCODING_HEADER.size]) != header:
+            raise ValueError("Face encodings have mismatched versions or dimensions")
+    
+    # One contiguous buffer, one decode, header columns sliced away
+    raw = np.frombuffer(b''.join(blobs), dtype=np.uint8).reshape(len(blobs), expected_size)
+    return raw[:, FACE_ENCODING_HEADER.size:].copy().view(FACE_ENCODING_DTYPE).astype(np.float32, copy=False)
+
+def pack_face_detections(face_locations, face_encodings, photo_indices=None):
+    """
+    Serialize the faces detected in a session's photos to a single compact blob
+    
+    Args:
+        face_locations: List of (top, right, bottom, left) tuples
+        face_encodings: List of face encodings, one per location
+        photo_indices: Index of the photo each face was found in (default: all in photo 0)
+        
+    Returns:
+        bytes: Versioned header followed by raw int32 boxes and photo indices and float32 encodings
+    """
+    import numpy as np
+    locations = np.asarray(face_locations, dtype=FACE_LOCATION_DTYPE).reshape(-1, 4)
+    encodings = np.asarray(face_encodings, dtype=FACE_ENCODING_DTYPE)
+    encodings = encodings.reshape(len(locations), -1 if len(locations) else 0)
+    photos = np.zeros(len(locations), dtype=FACE_LOCATION_DTYPE) if photo_indices is None \
+        else np.asarray(photo_indices, dtype=FACE_LOCATION_DTYPE)
+    if len(encodings) != len(locations) or len(photos) != len(locations):
+        raise ValueError("Every face location needs exactly one encoding and photo index")
+    
+    header = FACE_DETECTIONS_HEADER.pack(FACE_DETECTIONS_VERSION, encodings.shape[1], len(locations))
+    return header + locations.tobytes() + photos.tobytes() + encodings.tobytes()
+
+def unpack_face_detections(data):
+    """
+    Deserialize faces packed by pack_face_detections
+    
+    Args:
+        data: Bytes-like object holding packed detections
+        
+    Returns:
+        tuple: ((count, 4) int32 array of face locations, (count, dimension) float32 array of
+               encodings, (count,) int32 array of photo indices)
+        
+    Raises:
+        ValueError: If the header is unknown or the payload is truncated
+    """
+    import numpy as np
+    view = memoryview(data)
+    if len(view) < FACE_DETECTIONS_HEADER.size:
+        raise ValueError("Face detection data is too short")
+    
+    version, dimension, count = FACE_DETECTIONS_HEADER.unpack_from(view)
+    if version not in (1, FACE_DETECTIONS_VERSION):
+        raise ValueError(f"Unsupported face detection version: {version}")
+    
+    # Version 1 predates multi-photo sessions and has no photo indices
+    locations_size = count * 4 * np.dtype(FACE_LOCATION_DTYPE).itemsize
+    photos_size = count * np.dtype(FACE_LOCATION_DTYPE).itemsize if version >= 2 else 0
+    encodings_offset = FACE_DETECTIONS_HEADER.size + locations_size + photos_size
+    expected_size = encodings_offset + count * dimension * np.dtype(FACE_ENCODING_DTYPE).itemsize
+    if len(view) != expected_size:
+        raise ValueError(f"Face detection data has {len(view)} bytes, expected {expected_size}")
+    
+    locations = np.frombuffer(view, dtype=FACE_LOCATION_DTYPE, count=count * 4,
+                              offset=FACE_DETECTIONS_HEADER.size).reshape(count, 4)
+    if photos_size:
+        photos = np.frombuffer(view, dtype=FACE_LOCATION_DTYPE, count=count,
+                               offset=FACE_DETECTIONS_HEADER.size + locations_size).astype(np.int32)
+    else:
+        photos = np.zeros(count, dtype=np.int32)
+    encodings = np.frombuffer(view, dtype=FACE_ENCODING_DTYPE, count=count * dimension,
+                              offset=encodings_offset).reshape(count, dimension)
+    return locations.astype(np.int32), encodings.astype(np.float32), photos
+
+class BufferReader(io.RawIOBase):
+    """Read-only, seekable file object over a bytes-like buffer that never copies the whole buffer"""
+    
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, b):
+        chunk = self._view[self._position:self._position + len(b)]
+        b[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+    
+    def tell(self):
+        return self._position
+
+def read_upload(source, size=None):
+    """
+    Read an uploaded file or request body into a single buffer
+    
+    The data is copied at most once. Hashing, storage and image decoding
+    should all consume the returned view instead of re-reading the upload.
+    
+    Args:
+        source: FileStorage, file-like object or request stream
+        size: Number of bytes to read when the source is not seekable (e.g. request.content_length)
+        
+    Returns:
+        memoryview: Read-only view of the uploaded bytes
+    """
+    stream = getattr(source, 'stream', source)
+    
+    # Small uploads are parsed into a BytesIO, whose value can usually be shared without copying
+    if isinstance(stream, io.BytesIO):
+        return memoryview(stream.getvalue()).toreadonly()
+    
+    if size is None and stream.seekable():
+        stream.seek(0, io.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+    
+    readinto = getattr(stream, 'readinto', None)
+    if size is None or readinto is None:
+        return memoryview(stream.read()).toreadonly()
+    
+    # Fill a preallocated buffer in place
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    position = 0
+    while position < size:
+        count = readinto(view[position:])
+        if not count:
+            break
+        position += count
+    
+    return view[:position].toreadonly()